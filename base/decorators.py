@@ -1,4 +1,3 @@
-import socket
 import logging
 import log.config.client_log_config
 import log.config.server_log_config
@@ -18,8 +17,8 @@ else:
 def login_required(func):
     """
     Декоратор, проверяющий, что клиент авторизован на сервере.
-    Проверяет, что передаваемый объект сокета находится в
-    списке авторизованных клиентов.
+    Проверяет, что передаваемый объект подключения авторизован
+    и записан в словаре авторизованных клиентов.
     За исключением передачи словаря-запроса
     на авторизацию. Если клиент не авторизован,
     генерирует исключение TypeError
@@ -29,16 +28,16 @@ def login_required(func):
         # проверяем, что первый аргумент - экземпляр MessageProcessor
         # Импортить необходимо тут, иначе ошибка рекурсивного импорта.
         from server.center import MessageProcessor
+        from server.connection import ClientConnection
         from base.variables import ACTION, PRESENCE
         if isinstance(args[0], MessageProcessor):
             found = False
             for arg in args:
-                if isinstance(arg, socket.socket):
-                    # Проверяем, что данный сокет есть в списке names класса
-                    # MessageProcessor
-                    for client in args[0].names:
-                        if args[0].names[client] == arg:
-                            found = True
+                if isinstance(arg, ClientConnection):
+                    # Проверяем, что под именем подключения в словаре names
+                    # класса MessageProcessor записано именно оно
+                    if arg.authenticated and args[0].names.get(arg.name) is arg:
+                        found = True
 
             # Теперь надо проверить, что передаваемые аргументы не presence
             # сообщение. Если presense, то разрешаем
@@ -53,3 +52,20 @@ def login_required(func):
         return func(*args, **kwargs)
 
     return checker
+
+
+def action_handler(action, *fields, owner=None):
+    """
+    Декоратор, регистрирующий метод сервера обработчиком действия action.
+    fields - обязательные поля сообщения, owner - поле, в котором должно
+    быть имя пользователя, отправившего сообщение.
+    Реестр обработчиков строит метакласс ActionDispatcher.
+    """
+
+    def register(func):
+        func.action = action
+        func.required_fields = fields
+        func.owner_field = owner
+        return func
+
+    return register
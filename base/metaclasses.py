@@ -1,4 +1,5 @@
 import dis
+from collections import namedtuple
 
 
 class ServerVerifier(type):
@@ -80,3 +81,43 @@ class ClientVerifier(type):
         else:
             raise TypeError('Отсутствуют вызовы функций, работающих с сокетами.')
         super().__init__(clsname, bases, clsdict)
+
+
+# Запись реестра обработчиков: имя метода и функция проверки сообщения
+ActionHandler = namedtuple('ActionHandler', 'name validate')
+
+
+def make_validator(fields, owner):
+    """
+    Функция строит проверку сообщения для обработчика действия:
+    наличие обязательных полей и, если задано поле owner, совпадение
+    его значения с именем авторизованного пользователя подключения.
+    """
+    required = frozenset(fields)
+    if owner is None:
+        def validate(message, client):
+            return required <= message.keys()
+    else:
+        def validate(message, client):
+            return required <= message.keys() and message[owner] == client.name
+    return validate
+
+
+class ActionDispatcher(type):
+    """
+    Метакласс, строящий при создании класса сервера реестр обработчиков
+    действий протокола: словарь handlers, действие -> ActionHandler.
+    Обработчики наследуются, подкласс может добавить новые действия
+    или переопределить методы существующих.
+    """
+
+    # noinspection PyMethodParameters
+    def __init__(self, clsname, bases, clsdict):
+        handlers = dict(getattr(self, 'handlers', {}))
+        for name, func in clsdict.items():
+            action = getattr(func, 'action', None)
+            if action is not None and callable(func):
+                handlers[action] = ActionHandler(
+                    name, make_validator(func.required_fields, func.owner_field))
+        self.handlers = handlers
+        super().__init__(clsname, bases, clsdict)
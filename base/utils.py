@@ -1,34 +1,128 @@
 """Общие утилиты проекта"""
+import errno
+import hashlib
 import json
+import socket
+import struct
+import time
 
 from base.variables import *
 
+# Заголовок кадра - длина тела сообщения в байтах,
+# беззнаковое 4-байтовое целое в сетевом порядке байт.
+HEADER = struct.Struct('!I')
+
+
+def encode_message(message):
+    """
+    Утилита кодирования сообщения в кадр.
+    Принимает словарь, возвращает байты: заголовок с длиной и тело в JSON.
+    :param message:
+    :return:
+    """
+    body = json.dumps(message).encode(ENCODING)
+    return HEADER.pack(len(body)) + body
+
+
+def decode_message(body):
+    """
+    Утилита декодирования тела кадра.
+    Принимает байты, возвращает словарь, если принято что-то другое
+    генерирует ValueError.
+    :param body:
+    :return:
+    """
+    response = json.loads(bytes(body).decode(ENCODING))
+    if isinstance(response, dict):
+        return response
+    raise ValueError('Принятое сообщение не является словарём')
+
+
+def key_fingerprint(pubkey):
+    """Утилита вычисления отпечатка публичного ключа: SHA-256 текста ключа в hex."""
+    return hashlib.sha256(pubkey.encode(ENCODING)).hexdigest()
+
+
+def check_frame_length(length):
+    """Утилита проверки длины кадра из заголовка."""
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError(f'Превышен максимальный размер сообщения: {length}')
+
+
+class MessageDecoder:
+    """
+    Инкрементальный декодер потока кадров одного соединения.
+    Накапливает принятые байты и возвращает все полностью принятые
+    сообщения, неполный кадр сохраняется до следующего приёма.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Метод добавляет принятые байты и возвращает список готовых сообщений."""
+        self.buffer += data
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            length, = HEADER.unpack_from(self.buffer, offset)
+            check_frame_length(length)
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            messages.append(decode_message(self.buffer[offset + HEADER.size:end]))
+            offset = end
+        del self.buffer[:offset]
+        return messages
+
+
+def receive_exactly(sock_obj, length, deadline=None):
+    """
+    Утилита приёма из сокета ровно length байт.
+    Таймаут сокета прерывает приём, только если кадр ещё не начат: из него
+    ничего не принято и не задан срок deadline (time.monotonic). Начатый
+    кадр должен быть принят до срока, по умолчанию FRAME_TIMEOUT сек.
+    с первых принятых байт, иначе генерируется ConnectionAbortedError:
+    поток кадров разъехался бы на середине кадра.
+    """
+    data = bytearray()
+    while len(data) < length:
+        if deadline is not None and time.monotonic() >= deadline:
+            raise ConnectionAbortedError(errno.ETIMEDOUT, 'Истекло время приёма кадра')
+        try:
+            chunk = sock_obj.recv(length - len(data))
+        except socket.timeout:
+            if deadline is None:
+                raise
+            continue
+        if not chunk:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение закрыто удалённой стороной')
+        data += chunk
+        if deadline is None:
+            deadline = time.monotonic() + FRAME_TIMEOUT
+    return data
+
 
 def getting_message(sock_obj):
     """
     Утилита приёма и декодирования сообщения.
-    Принимает байты преобразует в словарь, если принято что-то другое возвращает ошибку значения
+    Принимает один кадр, преобразует его тело в словарь,
+    если принято что-то другое генерирует ValueError.
     :param sock_obj:
     :return:
     """
-    encoded_response = sock_obj.recv(MAX_PACKAGE_LENGTH)
-    if isinstance(encoded_response, bytes):
-        response_in_json = encoded_response.decode(ENCODING)
-        response = json.loads(response_in_json)
-        if isinstance(response, dict):
-            return response
-        return ValueError
-    return ValueError
+    length, = HEADER.unpack(receive_exactly(sock_obj, HEADER.size))
+    check_frame_length(length)
+    # Срок приёма тела отсчитывается от приёма заголовка
+    return decode_message(receive_exactly(sock_obj, length, time.monotonic() + FRAME_TIMEOUT))
 
 
 def sending_message(sock_obj, message):
     """
     Утилита кодирования и отправки сообщения.
-    Принимает словарь преобразует в байты
+    Принимает словарь преобразует в кадр и отправляет целиком.
     :param sock_obj:
     :param message:
     :return:
     """
-    message_in_json = json.dumps(message)
-    encoded_message = message_in_json.encode(ENCODING)
-    sock_obj.send(encoded_message)
+    sock_obj.sendall(encode_message(message))
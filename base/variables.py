@@ -6,9 +6,80 @@ DEFAULT_PORT = 7777
 # IP адрес по умолчанию для подключения клиента
 DEFAULT_IP_ADDRESS = '127.0.0.1'
 # Максимальная очередь подключений
-MAX_CONNECTIONS = 5
-# Максимальная длинна сообщения в байтах
-MAX_PACKAGE_LENGTH = 1024
+MAX_CONNECTIONS = 1024
+# Таймаут ожидания событий в основном цикле сервера, сек.
+# Используется только для проверки флага остановки сервера.
+SERVER_SELECT_TIMEOUT = 0.5
+# Размер очереди отправки клиента в байтах, при превышении которого
+# сервер перестаёт читать запросы этого клиента, пока очередь не уменьшится.
+OUTBOUND_HIGH_WATER = 256 * 1024
+# Предельный размер очереди отправки клиента в байтах,
+# при превышении соединение с клиентом разрывается.
+OUTBOUND_LIMIT = 4 * 1024 * 1024
+# Время, за которое новое подключение должно пройти авторизацию, сек.
+AUTH_TIMEOUT = 10
+# Время хранения сообщений для отключённых пользователей, сек.
+OFFLINE_MESSAGE_TTL = 7 * 24 * 60 * 60
+# Число сообщений, доставляемых из очереди за один запрос к базе
+OFFLINE_BATCH_SIZE = 100
+# Период очистки очереди от просроченных сообщений, сек.
+OFFLINE_CLEANUP_INTERVAL = 60
+# Число просроченных сообщений, удаляемых из базы одной транзакцией
+OFFLINE_EXPIRE_CHUNK = 500
+# Счётчики сообщений копятся в памяти и записываются в базу
+# не реже чем раз в STATS_FLUSH_INTERVAL сек. или каждые STATS_FLUSH_COUNT сообщений
+STATS_FLUSH_INTERVAL = 5
+STATS_FLUSH_COUNT = 1000
+# Записи истории входов старше HISTORY_RETENTION дней сворачиваются
+# в суточные итоги (0 - хранить без ограничения). Свёртка запускается
+# раз в HISTORY_COMPACT_INTERVAL сек. и обрабатывает записи пачками по HISTORY_COMPACT_CHUNK
+HISTORY_RETENTION = 30
+HISTORY_COMPACT_INTERVAL = 60
+HISTORY_COMPACT_CHUNK = 500
+# Архив пересылаемых сообщений: off - не вести, meta - отправитель, получатель,
+# время, размер и хэш текста, text - ещё и сам текст (для развёртываний без шифрования)
+ARCHIVE_MODE = 'off'
+# Число записей архива на странице результатов поиска
+ARCHIVE_PAGE_SIZE = 100
+# Число строк статистики пользователей, загружаемых окном за один запрос
+STAT_PAGE_SIZE = 200
+# Хранилище данных сервера: sqlite - база в файле, memory - в памяти без сохранения,
+# segments - база в файле, а очередь сообщений в журнале сегментов рядом с ней
+DEFAULT_STORAGE = 'sqlite'
+# Время ожидания завершения процесса-обработчика многопроцессного сервера, сек.
+WORKER_STOP_TIMEOUT = 5
+# Размер файла сегмента журнала сообщений в байтах
+SEGMENT_SIZE = 16 * 1024 * 1024
+# Срок действия токена возобновления сессии, сек. (0 - токены не выдаются)
+SESSION_TOKEN_TTL = 300
+# Предельный срок сессии от входа по паролю, сек.: продление токена его не сдвигает
+SESSION_MAX_AGE = 12 * 60 * 60
+# Период продления токена сессии клиентом, сек. Должен быть меньше срока действия токена
+SESSION_REFRESH_INTERVAL = 120
+# Допустимое расхождение времени сообщения о присутствии со временем сервера
+# при входе по токену, сек. Использованные случайные строки хранятся вдвое дольше.
+SESSION_PROOF_WINDOW = 60
+# Время ожидания клиентом ответа сервера на запрос, сек.
+REPLY_TIMEOUT = 5
+# Время, за которое должен быть принят начатый кадр, сек.
+FRAME_TIMEOUT = 30
+# Переподключение клиента после разрыва: число попыток и границы
+# случайной задержки перед попыткой, которая удваивается с каждой попыткой, сек.
+RECONNECT_ATTEMPTS = 12
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+# Число записей пользователей в кэше базы данных сервера
+USER_CACHE_SIZE = 4096
+# Время ожидания освобождения базы данных сервера другим соединением, сек.
+DB_BUSY_TIMEOUT = 15
+# Поток записи в базу фиксирует изменения пачками: пачка собирается
+# не дольше WRITE_BATCH_WINDOW сек. и не больше WRITE_BATCH_SIZE изменений
+WRITE_BATCH_WINDOW = 0.005
+WRITE_BATCH_SIZE = 500
+# Размер блока чтения из сокета в байтах
+MAX_PACKAGE_LENGTH = 65536
+# Максимальная длинна одного сообщения (тела кадра) в байтах
+MAX_MESSAGE_SIZE = 1024 * 1024
 # Кодировка проекта
 ENCODING = 'utf-8'
 # Текущий уровень логирования
@@ -25,6 +96,16 @@ FROM = 'from'
 TO = 'to'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+# Отпечаток публичного ключа, передаётся при входе вместо ключа целиком
+PUBLIC_KEY_HASH = 'pubkey_hash'
+# Необязательный номер запроса клиента для сопоставления с ответом сервера
+REQUEST_ID = 'id'
+# Токен возобновления сессии: в ответе 200 на авторизацию; в сообщении о присутствии
+# передаётся только идентификатор токена вместе со случайной строкой клиента и
+# HMAC ключом сессии от неё и времени сообщения
+SESSION_TOKEN = 'token'
+TOKEN_NONCE = 'nonce'
+TOKEN_PROOF = 'proof'
 
 # Прочие ключи, используемые в протоколе
 PRESENCE = 'presence'
@@ -39,3 +120,4 @@ REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
+SESSION_REFRESH = 'refresh_session'
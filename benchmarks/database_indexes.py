@@ -0,0 +1,106 @@
+"""
+Бенчмарк запросов базы данных сервера на большом объёме данных.
+
+Создаёт временную базу через ServerRepository (со всеми миграциями),
+заполняет её пользователями, контактами и историей входов, и измеряет
+время основных запросов сначала с индексами, затем без индексов,
+добавленных миграцией схемы.
+
+Пример запуска:
+
+``python benchmarks/database_indexes.py -u 100000 -r 10000000``
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from server.database import ServerRepository
+
+# Индексы, добавляемые миграцией схемы
+MIGRATION_INDEXES = ('ix_contacts_user_contact', 'ix_contacts_contact', 'ix_history_user_name', 'ix_history_user')
+
+# Размер пачки строк при заполнении базы
+CHUNK = 100000
+
+
+def fill_database(path, users, history_rows, contacts_per_user):
+    """Заполняет базу напрямую через sqlite3, минуя ORM."""
+    connection = sqlite3.connect(path)
+    now = datetime.datetime.now()
+    connection.executemany(
+        'INSERT INTO users (id, name, last_login, passwd_hash) VALUES (?, ?, ?, ?)',
+        ((i, f'user_{i}', now, 'hash') for i in range(1, users + 1)))
+    connection.executemany(
+        'INSERT INTO History (user, sent, accepted) VALUES (?, 0, 0)',
+        ((i,) for i in range(1, users + 1)))
+    connection.executemany(
+        'INSERT OR IGNORE INTO Contacts (user, contact) VALUES (?, ?)',
+        ((i, random.randint(1, users)) for i in range(1, users + 1) for _ in range(contacts_per_user)))
+    for start in range(0, history_rows, CHUNK):
+        connection.executemany(
+            'INSERT INTO history_user (name, date, ip_address, port) VALUES (?, ?, ?, ?)',
+            ((random.randint(1, users), now, '127.0.0.1', 7777)
+             for _ in range(min(CHUNK, history_rows - start))))
+        connection.commit()
+    connection.commit()
+    connection.close()
+
+
+def measure(database, users, rounds):
+    """Время запросов, мс: словарь название -> медиана."""
+    names = [f'user_{random.randint(1, users)}' for _ in range(rounds)]
+    queries = {
+        'пользователь по имени': lambda name: database.load_user_record(name),
+        'список контактов': lambda name: database.get_contacts(name),
+        'добавление контакта': lambda name: (database.add_contact(name, 'user_1'), database.sync()),
+        'история входов': lambda name: database.user_history(name),
+        'запись статистики': lambda name: (database.process_message(name, 'user_1'), database.flush()),
+    }
+    result = {}
+    for title, query in queries.items():
+        times = []
+        for name in names:
+            start = time.perf_counter()
+            query(name)
+            times.append((time.perf_counter() - start) * 1000)
+        result[title] = statistics.median(times)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', default=100000, type=int, help='число пользователей')
+    parser.add_argument('-r', default=10000000, type=int, help='число записей истории входов')
+    parser.add_argument('-c', default=10, type=int, help='число контактов у пользователя')
+    parser.add_argument('--rounds', default=50, type=int, help='число замеров каждого запроса')
+    namespace = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db3')
+    database = ServerRepository(path)
+    start = time.perf_counter()
+    fill_database(path, namespace.u, namespace.r, namespace.c)
+    print(f'База заполнена за {time.perf_counter() - start:.1f} с: пользователей {namespace.u}, '
+          f'записей истории {namespace.r}')
+
+    with_indexes = measure(database, namespace.u, namespace.rounds)
+    for index in MIGRATION_INDEXES:
+        database.session.execute(f'DROP INDEX {index}')
+    database.session.commit()
+    without_indexes = measure(database, namespace.u, namespace.rounds)
+
+    print(f'{"запрос":<24}{"без индексов, мс":>18}{"с индексами, мс":>18}')
+    for title in with_indexes:
+        print(f'{title:<24}{without_indexes[title]:>18.3f}{with_indexes[title]:>18.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Бенчмарк основного цикла сервера на большом числе простаивающих соединений.
+
+Запускает MessageProcessor во временной базе, открывает заданное число
+соединений, которые ничего не отправляют, и измеряет:
+
+* процессорное время, потраченное процессом за период простоя;
+* задержку ответа сервера на presence-сообщение незарегистрированного
+  пользователя (ответ 400) при всех открытых соединениях.
+
+Пример запуска:
+
+``python benchmarks/idle_connections.py -n 10000``
+"""
+
+import argparse
+import logging
+import os
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from base.utils import sending_message, getting_message
+from base.variables import *
+from server.center import MessageProcessor
+from server.database import ServerRepository
+
+
+def raise_files_limit(connections):
+    """Поднимает лимит открытых файлов: на каждое соединение нужно 2 дескриптора."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = connections * 2 + 100
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def start_server(port):
+    """Запускает поток сервера на временной базе данных."""
+    database = ServerRepository(os.path.join(tempfile.mkdtemp(), 'bench.db3'))
+    # Простаивающие соединения не авторизуются, отключаем для них таймаут.
+    server = MessageProcessor('127.0.0.1', port, database, auth_timeout=3600)
+    server.daemon = True
+    server.start()
+    time.sleep(0.5)
+    return server
+
+
+def open_idle_connections(port, count):
+    """Открывает count соединений, которые ничего не отправляют."""
+    connections = []
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        connections.append(sock)
+    return connections
+
+
+def measure_latency(port, rounds):
+    """Задержка ответа на presence незарегистрированного пользователя, мс."""
+    result = []
+    for i in range(rounds):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.settimeout(5)
+        presence = {ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: f'bench_{i}'}}
+        start = time.perf_counter()
+        sending_message(sock, presence)
+        getting_message(sock)
+        result.append((time.perf_counter() - start) * 1000)
+        sock.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', default=10000, type=int, help='число простаивающих соединений')
+    parser.add_argument('-p', default=7790, type=int, help='порт сервера')
+    parser.add_argument('--idle', default=5.0, type=float, help='длительность простоя, сек.')
+    parser.add_argument('--rounds', default=200, type=int, help='число замеров задержки')
+    namespace = parser.parse_args()
+
+    # Логирование каждого подключения исказит результаты.
+    logging.getLogger('server').setLevel(logging.WARNING)
+
+    limit = raise_files_limit(namespace.n)
+    count = min(namespace.n, (limit - 100) // 2)
+    if count < namespace.n:
+        print(f'Лимит дескрипторов {limit}, число соединений уменьшено до {count}.')
+
+    start_server(namespace.p)
+    connections = open_idle_connections(namespace.p, count)
+    print(f'Открыто соединений: {len(connections)}')
+
+    cpu_start = time.process_time()
+    time.sleep(namespace.idle)
+    cpu_idle = time.process_time() - cpu_start
+    print(f'CPU за {namespace.idle} с простоя: {cpu_idle * 1000:.1f} мс '
+          f'({cpu_idle / namespace.idle * 100:.2f}% ядра)')
+
+    latency = measure_latency(namespace.p, namespace.rounds)
+    print(f'Задержка ответа, мс: медиана {statistics.median(latency):.3f}, '
+          f'p99 {sorted(latency)[int(len(latency) * 0.99) - 1]:.3f}, '
+          f'максимум {max(latency):.3f}')
+
+    for sock in connections:
+        sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Бенчмарк записи в базу данных сервера при массовом входе пользователей.
+
+Регистрирует пользователей во временной базе, затем выполняет для
+каждого вход и выход, и измеряет, сколько пар вход-выход в секунду
+записывается в базу. Сравниваются фиксация каждого изменения отдельной
+транзакцией (пачка из одного изменения) и групповая фиксация потоком записи.
+Каждый вариант запускается в отдельном процессе.
+
+Пример запуска:
+
+``python benchmarks/login_storm.py -n 5000``
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from base.variables import WRITE_BATCH_WINDOW, WRITE_BATCH_SIZE
+from server.database import ServerRepository
+
+
+def login_storm(count, window, batch, result):
+    """Выполняет count пар вход-выход, кладёт в result число пар в секунду."""
+    logging.getLogger('server').setLevel(logging.WARNING)
+    database = ServerRepository(os.path.join(tempfile.mkdtemp(), 'bench.db3'), window, batch)
+    for i in range(count):
+        database.writer.submit(database.write_add_user, f'user_{i}', 'hash')
+    database.sync()
+
+    start = time.perf_counter()
+    for i in range(count):
+        database.user_login(f'user_{i}', '127.0.0.1', i, 'key')
+        database.user_logout(f'user_{i}')
+    database.sync()
+    result.put(count / (time.perf_counter() - start))
+
+
+def run(count, window, batch):
+    """Запуск варианта в отдельном процессе."""
+    result = multiprocessing.Queue()
+    process = multiprocessing.Process(target=login_storm, args=(count, window, batch, result))
+    process.start()
+    rate = result.get()
+    process.join()
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', default=5000, type=int, help='число пользователей')
+    namespace = parser.parse_args()
+
+    single = run(namespace.n, 0, 1)
+    print(f'Транзакция на изменение: {single:.0f} входов в секунду')
+    grouped = run(namespace.n, WRITE_BATCH_WINDOW, WRITE_BATCH_SIZE)
+    print(f'Групповая фиксация:      {grouped:.0f} входов в секунду (x{grouped / single:.1f})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Бенчмарк очереди сообщений для отключённых пользователей.
+
+Сохраняет сообщения для нескольких получателей и затем доставляет их
+пачками, как при входе получателя, и измеряет число сообщений в секунду
+для записи и для доставки. Сравниваются очередь в таблице SQLite
+(ServerRepository) и журнал сегментов (SegmentRepository).
+Каждый вариант запускается в отдельном процессе.
+
+Пример запуска:
+
+``python benchmarks/message_log.py -n 20000 -s 256``
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from base.variables import OFFLINE_BATCH_SIZE
+from server.repository import make_repository
+
+# Число получателей
+RECIPIENTS = 100
+
+
+def message_queue(storage, count, size, result):
+    """Сохраняет и доставляет count сообщений, кладёт в result скорости записи и доставки."""
+    logging.getLogger('server').setLevel(logging.WARNING)
+    database = make_repository(storage, os.path.join(tempfile.mkdtemp(), 'bench.db3'))
+    names = [f'user_{i}' for i in range(RECIPIENTS)]
+    for name in names:
+        database.add_user(name, 'hash')
+    message = {'action': 'message', 'from': 'user_0', 'time': 1.0, 'message': 'x' * size}
+
+    start = time.perf_counter()
+    for i in range(count):
+        database.store_message(names[i % RECIPIENTS], dict(message, to=names[i % RECIPIENTS]))
+    database.sync()
+    store = count / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    delivered = 0
+    for name in names:
+        while True:
+            frames = database.pop_offline_frames(name, OFFLINE_BATCH_SIZE)
+            delivered += len(frames)
+            if len(frames) < OFFLINE_BATCH_SIZE:
+                break
+    database.sync()
+    assert delivered == count
+    result.put((store, count / (time.perf_counter() - start)))
+
+
+def run(storage, count, size):
+    """Запуск варианта в отдельном процессе."""
+    result = multiprocessing.Queue()
+    process = multiprocessing.Process(target=message_queue, args=(storage, count, size, result))
+    process.start()
+    rates = result.get()
+    process.join()
+    return rates
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', default=20000, type=int, help='число сообщений')
+    parser.add_argument('-s', default=256, type=int, help='размер текста сообщения')
+    namespace = parser.parse_args()
+
+    sqlite_store, sqlite_pop = run('sqlite', namespace.n, namespace.s)
+    log_store, log_pop = run('segments', namespace.n, namespace.s)
+    print(f'{"хранилище":<20}{"запись, сообщ./с":>20}{"доставка, сообщ./с":>22}')
+    print(f'{"SQLite":<20}{sqlite_store:>20.0f}{sqlite_pop:>22.0f}')
+    print(f'{"журнал сегментов":<20}{log_store:>20.0f}{log_pop:>22.0f}')
+    print(f'{"ускорение":<20}{log_store / sqlite_store:>19.1f}x{log_pop / sqlite_pop:>21.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Бенчмарк стоимости обработки одного сообщения в зависимости от числа
+авторизованных пользователей.
+
+Создаёт MessageProcessor на временной базе, заполняет индекс сессий
+заданным числом пользователей и измеряет время вызова обработчика
+process_client_message на сообщении, не требующем обращений к базе:
+проверка авторизации, разбор и постановка ответа в очередь отправки.
+
+Пример запуска:
+
+``python benchmarks/session_index.py -n 10 100 1000 10000``
+"""
+
+import argparse
+import logging
+import os
+import selectors
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from base.variables import *
+from server.center import MessageProcessor
+from server.connection import ClientConnection
+from server.database import ServerRepository
+
+
+def fill_sessions(server, count):
+    """Добавляет в индекс сессий count авторизованных пользователей без сокетов."""
+    for i in range(len(server.names), count):
+        client = ClientConnection(None, ('127.0.0.1', i))
+        client.name = f'user_{i}'
+        server.names[client.name] = client
+
+
+def measure(server, client, rounds):
+    """Время обработки одного сообщения, мкс."""
+    message = {ACTION: 'bench', TIME: time.time(), USER: client.name}
+    result = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        server.process_client_message(message, client)
+        result.append((time.perf_counter() - start) * 1000000)
+        client.out_buffer.clear()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', default=[10, 100, 1000, 10000], type=int, nargs='+',
+                        help='число авторизованных пользователей')
+    parser.add_argument('--rounds', default=20000, type=int, help='число замеров на каждое значение')
+    namespace = parser.parse_args()
+
+    # Логирование каждого сообщения исказит результаты.
+    logging.getLogger('server').setLevel(logging.WARNING)
+
+    database = ServerRepository(os.path.join(tempfile.mkdtemp(), 'bench.db3'))
+    server = MessageProcessor('127.0.0.1', DEFAULT_PORT, database)
+
+    # Измеряемый клиент - единственный с настоящим сокетом в селекторе.
+    sock, peer = socket.socketpair()
+    client = ClientConnection(sock, ('127.0.0.1', 0))
+    client.name = 'bench'
+    server.clients.add(client)
+    server.names[client.name] = client
+    server.selector.register(sock, selectors.EVENT_READ, client)
+
+    for count in sorted(namespace.n):
+        fill_sessions(server, count)
+        latency = measure(server, client, namespace.rounds)
+        print(f'Пользователей {len(server.names):>6}: медиана {statistics.median(latency):.2f} мкс, '
+              f'p99 {sorted(latency)[int(len(latency) * 0.99) - 1]:.2f} мкс')
+
+    sock.close()
+    peer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -28,6 +28,8 @@ class ClientMainWindow(QMainWindow):
         # основные переменные
         self.database = database
         self.transport = transport
+        # Сообщения, ожидающие ответа сервера: зашифрованный текст -> исходный
+        self.sent_messages = dict()
 
         # объект - дешифорвщик сообщений с предзагруженным ключём
         self.decrypter = PKCS1_OAEP.new(keys)
@@ -184,9 +186,10 @@ class ClientMainWindow(QMainWindow):
             self.transport.add_contact(new_contact)
         except OSError as err:
             if err.errno:
-                self.messages.critical(self, 'Ошибка', 'Потеряно соединение с сервером!')
-                self.close()
-            self.messages.critical(self, 'Ошибка', 'Таймаут соединения!')
+                # Транспорт переподключается сам, окно не закрываем
+                self.messages.warning(self, 'Ошибка', 'Нет соединения с сервером, повторите попытку позже.')
+            else:
+                self.messages.critical(self, 'Ошибка', 'Таймаут соединения!')
         else:
             self.database.add_contact(new_contact)
             new_contact = QStandardItem(new_contact)
@@ -210,9 +213,10 @@ class ClientMainWindow(QMainWindow):
             self.transport.remove_contact(selected)
         except OSError as err:
             if err.errno:
-                self.messages.critical(self, 'Ошибка', 'Потеряно соединение с сервером!')
-                self.close()
-            self.messages.critical(self, 'Ошибка', 'Таймаут соединения!')
+                # Транспорт переподключается сам, окно не закрываем
+                self.messages.warning(self, 'Ошибка', 'Нет соединения с сервером, повторите попытку позже.')
+            else:
+                self.messages.critical(self, 'Ошибка', 'Таймаут соединения!')
         else:
             self.database.del_contact(selected)
             self.clients_list_update()
@@ -235,11 +239,13 @@ class ClientMainWindow(QMainWindow):
         message_text_encrypted = self.encryptor.encrypt(
             message_text.encode('utf8'))
         message_text_encrypted_base64 = base64.b64encode(
-            message_text_encrypted)
+            message_text_encrypted).decode('ascii')
+        # Сообщение сохраняется в истории, когда сервер его примет
+        self.sent_messages[message_text_encrypted_base64] = message_text
         try:
-            self.transport.send_message(self.current_chat, message_text_encrypted_base64.decode('ascii'))
-            pass
+            self.transport.send_message(self.current_chat, message_text_encrypted_base64)
         except OSError as err:
+            self.sent_messages.pop(message_text_encrypted_base64, None)
             if err.errno:
                 self.messages.critical(self, 'Ошибка', 'Потеряно соединение с сервером!')
                 self.close()
@@ -247,11 +253,27 @@ class ClientMainWindow(QMainWindow):
         except (ConnectionResetError, ConnectionAbortedError):
             self.messages.critical(self, 'Ошибка', 'Потеряно соединение с сервером!')
             self.close()
-        else:
-            self.database.save_message(self.current_chat, 'out', message_text)
-            CLIENT_LOGGER.debug(f'Отправлено сообщение для {self.current_chat}: {message_text}')
+
+    # Слот сообщения, принятого сервером
+    @pyqtSlot(str, str)
+    def message_sent(self, to, message):
+        message_text = self.sent_messages.pop(message, None)
+        if message_text is None:
+            return
+        self.database.save_message(to, 'out', message_text)
+        CLIENT_LOGGER.debug(f'Отправлено сообщение для {to}: {message_text}')
+        if to == self.current_chat:
             self.history_list_update()
 
+    # Слот сообщения, отклонённого сервером
+    @pyqtSlot(str, str, str)
+    def message_rejected(self, to, message, error):
+        message_text = self.sent_messages.pop(message, None)
+        self.messages.warning(self, 'Ошибка', f'Сообщение для {to} не доставлено: {error}')
+        # Возвращаем текст в поле ввода, чтобы его можно было отправить снова
+        if message_text and to == self.current_chat and not self.ui.text_message.toPlainText():
+            self.ui.text_message.setPlainText(message_text)
+
     # Слот приёма нового сообщений
     @pyqtSlot(str)
     def message(self, message):
@@ -319,3 +341,5 @@ class ClientMainWindow(QMainWindow):
         trans_obj.new_message.connect(self.message)
         trans_obj.connection_lost.connect(self.connection_lost)
         trans_obj.message_205.connect(self.sig_205)
+        trans_obj.message_sent.connect(self.message_sent)
+        trans_obj.message_rejected.connect(self.message_rejected)
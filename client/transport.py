@@ -1,30 +1,50 @@
 import binascii
+import errno
 import hashlib
 import hmac
+import itertools
+import os
+import queue
+import random
 import socket
 import time
 import logging
 import json
 import threading
+from collections import deque
+from concurrent.futures import Future, wait
+from functools import partial
 from PyQt5.QtCore import pyqtSignal, QObject
 
 from base.utils import *
 from base.variables import *
 
-# Логер и объект блокировки для работы с сокетом
+# Логер
 CLIENT_LOGGER = logging.getLogger('client')
-socket_lock = threading.Lock()
 
 
 class ClientTransport(threading.Thread, QObject):
     """
     Класс реализующий транспортную подсистему клиентского
     модуля. Отвечает за взаимодействие с сервером.
+    Сокет читает отдельный поток приёма: ответы на запросы передаются
+    в ожидающие их Future, а сообщения, присланные сервером по своей
+    инициативе (сообщения пользователей, 205), - в очередь, которую
+    разбирает основной поток транспорта (run). Отправка не ждёт приёма.
+    При потере соединения поток приёма переподключается с нарастающей
+    случайной задержкой и повторно авторизуется. Сообщения пользователям,
+    отправленные без соединения, отправляются после переподключения один
+    раз. Запросы, оставшиеся без ответа при разрыве, и остальные запросы
+    без соединения завершаются ошибкой.
     """
     # Сигналы новое сообщение и потеря соединения
     new_message = pyqtSignal(dict)
     message_205 = pyqtSignal()
     connection_lost = pyqtSignal()
+    # Сигналы ответа сервера на отправленное сообщение: получатель и
+    # текст сообщения, при отказе - ещё и текст ошибки
+    message_sent = pyqtSignal(str, str)
+    message_rejected = pyqtSignal(str, str, str)
 
     def __init__(self, port, ip_address, database, username, passwd, keys):
         # Вызываем конструктор предка
@@ -41,12 +61,38 @@ class ClientTransport(threading.Thread, QObject):
         self.transport = None
         # Набор ключей для шифрования
         self.keys = keys
+        # Адрес сервера, хэш пароля, публичный ключ и его отпечаток - для переподключений
+        self.server_address = (ip_address, port)
+        self.passwd_hash = None
+        self.pubkey = None
+        self.pubkey_hash = None
+        # Токен возобновления сессии, выданный сервером, и срок его продления
+        self.session_token = None
+        self.session_refresh_at = 0
+        # Блокировка отправки в сокет
+        self.send_lock = threading.Lock()
+        # Признак авторизованного соединения, меняется под send_lock
+        self.connected = False
+        # Запросы, ожидающие ответа: номер запроса -> Future ответа, в порядке отправки
+        self.pending = dict()
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        # Сообщения сервера, присланные по его инициативе, для разбора в run
+        self.pushes = queue.Queue()
+        # Запросы, не отправленные из-за разрыва, для отправки
+        # после переподключения: (номер, сообщение, Future)
+        self.outbox = deque()
+        # Поток приёма сообщений от сервера
+        self.reader = None
+        # Флаг продолжения работы транспорта и событие остановки,
+        # прерывающее ожидание перед переподключением.
+        self.running = True
+        self.stopped = threading.Event()
         # Устанавливаем соединение:
         self.connection_init(port, ip_address)
         # Обновляем таблицы известных пользователей и контактов
         try:
-            self.user_list_update()
-            self.contacts_list_update()
+            self.lists_update()
         except OSError as err:
             if err.errno:
                 CLIENT_LOGGER.critical(f'Потеряно соединение с сервером.')
@@ -55,25 +101,16 @@ class ClientTransport(threading.Thread, QObject):
         except json.JSONDecodeError:
             CLIENT_LOGGER.critical(f'Потеряно соединение с сервером.')
             raise Exception('Потеряно соединение с сервером!')
-            # Флаг продолжения работы транспорта.
-        self.running = True
 
     # Функция инициализации соединения с сервером
-    # noinspection PyDictCreation
     def connection_init(self, port, ip):
-        # Инициализация сокета и сообщение серверу о нашем появлении
-        self.transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # Таймаут необходим для освобождения сокета.
-        self.transport.settimeout(5)
-
         # Соединяемся, 5 попыток соединения, флаг успеха ставим в True если удалось
         connected = False
         for i in range(5):
             CLIENT_LOGGER.info(f'Попытка подключения № {i + 1}')
             try:
-                self.transport.connect((ip, port))
-            except (OSError, ConnectionRefusedError):
+                self.connect()
+            except OSError:
                 pass
             else:
                 connected = True
@@ -92,47 +129,90 @@ class ClientTransport(threading.Thread, QObject):
         passwd_bytes = self.password.encode('utf-8')
         salt = self.username.lower().encode('utf-8')
         passwd_hash = hashlib.pbkdf2_hmac('sha512', passwd_bytes, salt, 10000)
-        passwd_hash_string = binascii.hexlify(passwd_hash)
+        self.passwd_hash = binascii.hexlify(passwd_hash)
 
-        CLIENT_LOGGER.debug(f'Passwd hash ready: {passwd_hash_string}')
+        CLIENT_LOGGER.debug(f'Passwd hash ready: {self.passwd_hash}')
 
         # Получаем публичный ключ и декодируем его из байтов
-        pubkey = self.keys.publickey().export_key().decode('ascii')
+        self.pubkey = self.keys.publickey().export_key().decode('ascii')
+        self.pubkey_hash = key_fingerprint(self.pubkey)
 
-        # Авторизизация на сервере
-        with socket_lock:
-            presense = {
-                ACTION: PRESENCE,
-                TIME: time.time(),
-                USER: {
-                    ACCOUNT_NAME: self.username,
-                    PUBLIC_KEY: pubkey
-                }
+        self.authorize()
+        self.connected = True
+
+        # Дальше сокет читает поток приёма
+        self.reader = threading.Thread(target=self.read_messages, daemon=True)
+        self.reader.start()
+
+    def connect(self):
+        """Метод создания сокета и подключения к серверу."""
+        self.transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Таймаут необходим для освобождения сокета.
+        self.transport.settimeout(5)
+        try:
+            self.transport.connect(self.server_address)
+        except OSError:
+            self.transport.close()
+            raise
+
+    # noinspection PyDictCreation
+    def authorize(self):
+        """
+        Метод авторизации на сервере. Поток приёма в это время
+        не читает сокет, ответы читаются здесь же. Если есть токен
+        сессии, в сообщении о присутствии передаются его идентификатор,
+        случайная строка и HMAC ключом сессии от неё и времени сообщения:
+        сервер сразу отвечает 200. Если токен не подошёл, сервер
+        присылает обычный запрос пароля.
+        Вместо публичного ключа передаётся его отпечаток, сам ключ
+        отправляется в ответе на запрос 511, только если сервер его запросил.
+        """
+        presense = {
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {
+                ACCOUNT_NAME: self.username,
+                PUBLIC_KEY_HASH: self.pubkey_hash
             }
-            CLIENT_LOGGER.debug(f"Presense message = {presense}")
-            # Отправляем серверу приветственное сообщение.
-            try:
-                sending_message(self.transport, presense)
-                ans = getting_message(self.transport)
-                CLIENT_LOGGER.debug(f'Ответ сервера = {ans}.')
-                # Если сервер вернул ошибку, бросаем исключение.
-                if RESPONSE in ans:
-                    if ans[RESPONSE] == 400:
-                        raise Exception(ans[ERROR])
-                    elif ans[RESPONSE] == 511:
-                        # Если всё нормально, то продолжаем процедуру
-                        # авторизации.
-                        ans_data = ans[DATA]
-                        hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'), 'MD5')
-                        digest = hash.digest()
-                        my_ans = {RESPONSE: 511, DATA: None}
-                        my_ans[DATA] = binascii.b2a_base64(
-                            digest).decode('ascii')
-                        sending_message(self.transport, my_ans)
-                        self.process_server_ans(getting_message(self.transport))
-            except (OSError, json.JSONDecodeError) as err:
-                CLIENT_LOGGER.debug(f'Connection error.', exc_info=err)
-                raise Exception('Сбой соединения в процессе авторизации.')
+        }
+        if self.session_token:
+            token_id, session_key = self.session_token.split('.')
+            nonce = binascii.hexlify(os.urandom(16)).decode('ascii')
+            proof = hmac.new(session_key.encode('ascii'), f'{nonce}:{presense[TIME]!r}'.encode('ascii'), 'sha256')
+            presense[SESSION_TOKEN] = token_id
+            presense[TOKEN_NONCE] = nonce
+            presense[TOKEN_PROOF] = binascii.b2a_base64(proof.digest()).decode('ascii')
+        CLIENT_LOGGER.debug(f"Presense message = {presense}")
+        # Отправляем серверу приветственное сообщение.
+        try:
+            sending_message(self.transport, presense)
+            ans = getting_message(self.transport)
+            CLIENT_LOGGER.debug(f'Ответ сервера = {ans}.')
+            # Если сервер вернул ошибку, бросаем исключение.
+            if RESPONSE in ans:
+                if ans[RESPONSE] == 400:
+                    raise Exception(ans[ERROR])
+                # Если всё нормально, то продолжаем процедуру
+                # авторизации. Вход по токену отвечает сразу 200.
+                if ans[RESPONSE] == 511:
+                    ans_data = ans[DATA]
+                    hash = hmac.new(self.passwd_hash, ans_data.encode('utf-8'), 'MD5')
+                    digest = hash.digest()
+                    my_ans = {RESPONSE: 511, DATA: None}
+                    my_ans[DATA] = binascii.b2a_base64(
+                        digest).decode('ascii')
+                    # Сохранённый на сервере ключ отличается от нашего
+                    if ans.get(PUBLIC_KEY_REQUEST):
+                        my_ans[PUBLIC_KEY] = self.pubkey
+                    sending_message(self.transport, my_ans)
+                    ans = getting_message(self.transport)
+                self.process_server_ans(ans)
+                # Сохраняем новый токен сессии из ответа 200
+                self.session_token = ans.get(SESSION_TOKEN)
+                self.session_refresh_at = time.monotonic() + SESSION_REFRESH_INTERVAL
+        except (OSError, json.JSONDecodeError) as err:
+            CLIENT_LOGGER.debug(f'Connection error.', exc_info=err)
+            raise Exception('Сбой соединения в процессе авторизации.')
 
     # Функция обрабатывающяя сообщения от сервера. Ничего не возращает. Генерирует исключение при ошибке.
     def process_server_ans(self, message):
@@ -145,8 +225,7 @@ class ClientTransport(threading.Thread, QObject):
             elif message[RESPONSE] == 400:
                 raise Exception(f'{message[ERROR]}')
             elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_update()
+                self.lists_update()
                 self.message_205.emit()
             else:
                 CLIENT_LOGGER.debug(f'Принят неизвестный код подтверждения {message[RESPONSE]}')
@@ -162,19 +241,22 @@ class ClientTransport(threading.Thread, QObject):
 
     # Функция обновляющая контакт - лист с сервера
     def contacts_list_update(self):
-        self.database.contacts_clear()
-        CLIENT_LOGGER.debug(f'Запрос контакт листа для пользователся {self.name}')
+        CLIENT_LOGGER.debug(f'Запрос контакт листа для пользователся {self.username}')
+        self.contacts_received(self.wait_reply(self.contacts_request()))
+
+    def contacts_request(self):
         req = {
             ACTION: GET_CONTACTS,
             TIME: time.time(),
             USER: self.username
         }
         CLIENT_LOGGER.debug(f'Сформирован запрос {req}')
-        with socket_lock:
-            sending_message(self.transport, req)
-            ans = getting_message(self.transport)
+        return self.request(req)
+
+    def contacts_received(self, ans):
         CLIENT_LOGGER.debug(f'Получен ответ {ans}')
         if RESPONSE in ans and ans[RESPONSE] == 202:
+            self.database.contacts_clear()
             for contact in ans[LIST_INFO]:
                 self.database.add_contact(contact)
         else:
@@ -183,34 +265,57 @@ class ClientTransport(threading.Thread, QObject):
     # Функция обновления таблицы известных пользователей.
     def user_list_update(self):
         CLIENT_LOGGER.debug(f'Запрос списка известных пользователей {self.username}')
+        self.users_received(self.wait_reply(self.users_request()))
+
+    def users_request(self):
         req = {
             ACTION: USERS_REQUEST,
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with socket_lock:
-            sending_message(self.transport, req)
-            ans = getting_message(self.transport)
+        return self.request(req)
+
+    def users_received(self, ans):
         if RESPONSE in ans and ans[RESPONSE] == 202:
             self.database.add_users(ans[LIST_INFO])
         else:
             CLIENT_LOGGER.error('Не удалось обновить список известных пользователей.')
 
+    def lists_update(self):
+        """
+        Метод обновления списков известных пользователей и контактов.
+        Оба запроса отправляются сразу, ответы ожидаются вместе.
+        """
+        users, contacts = self.wait_replies([self.users_request(), self.contacts_request()])
+        self.users_received(users)
+        self.contacts_received(contacts)
+
     # Метод запрашивающий с сервера публичный ключ пользователя.
     def key_request(self, user):
-        CLIENT_LOGGER.debug(f'Запрос публичного ключа для {user}')
-        req = {
-            ACTION: PUBLIC_KEY_REQUEST,
-            TIME: time.time(),
-            ACCOUNT_NAME: user
-        }
-        with socket_lock:
-            sending_message(self.transport, req)
-            ans = getting_message(self.transport)
-        if RESPONSE in ans and ans[RESPONSE] == 511:
-            return ans[DATA]
-        else:
-            CLIENT_LOGGER.error(f'Не удалось получить ключ собеседника{user}.')
+        return self.key_requests([user])[user]
+
+    def key_requests(self, users):
+        """
+        Метод запроса публичных ключей нескольких пользователей.
+        Запросы отправляются все сразу, возвращает словарь
+        имя -> ключ (None, если ключ получить не удалось).
+        """
+        futures = []
+        for user in users:
+            CLIENT_LOGGER.debug(f'Запрос публичного ключа для {user}')
+            futures.append(self.request({
+                ACTION: PUBLIC_KEY_REQUEST,
+                TIME: time.time(),
+                ACCOUNT_NAME: user
+            }))
+        keys = dict()
+        for user, ans in zip(users, self.wait_replies(futures)):
+            if RESPONSE in ans and ans[RESPONSE] == 511:
+                keys[user] = ans[DATA]
+            else:
+                keys[user] = None
+                CLIENT_LOGGER.error(f'Не удалось получить ключ собеседника{user}.')
+        return keys
 
     # Функция сообщающая на сервер о добавлении нового контакта
     def add_contact(self, contact):
@@ -221,9 +326,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            sending_message(self.transport, req)
-            self.process_server_ans(getting_message(self.transport))
+        self.process_server_ans(self.wait_reply(self.request(req)))
 
     # Функция удаления клиента на сервере
     def remove_contact(self, contact):
@@ -234,28 +337,34 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            sending_message(self.transport, req)
-            self.process_server_ans(getting_message(self.transport))
+        self.process_server_ans(self.wait_reply(self.request(req)))
 
     # Функция закрытия соединения, отправляет сообщение о выходе.
     def transport_shutdown(self):
         self.running = False
+        self.stopped.set()
         message = {
             ACTION: QUIT,
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with socket_lock:
+        with self.send_lock:
             try:
                 sending_message(self.transport, message)
             except OSError:
                 pass
+        self.pushes.put(None)
         CLIENT_LOGGER.debug('Сокет завершает работу.')
         time.sleep(0.75)
 
     # Функция отправки сообщения на сервер
     def send_message(self, to, message):
+        """
+        Метод отправки сообщения пользователю. Ответ сервера не ожидается:
+        его проверит поток приёма, метод возвращает Future ответа.
+        Сообщение принято сервером, когда пришёл сигнал message_sent,
+        при отказе или потере соединения приходит сигнал message_rejected.
+        """
         message_dict = {
             ACTION: MSG,
             FROM: self.username,
@@ -264,38 +373,221 @@ class ClientTransport(threading.Thread, QObject):
             MESSAGE: message
         }
         CLIENT_LOGGER.debug(f'Сформирован словарь сообщения: {message_dict}')
+        # Без соединения сообщение отправится после переподключения
+        future = self.request(message_dict, replay=True)
+        future.add_done_callback(partial(self.message_answered, to, message))
+        CLIENT_LOGGER.info(f'Отправлено сообщение для пользователя {to}')
+        return future
 
-        # Необходимо дождаться освобождения сокета для отправки сообщения
-        with socket_lock:
-            sending_message(self.transport, message_dict)
-            self.process_server_ans(getting_message(self.transport))
-            CLIENT_LOGGER.info(f'Отправлено сообщение для пользователя {to}')
+    def message_answered(self, to, message, future):
+        """Метод проверки ответа сервера на отправленное сообщение."""
+        try:
+            ans = future.result()
+            if ans.get(RESPONSE) != 200:
+                raise Exception(ans.get(ERROR, f'Код ответа {ans.get(RESPONSE)}'))
+        except Exception as err:
+            CLIENT_LOGGER.error(f'Сообщение для пользователя {to} не принято сервером: {err}')
+            self.message_rejected.emit(to, message, str(err))
+        else:
+            self.message_sent.emit(to, message)
 
-    def run(self):
+    def request(self, message, replay=False):
+        """
+        Метод отправки запроса серверу. Возвращает Future, в который
+        поток приёма передаст ответ. Запрос получает номер REQUEST_ID,
+        ответ сопоставляется с запросом только по нему.
+        Запрос с replay=True, который не удалось отправить из-за разрыва,
+        откладывается до переподключения, остальные запросы без соединения
+        генерируют ConnectionResetError. Отправленные запросы, ответ на
+        которые не пришёл до разрыва, не повторяются: сервер мог их уже
+        выполнить, их Future завершаются ошибкой.
+        """
+        future = Future()
+        with self.send_lock:
+            if not self.running or not (self.connected or replay):
+                raise ConnectionResetError(errno.ECONNRESET, 'Нет соединения с сервером')
+            request_id = next(self.request_ids)
+            message[REQUEST_ID] = request_id
+            if self.connected:
+                try:
+                    self.send_request(request_id, message, future)
+                except OSError:
+                    if not replay:
+                        raise
+                    # Запрос не ушёл целиком, сервер его не выполнит
+                    self.outbox.append((request_id, message, future))
+            else:
+                self.outbox.append((request_id, message, future))
+        return future
+
+    def send_request(self, request_id, message, future):
+        """Метод отправки запроса в сокет, вызывается под send_lock."""
+        with self.pending_lock:
+            self.pending[request_id] = future
+        try:
+            sending_message(self.transport, message)
+        except OSError:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+            raise
+
+    @classmethod
+    def wait_reply(cls, future):
+        """Метод ожидания ответа на запрос не дольше REPLY_TIMEOUT сек."""
+        return cls.wait_replies([future])[0]
+
+    @staticmethod
+    def wait_replies(futures):
+        """
+        Метод ожидания ответов на несколько отправленных запросов.
+        Все ответы должны прийти за REPLY_TIMEOUT сек., возвращает их
+        в порядке запросов.
+        """
+        done, not_done = wait(futures, REPLY_TIMEOUT)
+        if not_done:
+            raise socket.timeout('Истекло время ожидания ответа сервера')
+        return [future.result() for future in futures]
+
+    def resolve(self, message):
+        """
+        Метод передачи ответа сервера в Future ожидающего его запроса.
+        Ответ без номера запроса отбрасывается: сопоставить его по порядку
+        нельзя, он мог бы завершить не тот запрос.
+        """
+        with self.pending_lock:
+            future = self.pending.pop(message.get(REQUEST_ID), None)
+        if future is None:
+            CLIENT_LOGGER.debug(f'Ответ сервера без ожидающего запроса: {message}')
+        else:
+            future.set_result(message)
+
+    def connection_broken(self):
+        """
+        Метод обработки разрыва соединения в потоке приёма. Запросы без
+        ответа завершаются ошибкой: сервер мог их выполнить, и повтор
+        после переподключения привёл бы к дублям сообщений.
+        """
+        try:
+            self.transport.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.transport.close()
+        with self.send_lock:
+            self.connected = False
+            with self.pending_lock:
+                pending, self.pending = self.pending, dict()
+        for future in pending.values():
+            future.set_exception(ConnectionResetError(errno.ECONNRESET, 'Потеряно соединение с сервером'))
+
+    def reconnect(self):
+        """
+        Метод переподключения к серверу. Перед каждой попыткой выжидает
+        случайное время от нуля до RECONNECT_DELAY * 2 ** номер попытки,
+        но не больше RECONNECT_MAX_DELAY, чтобы клиенты после перезапуска
+        сервера не подключались все одновременно. После авторизации
+        отправляет отложенные запросы. Возвращает True при успехе.
+        """
+        for attempt in range(RECONNECT_ATTEMPTS):
+            delay = random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** attempt))
+            if self.stopped.wait(delay):
+                return False
+            CLIENT_LOGGER.info(f'Попытка переподключения № {attempt + 1}')
+            try:
+                self.connect()
+            except OSError:
+                continue
+            try:
+                self.authorize()
+            except Exception as err:
+                CLIENT_LOGGER.debug(f'Не удалось авторизоваться: {err}')
+                self.transport.close()
+                continue
+            with self.send_lock:
+                while self.outbox:
+                    request = self.outbox.popleft()
+                    try:
+                        self.send_request(*request)
+                    except OSError:
+                        # Новый разрыв обнаружит поток приёма
+                        self.outbox.appendleft(request)
+                        break
+                self.connected = True
+            CLIENT_LOGGER.info('Соединение с сервером восстановлено.')
+            return True
+        return False
+
+    def read_messages(self):
+        """
+        Метод основной цикл потока приёма. Читает сокет без перерывов,
+        сообщения по инициативе сервера кладёт в очередь для run,
+        остальное - ответы на запросы. При разрыве соединения переподключается.
+        """
         CLIENT_LOGGER.debug('Запущен процесс - приёма сообщений от сервера.')
         while self.running:
-            # Отдыхаем секунду и снова пробуем захватить сокет.
-            # если не сделать тут задержку, то отправка может достаточно долго ждать освобождения сокета.
-            time.sleep(1)
-            message = None
-            with socket_lock:
-                try:
-                    self.transport.settimeout(0.75)
-                    message = getting_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        CLIENT_LOGGER.critical(f'Потеряно соединение с сервером.')
-                        self.running = False
-                        self.connection_lost.emit()
-                # Проблемы с соединением
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError, TypeError):
-                    CLIENT_LOGGER.debug(f'Потеряно соединение с сервером.')
+            try:
+                message = getting_message(self.transport)
+            except socket.timeout:
+                continue
+            # Проблемы с соединением
+            except (OSError, ValueError) as err:
+                if not self.running:
+                    break
+                CLIENT_LOGGER.error(f'Потеряно соединение с сервером.', exc_info=err)
+                self.connection_broken()
+                if self.reconnect():
+                    # Пока соединения не было, списки на сервере могли измениться
+                    self.pushes.put({RESPONSE: 205})
+                    continue
+                if self.running:
+                    CLIENT_LOGGER.critical(f'Не удалось восстановить соединение с сервером.')
                     self.running = False
+                    self.fail_outbox()
+                    self.pushes.put(None)
                     self.connection_lost.emit()
-                finally:
-                    self.transport.settimeout(5)
+                break
+            CLIENT_LOGGER.debug(f'Принято сообщение с сервера: {message}')
+            if ACTION in message or message.get(RESPONSE) == 205:
+                self.pushes.put(message)
+            else:
+                self.resolve(message)
 
-            # Если сообщение получено, то вызываем функцию обработчик:
-            if message:
-                CLIENT_LOGGER.debug(f'Принято сообщение с сервера: {message}')
+    def fail_outbox(self):
+        """Метод завершения ошибкой отложенных запросов, если соединение не восстановлено."""
+        with self.send_lock:
+            outbox, self.outbox = self.outbox, deque()
+        for request_id, message, future in outbox:
+            future.set_exception(ConnectionResetError(errno.ECONNRESET, 'Потеряно соединение с сервером'))
+
+    def refresh_session(self):
+        """
+        Метод продления токена сессии раз в SESSION_REFRESH_INTERVAL сек.,
+        чтобы при разрыве у клиента был действующий токен.
+        """
+        if not self.session_token or not self.connected or time.monotonic() < self.session_refresh_at:
+            return
+        self.session_refresh_at = time.monotonic() + SESSION_REFRESH_INTERVAL
+        try:
+            future = self.request({ACTION: SESSION_REFRESH, TIME: time.time()})
+        except OSError:
+            return
+        future.add_done_callback(self.session_refreshed)
+
+    def session_refreshed(self, future):
+        """Метод сохранения продлённого токена из ответа сервера."""
+        if future.exception() is None and future.result().get(RESPONSE) == 200:
+            self.session_token = future.result().get(SESSION_TOKEN)
+
+    def run(self):
+        CLIENT_LOGGER.debug('Запущен процесс - разбора сообщений от сервера.')
+        while True:
+            self.refresh_session()
+            try:
+                message = self.pushes.get(timeout=1)
+            except queue.Empty:
+                continue
+            if message is None:
+                break
+            try:
                 self.process_server_ans(message)
+            except OSError as err:
+                CLIENT_LOGGER.error(f'Не удалось обработать сообщение сервера {message}.', exc_info=err)
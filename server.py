@@ -12,7 +12,9 @@ from PyQt5.QtWidgets import QApplication
 from base.utils import *
 from base.variables import *
 from server.center import MessageProcessor
-from server.database import ServerRepository
+from server.async_center import AsyncMessageProcessor
+from server.workers import ShardedServer
+from server.repository import make_repository
 from server.main_window import MainWindow
 import log.config.server_log_config
 
@@ -38,7 +40,7 @@ SERVER_LOGGER = logging.getLogger('server')
 def argument_parser(default_port, default_address):
     """
     Парсер параметров коммандной строки,
-    чтение параметров, возвращает 2 параметров.
+    чтение параметров, возвращает 5 параметров.
     """
     SERVER_LOGGER.debug(
         f'Инициализация парсера аргументов коммандной строки: {sys.argv}')
@@ -46,12 +48,20 @@ def argument_parser(default_port, default_address):
     parser.add_argument('-p', default=default_port, type=int, nargs='?')
     parser.add_argument('-a', default=default_address, nargs='?')
     parser.add_argument('--no_gui', action='store_true')
+    parser.add_argument('--engine', default='thread', choices=('thread', 'asyncio'))
+    parser.add_argument('--workers', default=1, type=int)
     namespace = parser.parse_args(sys.argv[1:])
+    if namespace.workers < 1:
+        parser.error('число процессов должно быть не меньше 1')
+    if namespace.workers > 1 and namespace.engine != 'thread':
+        parser.error('многопроцессный режим поддерживается только движком thread')
     listen_port = namespace.p
     listen_address = namespace.a
     gui = namespace.no_gui
+    engine = namespace.engine
+    workers = namespace.workers
     SERVER_LOGGER.debug('Аргументы успешно загружены.')
-    return listen_address, listen_port, gui
+    return listen_address, listen_port, gui, engine, workers
 
 
 # Загрузка файла конфигурации
@@ -70,6 +80,15 @@ def config_load():
         config.set('SETTINGS', 'listen_address', '')
         config.set('SETTINGS', 'database_path', '')
         config.set('SETTINGS', 'database_file', 'server_database.db3')
+        config.set('SETTINGS', 'storage', DEFAULT_STORAGE)
+        config.set('SETTINGS', 'outbound_high_water', str(OUTBOUND_HIGH_WATER))
+        config.set('SETTINGS', 'outbound_limit', str(OUTBOUND_LIMIT))
+        config.set('SETTINGS', 'auth_timeout', str(AUTH_TIMEOUT))
+        config.set('SETTINGS', 'offline_ttl', str(OFFLINE_MESSAGE_TTL))
+        config.set('SETTINGS', 'history_retention', str(HISTORY_RETENTION))
+        config.set('SETTINGS', 'archive', ARCHIVE_MODE)
+        config.set('SETTINGS', 'session_ttl', str(SESSION_TOKEN_TTL))
+        config.set('SETTINGS', 'session_max_age', str(SESSION_MAX_AGE))
         return config
 
 
@@ -79,14 +98,42 @@ def main():
     config = config_load()
 
     # загрузка параметров командной строки, если нет параметров, то значения по умоланию.
-    listen_address, listen_port, gui = argument_parser(config['SETTINGS']['default_port'],
-                                                       config['SETTINGS']['listen_address'])
-
-    # объявление БД
-    database = ServerRepository(os.path.join(config['SETTINGS']['database_path'],
-                                             config['SETTINGS']['database_file']))
-
-    server = MessageProcessor(listen_address, listen_port, database)
+    listen_address, listen_port, gui, engine, workers = argument_parser(config['SETTINGS']['default_port'],
+                                                                        config['SETTINGS']['listen_address'])
+
+    database_path = os.path.join(config['SETTINGS']['database_path'],
+                                 config['SETTINGS']['database_file'])
+    storage = config['SETTINGS'].get('storage', fallback=DEFAULT_STORAGE)
+    outbound_high_water = config['SETTINGS'].getint('outbound_high_water', fallback=OUTBOUND_HIGH_WATER)
+    outbound_limit = config['SETTINGS'].getint('outbound_limit', fallback=OUTBOUND_LIMIT)
+    auth_timeout = config['SETTINGS'].getfloat('auth_timeout', fallback=AUTH_TIMEOUT)
+    offline_ttl = config['SETTINGS'].getint('offline_ttl', fallback=OFFLINE_MESSAGE_TTL)
+    history_retention = config['SETTINGS'].getint('history_retention', fallback=HISTORY_RETENTION)
+    archive = config['SETTINGS'].get('archive', fallback=ARCHIVE_MODE)
+    session_ttl = config['SETTINGS'].getint('session_ttl', fallback=SESSION_TOKEN_TTL)
+    session_max_age = config['SETTINGS'].getint('session_max_age', fallback=SESSION_MAX_AGE)
+
+    # В многопроцессном режиме базой владеет отдельный процесс,
+    # координатор запускает его сам и отдаёт прокси для графической оболочки.
+    if workers > 1:
+        server = ShardedServer(listen_address, listen_port, database_path, workers,
+                               outbound_high_water, outbound_limit, auth_timeout, offline_ttl,
+                               history_retention, archive, session_ttl, session_max_age, storage)
+        database = server.database
+    else:
+        # объявление БД
+        database = make_repository(storage, database_path)
+
+        # Выбор движка сервера: поток с селектором или цикл событий asyncio
+        if engine == 'asyncio':
+            engine_class = AsyncMessageProcessor
+        else:
+            engine_class = MessageProcessor
+
+        server = engine_class(listen_address, listen_port, database,
+                              outbound_high_water, outbound_limit, auth_timeout, offline_ttl,
+                              history_retention, archive, session_ttl,
+                              session_max_age=session_max_age)
     server.daemon = True
     server.start()
 
@@ -111,7 +158,9 @@ def main():
         server_app.exec_()
 
         # По закрытию окон останавливаем обработчик сообщений
+        # и ждём записи отложенных изменений базы
         server.running = False
+        server.join()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,99 @@
+from PyQt5.QtWidgets import QDialog, QPushButton, QLineEdit, QLabel, QTableView
+from PyQt5.QtGui import QStandardItemModel, QStandardItem
+from PyQt5.QtCore import Qt
+
+
+# noinspection PyTypeChecker
+class ArchiveWindow(QDialog):
+    """
+    Класс - окно поиска по архиву сообщений.
+    Результаты выводятся страницами, новые сообщения первыми.
+    """
+
+    def __init__(self, database):
+        super().__init__()
+        self.database = database
+        # id последней показанной записи - начало следующей страницы
+        self.last_id = None
+        self.initUI()
+
+    def initUI(self):
+        # Настройки окна:
+        self.setWindowTitle('Архив сообщений')
+        self.setFixedSize(800, 700)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+
+        # Поля фильтров
+        self.label_sender = QLabel('Отправитель:', self)
+        self.label_sender.move(10, 10)
+        self.label_sender.setFixedSize(150, 15)
+        self.sender_field = QLineEdit(self)
+        self.sender_field.setFixedSize(150, 20)
+        self.sender_field.move(10, 30)
+
+        self.label_recipient = QLabel('Получатель:', self)
+        self.label_recipient.move(170, 10)
+        self.label_recipient.setFixedSize(150, 15)
+        self.recipient_field = QLineEdit(self)
+        self.recipient_field.setFixedSize(150, 20)
+        self.recipient_field.move(170, 30)
+
+        self.label_query = QLabel('Текст сообщения:', self)
+        self.label_query.move(330, 10)
+        self.label_query.setFixedSize(290, 15)
+        self.query_field = QLineEdit(self)
+        self.query_field.setFixedSize(290, 20)
+        self.query_field.move(330, 30)
+
+        self.search_button = QPushButton('Найти', self)
+        self.search_button.move(630, 27)
+        self.search_button.clicked.connect(self.search)
+
+        # Таблица с найденными сообщениями
+        self.archive_table = QTableView(self)
+        self.archive_table.move(10, 60)
+        self.archive_table.setFixedSize(780, 580)
+
+        self.next_button = QPushButton('Следующая страница', self)
+        self.next_button.move(250, 655)
+        self.next_button.clicked.connect(self.next_page)
+
+        # Кнапка закрытия окна
+        self.close_button = QPushButton('Закрыть', self)
+        self.close_button.move(420, 655)
+        self.close_button.clicked.connect(self.close)
+
+        self.search()
+
+    def search(self):
+        """Метод поиска с первой страницы."""
+        self.last_id = None
+        self.next_page()
+
+    def next_page(self):
+        """Метод заполнения таблицы следующей страницей результатов поиска."""
+        page = self.database.archive_page(
+            sender=self.sender_field.text() or None,
+            recipient=self.recipient_field.text() or None,
+            query=self.query_field.text() or None,
+            before=self.last_id)
+        self.next_button.setEnabled(bool(page))
+        # Пустая страница после последней не затирает показанные результаты
+        if not page and self.last_id:
+            return
+        self.last_id = page[-1].id if page else None
+
+        # Объект модели данных:
+        list = QStandardItemModel()
+        list.setHorizontalHeaderLabels(
+            ['Время', 'Отправитель', 'Получатель', 'Размер', 'Хэш', 'Текст'])
+        for record in page:
+            row = [str(record.created.replace(microsecond=0)), record.sender, record.recipient,
+                   str(record.size), record.digest, record.text or '']
+            items = [QStandardItem(value) for value in row]
+            for item in items:
+                item.setEditable(False)
+            list.appendRow(items)
+        self.archive_table.setModel(list)
+        self.archive_table.resizeColumnsToContents()
+        self.archive_table.resizeRowsToContents()
@@ -0,0 +1,170 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from base.variables import *
+from server.center import MessageProcessor
+from server.connection import AsyncClientConnection
+import log.config.server_log_config
+
+# Загрузка логера
+SERVER_LOGGER = logging.getLogger('server')
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    """
+    Асинхронный вариант основного класса сервера на asyncio.
+    Каждое подключение обслуживается отдельной задачей, обработка
+    сообщений протокола JIM и обращения к базе данных выполняются
+    в отдельном потоке-исполнителе, чтобы не блокировать цикл событий.
+    Работает в качестве отдельного потока, как и MessageProcessor.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Цикл событий и сервер asyncio, создаются при запуске потока
+        self.loop = None
+        self.server = None
+
+        # Исполнитель обработчиков. Поток один: обработчики работают
+        # с общим состоянием сервера и одной сессией базы данных.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='jim')
+
+    def run(self):
+        """Метод основной цикл потока."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.executor.shutdown()
+            self.loop.close()
+            self.database.flush()
+
+    async def serve(self):
+        """Корутина запуска сервера, работает до сброса флага running."""
+        self.init_socket()
+        self.server = await asyncio.start_server(self.handle_client, sock=self.sock)
+        async with self.server:
+            while self.running:
+                await asyncio.sleep(SERVER_SELECT_TIMEOUT)
+                await self.loop.run_in_executor(self.executor, self.housekeeping_locked)
+                for client in list(self.clients):
+                    if client.offline_acks:
+                        await self.ack_written(client)
+
+        # Разрываем оставшиеся подключения и ждём завершения их задач.
+        for client in list(self.clients):
+            client.writer.transport.abort()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def handle_client(self, reader, writer):
+        """Корутина обслуживания одного подключения."""
+        client = AsyncClientConnection(reader, writer)
+        SERVER_LOGGER.info(f'Установлено соедение с ПК {client.address}')
+        # drain() ждёт, пока буфер транспорта не опустится ниже порога.
+        # Порог не выше половины предела: доставка ожидавших сообщений,
+        # ждущая drain(), не должна переполнять буфер.
+        writer.transport.set_write_buffer_limits(high=min(self.outbound_high_water, self.outbound_limit // 2))
+        with self.lock:
+            self.clients.add(client)
+            self.start_handshake(client)
+        try:
+            while client in self.clients and not client.closing:
+                data = await reader.read(MAX_PACKAGE_LENGTH)
+                if not data:
+                    break
+                messages = client.decoder.feed(data)
+                if messages:
+                    await self.loop.run_in_executor(self.executor, self.process_messages_locked, messages, client)
+                # Пока клиент не принимает ответы, не читаем его запросы.
+                await writer.drain()
+        except (OSError, ValueError) as err:
+            SERVER_LOGGER.debug(f'Getting data from client exception.', exc_info=err)
+        finally:
+            await self.loop.run_in_executor(self.executor, self.remove_client, client)
+
+    def process_messages_locked(self, messages, client):
+        """Метод обработки сообщений в потоке-исполнителе."""
+        with self.lock:
+            self.process_messages(messages, client)
+
+    def housekeeping_locked(self):
+        """Метод периодических задач в потоке-исполнителе."""
+        with self.lock:
+            self.housekeeping()
+
+    def send_frame(self, client, frame):
+        """Метод отправки готового кадра клиенту через буфер транспорта asyncio."""
+        if client not in self.clients or client.closing:
+            return
+        self.loop.call_soon_threadsafe(self.write_client, client, frame)
+
+    def write_client(self, client, data):
+        """Метод записи данных в транспорт, выполняется в цикле событий."""
+        if client.writer.is_closing():
+            return
+        client.writer.write(data)
+        client.bytes_queued += len(data)
+        if client.writer.transport.get_write_buffer_size() > self.outbound_limit:
+            SERVER_LOGGER.error(
+                f'Превышен размер очереди отправки клиента {client.address}, соединение разорвано.')
+            # Задача клиента завершится и удалит его из списков.
+            client.writer.transport.abort()
+
+    def deliver_offline_messages(self, client):
+        """
+        Метод доставки клиенту сообщений, поступивших пока он был отключён.
+        Доставка выполняется отдельной задачей цикла событий deliver_offline.
+        """
+        asyncio.run_coroutine_threadsafe(self.deliver_offline(client), self.loop)
+
+    async def deliver_offline(self, client):
+        """
+        Корутина доставки ожидавших сообщений. Сообщения читаются из
+        хранилища порциями без удаления, после каждого ждём, пока буфер
+        транспорта не опустится ниже порога. Из хранилища сообщения
+        удаляются после записи их байт в сокет: здесь и в цикле serve
+        для сообщений, оставшихся в буфере после последней порции.
+        """
+        while client in self.clients and not client.closing:
+            batch = await self.loop.run_in_executor(
+                self.executor, self.database.peek_offline_frames,
+                client.name, OFFLINE_BATCH_SIZE, client.offline_position)
+            try:
+                for position, frame in batch:
+                    if client not in self.clients or client.closing or client.writer.is_closing():
+                        return
+                    self.write_client(client, frame)
+                    client.offline_position = position
+                    client.offline_acks.append((client.bytes_queued, position))
+                    await client.writer.drain()
+            except ConnectionResetError:
+                return
+            await self.ack_written(client)
+            if len(batch) < OFFLINE_BATCH_SIZE:
+                return
+
+    async def ack_written(self, client):
+        """
+        Корутина удаления из хранилища сообщений, байты которых ушли из буфера
+        транспорта. У закрываемого транспорта буфер мог быть сброшен, не отправившись,
+        такие сообщения остаются в хранилище до следующего входа.
+        """
+        if client.writer.is_closing():
+            return
+        written = client.bytes_queued - client.writer.transport.get_write_buffer_size()
+        await self.loop.run_in_executor(self.executor, self.ack_offline_messages, client, written)
+
+    def close_client(self, client):
+        """
+        Метод закрытия соединения после отправки всей очереди клиента.
+        Транспорт asyncio сам отправляет буфер перед закрытием.
+        """
+        client.closing = True
+        self.loop.call_soon_threadsafe(client.writer.close)
+
+    def release_client(self, client):
+        """Метод освобождения сокета отключённого клиента."""
+        self.loop.call_soon_threadsafe(client.writer.close)
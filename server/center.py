@@ -1,54 +1,117 @@
+import datetime
 import threading
-import select
+import selectors
 import socket
-import json
 import hmac
 import binascii
+import hashlib
 import os
+import time
+from collections import Counter, deque
 
-from base.decorators import login_required
-from base.metaclasses import ServerVerifier
+from base.decorators import login_required, action_handler
+from base.metaclasses import ServerVerifier, ActionDispatcher
 from base.descriptors import PortValidator
 from base.variables import *
-from base.utils import sending_message, getting_message
+from base.utils import encode_message, key_fingerprint
+from server.connection import ClientConnection, Challenge
+from server.tokens import make_token, token_key, token_proof, check_token_id, NonceCache
 import log.config.server_log_config
 
 # Загрузка логера
 SERVER_LOGGER = logging.getLogger('server')
 
 
-class MessageProcessor(threading.Thread):
+class MessageProcessor(threading.Thread, metaclass=ActionDispatcher):
     """
     Основной класс сервера. Принимает содинения, словари - пакеты
     от клиентов, обрабатывает поступающие сообщения.
     Работает в качестве отдельного потока.
+    Обработчики действий протокола регистрируются декоратором action_handler.
     """
     port = PortValidator()
 
-    def __init__(self, listen_address, listen_port, database):
+    def __init__(self, listen_address, listen_port, database,
+                 outbound_high_water=OUTBOUND_HIGH_WATER, outbound_limit=OUTBOUND_LIMIT,
+                 auth_timeout=AUTH_TIMEOUT, offline_ttl=OFFLINE_MESSAGE_TTL,
+                 history_retention=HISTORY_RETENTION, archive=ARCHIVE_MODE,
+                 session_ttl=SESSION_TOKEN_TTL, token_secret=None, session_max_age=SESSION_MAX_AGE):
         # Параментры подключения
         self.addr = listen_address
         self.port = listen_port
 
+        # Разрешить нескольким процессам слушать один порт (SO_REUSEPORT)
+        self.reuse_port = False
+
         # База данных сервера
         self.database = database
 
+        # Пороги очереди отправки клиента: при превышении первого
+        # перестаём читать запросы клиента, при превышении второго отключаем его.
+        self.outbound_high_water = outbound_high_water
+        self.outbound_limit = outbound_limit
+
+        # Время на авторизацию нового подключения, сек.
+        self.auth_timeout = auth_timeout
+
+        # Очередь незавершённых авторизаций в порядке подключения.
+        # Таймаут у всех одинаковый, поэтому сроки в очереди возрастают.
+        self.handshakes = deque()
+
+        # Время хранения сообщений для отключённых пользователей, сек.
+        # и срок следующей очистки очереди от просроченных сообщений.
+        self.offline_ttl = offline_ttl
+        self.cleanup_at = 0
+
+        # Срок хранения подробной истории входов, дней,
+        # и срок следующего запуска её свёртки.
+        self.history_retention = history_retention
+        self.compact_at = 0
+
+        # Режим архива пересылаемых сообщений: off, meta или text
+        self.archive = archive
+
+        # Срок действия токенов возобновления сессии и секрет для их подписи.
+        # Секрет по умолчанию случайный: после перезапуска сервера
+        # выданные токены недействительны.
+        self.session_ttl = session_ttl
+        self.token_secret = token_secret or os.urandom(32)
+        # Случайные строки недавних входов по токену. Время сообщения
+        # принимается в пределах окна в обе стороны, поэтому строка
+        # хранится два окна. В многопроцессном режиме у каждого процесса своя.
+        self.token_nonces = NonceCache(2 * SESSION_PROOF_WINDOW)
+
+        # Предельный срок сессии от входа по паролю, сек.
+        self.session_max_age = session_max_age
+
+        # Срок следующей записи счётчиков сообщений в базу
+        self.stats_flush_at = time.monotonic() + STATS_FLUSH_INTERVAL
+
         # Сокет, через который будет осуществляться работа
         self.sock = None
 
-        # Список подключённых клиентов.
-        self.clients = []
+        # Селектор событий готовности сокетов (epoll в Linux)
+        self.selector = selectors.DefaultSelector()
 
-        # Сокеты
-        self.listen_sockets = None
-        self.error_sockets = None
+        # Блокировка состояния сервера: методы сервера вызываются
+        # также из потока графической оболочки.
+        self.lock = threading.RLock()
+
+        # Множество подключённых клиентов.
+        self.clients = set()
 
         # Флаг продолжения работы
         self.running = True
 
-        # Словарь содержащий сопоставленные имена и соответствующие им сокеты.
+        # Словарь содержащий сопоставленные имена и соответствующие им подключения.
         self.names = dict()
 
+        # Счётчики обработанных сообщений по действиям
+        self.action_counters = Counter()
+
+        # Подписчики на вход и выход пользователей (графическая оболочка)
+        self.user_listeners = []
+
         # Конструктор предка
         super().__init__()
 
@@ -56,53 +119,240 @@ class MessageProcessor(threading.Thread):
         """Метод основной цикл потока."""
         # Инициализация Сокета
         self.init_socket()
+        self.selector.register(self.sock, selectors.EVENT_READ)
 
-        # Основной цикл программы сервера
+        # Основной цикл программы сервера. Поток спит в селекторе, пока
+        # не появятся события, таймаут нужен только для проверки флага running.
         while self.running:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
             try:
-                client, client_address = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                SERVER_LOGGER.info(f'Установлено соедение с ПК {client_address}')
-                client.settimeout(5)
-                self.clients.append(client)
-
-            recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
-            # Проверяем на наличие ждущих клиентов
-            try:
-                if self.clients:
-                    recv_data_lst, self.listen_sockets, self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0)
+                events = self.selector.select(SERVER_SELECT_TIMEOUT)
             except OSError as err:
                 SERVER_LOGGER.error(f'Ошибка работы с сокетами: {err.errno}')
+                continue
+
+            with self.lock:
+                for key, mask in events:
+                    self.handle_event(key, mask)
+                self.housekeeping()
+
+        self.selector.close()
+        self.sock.close()
+        self.database.flush()
+
+    def handle_event(self, key, mask):
+        """Метод обработки события готовности одного сокета."""
+        if key.data is None:
+            self.accept_clients()
+            return
+        if mask & selectors.EVENT_WRITE:
+            self.flush_client(key.data)
+        if mask & selectors.EVENT_READ:
+            self.read_client(key.data)
+
+    def accept_clients(self):
+        """
+        Метод приёма новых подключений.
+        Принимает все ожидающие соединения и регистрирует их в селекторе.
+        """
+        while True:
+            try:
+                client_sock, client_address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                SERVER_LOGGER.error(f'Ошибка приёма соединения: {err}')
+                return
+            SERVER_LOGGER.info(f'Установлено соедение с ПК {client_address}')
+            client_sock.setblocking(False)
+            client = ClientConnection(client_sock, client_address)
+            self.clients.add(client)
+            self.selector.register(client_sock, selectors.EVENT_READ, client)
+            self.start_handshake(client)
+
+    def start_handshake(self, client):
+        """Метод постановки нового подключения в очередь ожидания авторизации."""
+        client.auth_deadline = time.monotonic() + self.auth_timeout
+        self.handshakes.append(client)
+
+    def housekeeping(self):
+        """Метод периодических задач, вызывается в основном цикле после обработки событий."""
+        self.expire_handshakes()
+        now = time.monotonic()
+        if now >= self.stats_flush_at:
+            self.stats_flush_at = now + STATS_FLUSH_INTERVAL
+            self.database.flush_message_stats()
+        if now >= self.cleanup_at:
+            self.cleanup_at = now + OFFLINE_CLEANUP_INTERVAL
+            count = self.database.remove_expired_messages(self.offline_ttl)
+            if count:
+                SERVER_LOGGER.info(f'Удалено просроченных сообщений из очереди: {count}.')
+        if self.history_retention and now >= self.compact_at:
+            self.compact_at = now + HISTORY_COMPACT_INTERVAL
+            self.database.compact_history(self.history_retention)
+
+    def expire_handshakes(self):
+        """
+        Метод отключения клиентов, не прошедших авторизацию за отведённое время.
+        """
+        now = time.monotonic()
+        while self.handshakes and self.handshakes[0].auth_deadline <= now:
+            client = self.handshakes.popleft()
+            if client.authenticated or client not in self.clients:
+                continue
+            SERVER_LOGGER.info(f'Клиент {client.address} не авторизовался вовремя, соединение разорвано.')
+            self.remove_client(client)
+
+    def read_client(self, client):
+        """
+        Метод приёма данных от клиента.
+        Обрабатывает все сообщения, полностью принятые за одно чтение,
+        если ошибка, исключаем клиента.
+        """
+        # Клиент мог быть отключён при обработке предыдущего события.
+        if client not in self.clients:
+            return
+        try:
+            data = client.sock.recv(MAX_PACKAGE_LENGTH)
+            if not data:
+                raise ConnectionResetError('Соединение закрыто клиентом')
+            messages = client.decoder.feed(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (OSError, ValueError) as err:
+            SERVER_LOGGER.debug(f'Getting data from client exception.', exc_info=err)
+            self.remove_client(client)
+            return
 
-            # принимаем сообщения и если ошибка, исключаем клиента.
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
-                    try:
-                        self.process_client_message(
-                            getting_message(client_with_message), client_with_message)
-                    except (OSError, json.JSONDecodeError, TypeError) as err:
-                        SERVER_LOGGER.debug(f'Getting data from client exception.', exc_info=err)
-                        self.remove_client(client_with_message)
+        self.process_messages(messages, client)
+
+    def process_messages(self, messages, client):
+        """Метод обработки сообщений, принятых от клиента за одно чтение."""
+        for message in messages:
+            if client not in self.clients or client.closing:
+                return
+            try:
+                # Если клиенту отправлен запрос 511, сообщение считается ответом на него.
+                if client.challenge:
+                    challenge = client.challenge
+                    client.challenge = None
+                    self.finish_auth(challenge, client, message)
+                else:
+                    self.process_client_message(message, client)
+            except (OSError, ValueError, TypeError, KeyError) as err:
+                SERVER_LOGGER.debug(f'Processing client message exception.', exc_info=err)
+                self.remove_client(client)
+                return
+            except Exception as err:
+                # Ошибка обработчика не должна останавливать поток сервера:
+                # отвечаем клиенту ошибкой и отключаем только его.
+                SERVER_LOGGER.error(f'Ошибка обработки сообщения клиента {client.address}: {err}', exc_info=err)
+                self.send_to(client, {
+                    RESPONSE: 400,
+                    ERROR: 'Bad request'
+                })
+                self.close_client(client)
+                return
+
+    def send_to(self, client, message):
+        """
+        Метод постановки сообщения в очередь отправки клиента.
+        Байты отправляются в основном цикле, когда сокет готов к записи,
+        поэтому медленный получатель не задерживает остальных клиентов.
+        Ответу на запрос с номером добавляется номер запроса.
+        """
+        if client.request_id is not None and RESPONSE in message:
+            message = dict(message, **{REQUEST_ID: client.request_id})
+        self.send_frame(client, encode_message(message))
+
+    def send_frame(self, client, frame):
+        """Метод постановки готового кадра в очередь отправки клиента."""
+        with self.lock:
+            if client not in self.clients or client.closing:
+                return
+            client.out_buffer += frame
+            client.bytes_queued += len(frame)
+            if len(client.out_buffer) > self.outbound_limit:
+                SERVER_LOGGER.error(
+                    f'Превышен размер очереди отправки клиента {client.address}, соединение разорвано.')
+                self.remove_client(client)
+                return
+            if not client.paused and len(client.out_buffer) > self.outbound_high_water:
+                SERVER_LOGGER.warning(
+                    f'Клиент {client.address} не успевает принимать данные, чтение его запросов приостановлено.')
+                client.paused = True
+            self.update_interest(client)
+
+    def flush_client(self, client):
+        """Метод отправки очереди клиента по готовности сокета к записи."""
+        if client not in self.clients:
+            return
+        try:
+            sent = client.sock.send(client.out_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as err:
+            SERVER_LOGGER.debug(f'Sending data to client exception.', exc_info=err)
+            self.remove_client(client)
+            return
+        del client.out_buffer[:sent]
+        client.bytes_sent += sent
+        self.ack_offline_messages(client, client.bytes_sent)
+
+        if client.closing and not client.out_buffer:
+            self.remove_client(client)
+            return
+        # Возобновляем чтение и доставку ожидавших сообщений,
+        # когда очередь опустела наполовину.
+        if len(client.out_buffer) <= self.outbound_high_water // 2:
+            client.paused = False
+            if client.offline_pending:
+                self.deliver_offline_messages(client)
+        self.update_interest(client)
+
+    def update_interest(self, client):
+        """Метод обновления набора событий, ожидаемых от сокета клиента."""
+        events = 0
+        if not client.paused and not client.closing:
+            events |= selectors.EVENT_READ
+        if client.out_buffer:
+            events |= selectors.EVENT_WRITE
+        if events != self.selector.get_key(client.sock).events:
+            self.selector.modify(client.sock, events, client)
+
+    def close_client(self, client):
+        """
+        Метод закрытия соединения после отправки всей очереди клиента.
+        Используется, когда клиенту нужно успеть отправить ответ с ошибкой.
+        """
+        if not client.out_buffer:
+            self.remove_client(client)
+            return
+        client.closing = True
+        self.update_interest(client)
 
     def remove_client(self, client):
         """
         Метод обработчик клиента с которым прервана связь.
-        Ищет клиента и удаляет его из списков и базы:
+        Удаляет клиента из списков и базы:
         """
-        SERVER_LOGGER.info(f'Клиент {client.getpeername()} отключился от сервера.')
-        for name in self.names:
-            if self.names[name] == client:
+        with self.lock:
+            if client not in self.clients:
+                return
+            SERVER_LOGGER.info(f'Клиент {client.address} отключился от сервера.')
+            name = client.name
+            if name is not None and self.names.get(name) is client:
                 self.database.user_logout(name)
                 del self.names[name]
-                break
-        self.clients.remove(client)
-        client.close()
+                self.on_user_logout(name)
+                for listener in self.user_listeners:
+                    listener.user_logged_out(name)
+            self.clients.remove(client)
+            self.release_client(client)
+
+    def release_client(self, client):
+        """Метод освобождения сокета отключённого клиента."""
+        self.selector.unregister(client.sock)
+        client.sock.close()
 
     def init_socket(self):
         """Метод инициализатор сокета."""
@@ -111,8 +361,10 @@ class MessageProcessor(threading.Thread):
             f' Если адрес не указан, принимаются соединения с любых адресов.')
         # Готовим сокет
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.reuse_port:
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         transport.bind((self.addr, self.port))
-        transport.settimeout(0.75)
+        transport.setblocking(False)
 
         # Начинаем слушать сокет.
         self.sock = transport
@@ -122,220 +374,394 @@ class MessageProcessor(threading.Thread):
         """
         Метод отправки сообщения клиенту.
         """
-        if message[TO] in self.names and self.names[message[TO]] in self.listen_sockets:
-            try:
-                sending_message(self.names[message[TO]], message)
-                SERVER_LOGGER.info(
-                    f'Отправлено сообщение пользователю {message[TO]} от пользователя {message[FROM]}.')
-            except OSError:
-                self.remove_client(message[TO])
-        elif message[TO] in self.names and self.names[message[TO]] not in self.listen_sockets:
-            SERVER_LOGGER.error(
-                f'Связь с клиентом {message[TO]} была потеряна. Соединение закрыто, доставка невозможна.')
-            self.remove_client(self.names[message[TO]])
+        if message[TO] in self.names:
+            self.send_to(self.names[message[TO]], message)
+            SERVER_LOGGER.info(
+                f'Отправлено сообщение пользователю {message[TO]} от пользователя {message[FROM]}.')
         else:
             SERVER_LOGGER.error(
                 f'Пользователь {message[TO]} не зарегистрирован на сервере, отправка сообщения невозможна.')
 
     @login_required
     def process_client_message(self, message, client):
-        """Метод отбработчик поступающих сообщений."""
+        """
+        Метод отбработчик поступающих сообщений.
+        Обработчик выбирается по полю action из реестра handlers,
+        который метакласс строит при создании класса.
+        Номер запроса REQUEST_ID, если клиент его передал, убирается
+        из сообщения и возвращается в ответах на этот запрос.
+        """
         SERVER_LOGGER.debug(f'Разбор сообщения от клиента : {message}')
-        # Если это сообщение о присутствии, принимаем и отвечаем
-        if ACTION in message and message[ACTION] == PRESENCE \
-                and TIME in message \
-                and USER in message:
-            # Если сообщение о присутствии то вызываем функцию авторизации.
-            self.autorize_user(message, client)
-
-        # Если это сообщение, то отправляем его получателю.
-        elif ACTION in message and message[ACTION] == MESSAGE \
-                and TO in message \
-                and TIME in message \
-                and FROM in message \
-                and MESSAGE in message \
-                and self.names[message[FROM]] == client:
-            if message[TO] in self.names:
-                self.database.process_message(message[FROM], message[TO])
-                self.process_message(message)
-                try:
-                    sending_message(client, {RESPONSE: 200})
-                except OSError:
-                    self.remove_client(client)
-            else:
-                try:
-                    sending_message(client, {
-                        RESPONSE: 400,
-                        ERROR: 'Bad request'
-                    })
-                except OSError:
-                    pass
+        client.request_id = message.pop(REQUEST_ID, None)
+        try:
+            action = message.get(ACTION)
+            handler = self.handlers.get(action)
+            if handler is None or not handler.validate(message, client):
+                self.action_counters[None] += 1
+                self.send_to(client, {
+                    RESPONSE: 400,
+                    ERROR: 'Bad request'
+                })
+                return
+            self.action_counters[action] += 1
+            getattr(self, handler.name)(message, client)
+        finally:
+            client.request_id = None
+
+    def action_stats(self):
+        """
+        Метод возвращает число обработанных сообщений по действиям.
+        Некорректные запросы учитываются под ключом None.
+        """
+        with self.lock:
+            return dict(self.action_counters)
+
+    @action_handler(MESSAGE, TO, TIME, FROM, MESSAGE, owner=FROM)
+    def action_message(self, message, client):
+        """
+        Обработчик сообщения пользователю, отправляет его получателю.
+        Если получатель не подключён, сообщение сохраняется в очереди.
+        """
+        if self.is_online(message[TO]):
+            self.database.process_message(message[FROM], message[TO])
+            self.archive_message(message)
+            self.process_message(message)
+            self.send_to(client, {RESPONSE: 200})
+        elif self.database.check_user(message[TO]):
+            # Получатель не подключён: сообщение будет доставлено при его входе.
+            self.database.process_message(message[FROM], message[TO])
+            self.archive_message(message)
+            self.database.store_message(message[TO], message)
+            self.send_to(client, {RESPONSE: 200})
+            SERVER_LOGGER.info(f'Сообщение для пользователя {message[TO]} поставлено в очередь.')
+        else:
+            self.send_to(client, {
+                RESPONSE: 400,
+                ERROR: 'Bad request'
+            })
+
+    def archive_message(self, message):
+        """
+        Метод записи сообщения в архив в соответствии с режимом архива.
+        Текст сохраняется только в режиме text, иначе - его размер и хэш.
+        """
+        if self.archive == 'off':
             return
+        text = str(message[MESSAGE])
+        self.database.archive_message(
+            message[FROM], message[TO], len(text), hashlib.sha256(text.encode(ENCODING)).hexdigest(),
+            text if self.archive == 'text' else None)
 
-        # если клиент выходит
-        elif ACTION in message and message[ACTION] == QUIT \
-                and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            self.remove_client(client)
+    @action_handler(QUIT, ACCOUNT_NAME, owner=ACCOUNT_NAME)
+    def action_quit(self, message, client):
+        """Обработчик выхода клиента."""
+        self.remove_client(client)
 
-        # если это запрос списка контактов
-        elif ACTION in message and message[ACTION] == GET_CONTACTS \
-                and USER in message and \
-                self.names[message[USER]] == client:
-            try:
-                sending_message(client, {
-                    RESPONSE: 202,
-                    LIST_INFO: self.database.get_contacts(message[USER])
-                })
-            except OSError:
-                self.remove_client(client)
+    @action_handler(GET_CONTACTS, USER, owner=USER)
+    def action_get_contacts(self, message, client):
+        """Обработчик запроса списка контактов."""
+        self.send_to(client, {
+            RESPONSE: 202,
+            LIST_INFO: self.database.get_contacts(message[USER])
+        })
 
-        # если это добавление контакта
-        elif ACTION in message and message[ACTION] == ADD_CONTACT \
-                and ACCOUNT_NAME in message \
-                and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                sending_message(client, {RESPONSE: 200})
-            except OSError:
-                self.remove_client(client)
+    @action_handler(ADD_CONTACT, ACCOUNT_NAME, USER, owner=USER)
+    def action_add_contact(self, message, client):
+        """Обработчик добавления контакта."""
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        self.send_to(client, {RESPONSE: 200})
 
-        # если это удаление контакта
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT \
-                and ACCOUNT_NAME in message \
-                and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                sending_message(client, {RESPONSE: 200})
-            except OSError:
-                self.remove_client(client)
+    @action_handler(REMOVE_CONTACT, ACCOUNT_NAME, USER, owner=USER)
+    def action_remove_contact(self, message, client):
+        """Обработчик удаления контакта."""
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        self.send_to(client, {RESPONSE: 200})
 
-        # если это запрос известных пользователей
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            try:
-                sending_message(client, {
-                    RESPONSE: 202,
-                    LIST_INFO: [user[0] for user in self.database.users_list()]
-                })
-            except OSError:
-                self.remove_client(client)
+    @action_handler(USERS_REQUEST, ACCOUNT_NAME, owner=ACCOUNT_NAME)
+    def action_users_request(self, message, client):
+        """Обработчик запроса известных пользователей."""
+        self.send_to(client, {
+            RESPONSE: 202,
+            LIST_INFO: [user[0] for user in self.database.users_list()]
+        })
 
-        # Если это запрос публичного ключа пользователя
-        elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST \
-                and ACCOUNT_NAME in message:
-            response = {RESPONSE: 511, DATA: self.database.get_pubkey(message[ACCOUNT_NAME])}
-            # может быть, что ключа ещё нет (пользователь никогда не логинился,
-            # тогда шлём 400)
-            if response[DATA]:
-                try:
-                    sending_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                try:
-                    sending_message(client, {
-                        RESPONSE: 400,
-                        ERROR: 'Нет публичного ключа для данного пользователя!'
-                    })
-                except OSError:
-                    self.remove_client(client)
-
-        # Иначе Bad request
+    @action_handler(PUBLIC_KEY_REQUEST, ACCOUNT_NAME)
+    def action_public_key_request(self, message, client):
+        """Обработчик запроса публичного ключа пользователя."""
+        response = {RESPONSE: 511, DATA: self.database.get_pubkey(message[ACCOUNT_NAME])}
+        # может быть, что ключа ещё нет (пользователь никогда не логинился,
+        # тогда шлём 400)
+        if response[DATA]:
+            self.send_to(client, response)
         else:
-            try:
-                sending_message(client, {
-                    RESPONSE: 400,
-                    ERROR: 'Bad request'
-                })
-            except OSError:
-                self.remove_client(client)
+            self.send_to(client, {
+                RESPONSE: 400,
+                ERROR: 'Нет публичного ключа для данного пользователя!'
+            })
+
+    @action_handler(SESSION_REFRESH, TIME)
+    def action_session_refresh(self, message, client):
+        """
+        Обработчик продления сессии: выдаёт клиенту новый токен.
+        После предельного срока сессии токен не выдаётся.
+        """
+        response = {RESPONSE: 200}
+        token = self.session_token(client)
+        if token:
+            response[SESSION_TOKEN] = token
+        self.send_to(client, response)
+
+    def session_token(self, client):
+        """
+        Метод выпуска токена сессии клиента. Возвращает None, если токены
+        отключены или истёк предельный срок сессии.
+        """
+        if self.session_ttl and time.time() < client.session_deadline:
+            return make_token(self.token_secret, client.name, self.session_ttl, client.session_deadline,
+                              fingerprint=client.key_fingerprint)
+        return None
+
+    @action_handler(PRESENCE, TIME, USER)
+    def autorize_user(self, message, client):
+        """
+        Метод реализующий авторизцию пользователей.
+        Ответ на запрос 511 не ожидается на месте, а придёт следующим
+        сообщением клиента, остальные клиенты тем временем обслуживаются.
+        Клиент с действующим токеном сессии входит сразу, без запроса 511.
+        """
+        if self.session_login(message, client):
+            return
+        if not self.check_presence(message, client):
+            return
+        self.password_challenge(message, client)
+
+    def password_challenge(self, message, client):
+        """Метод отправки клиенту запроса 511 для проверки пароля."""
+        message_auth, digest = self.make_challenge(message[USER][ACCOUNT_NAME])
+        # Ключ запрашивается, только если клиент прислал отпечаток,
+        # не совпадающий с отпечатком сохранённого ключа.
+        key_changed = self.key_changed(message[USER])
+        if key_changed and PUBLIC_KEY not in message[USER]:
+            message_auth[PUBLIC_KEY_REQUEST] = True
+        # Вход по паролю начинает новую сессию со своим предельным сроком
+        client.challenge = Challenge(message, digest, key_changed, time.time() + self.session_max_age)
+        self.send_to(client, message_auth)
+
+    def session_login(self, message, client):
+        """
+        Метод входа по токену возобновления сессии за один обмен.
+        Сообщение о присутствии содержит идентификатор токена, случайную
+        строку клиента и HMAC ключом сессии от неё и времени сообщения.
+        Ключ вычисляется по идентификатору, база не используется. Возвращает
+        False, если токена нет, он просрочен или поддельный, имя занято,
+        ключ клиента не тот, с которым выдан токен, время сообщения вне окна
+        или строка уже использована, - тогда выполняется обычная авторизация.
+        Пользователь, удалённый после выдачи токена, входит по нему, пока
+        токен не истечёт: продлить его уже нельзя.
+        """
+        token_id = message.get(SESSION_TOKEN)
+        nonce = message.get(TOKEN_NONCE)
+        if not token_id or not self.session_ttl or not isinstance(nonce, str):
+            return False
+        session = check_token_id(token_id)
+        if session is None:
+            return False
+        name, deadline, fingerprint = session
+        if name != message[USER][ACCOUNT_NAME] or self.is_online(name):
+            return False
+        if fingerprint is None or self.presence_fingerprint(message[USER]) != fingerprint:
+            return False
+        if not isinstance(message[TIME], (int, float)) or abs(time.time() - message[TIME]) > SESSION_PROOF_WINDOW:
+            return False
+        try:
+            proof = binascii.a2b_base64(message.get(TOKEN_PROOF))
+        except (binascii.Error, TypeError, ValueError):
+            return False
+        digest = token_proof(token_key(self.token_secret, token_id), nonce, message[TIME])
+        if not hmac.compare_digest(digest, proof):
+            return False
+        # Строка запоминается после проверки HMAC: чужие строки занять нельзя
+        if not self.token_nonces.add(nonce):
+            SERVER_LOGGER.warning(f'Повтор сообщения о присутствии {name} с токеном сессии.')
+            return False
+        self.complete_login(message, client, None, deadline)
+        return True
 
-    def autorize_user(self, message, sock):
-        """Метод реализующий авторизцию пользователей."""
+    @staticmethod
+    def presence_fingerprint(user):
+        """
+        Метод получения отпечатка ключа клиента из сообщения о присутствии:
+        клиент присылает ключ целиком (PUBLIC_KEY) или только его отпечаток.
+        """
+        if PUBLIC_KEY in user:
+            return key_fingerprint(user[PUBLIC_KEY])
+        return user.get(PUBLIC_KEY_HASH)
+
+    def key_changed(self, user):
+        """
+        Метод проверки, отличается ли ключ клиента от сохранённого.
+        Сравниваются отпечатки ключа из сообщения о присутствии и сохранённого.
+        """
+        fingerprint = self.presence_fingerprint(user)
+        stored = self.database.get_pubkey(user[ACCOUNT_NAME])
+        return fingerprint is None or stored is None or fingerprint != key_fingerprint(stored)
+
+    def check_presence(self, message, client):
+        """
+        Метод проверки сообщения о присутствии перед авторизацией.
+        Если имя занято или не зарегистрировано, отвечает 400,
+        закрывает соединение и возвращает False.
+        """
         # Если имя пользователя уже занято то возвращаем 400
         SERVER_LOGGER.debug(f'Start auth process for {message[USER]}')
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
-            try:
-                SERVER_LOGGER.debug('Username busy, sending 400')
-                sending_message(sock, {
-                    RESPONSE: 400,
-                    ERROR: 'Bad request'
-                })
-            except OSError:
-                SERVER_LOGGER.debug('OS Error')
-                pass
-            self.clients.remove(sock)
-            sock.close()
+        if self.is_online(message[USER][ACCOUNT_NAME]):
+            SERVER_LOGGER.debug('Username busy, sending 400')
+            self.send_to(client, {
+                RESPONSE: 400,
+                ERROR: 'Bad request'
+            })
+            self.close_client(client)
+            return False
         # Проверяем что пользователь зарегистрирован на сервере.
         elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
-            try:
-                SERVER_LOGGER.debug('Unknown username, sending 400')
-                sending_message(sock, {
-                    RESPONSE: 400,
-                    ERROR: 'Пользователь не зарегистрирован.'
-                })
-            except OSError:
-                pass
-            self.clients.remove(sock)
-            sock.close()
+            SERVER_LOGGER.debug('Unknown username, sending 400')
+            self.send_to(client, {
+                RESPONSE: 400,
+                ERROR: 'Пользователь не зарегистрирован.'
+            })
+            self.close_client(client)
+            return False
+        SERVER_LOGGER.debug('Correct username, starting passwd check.')
+        return True
+
+    def make_challenge(self, name):
+        """
+        Метод подготовки запроса 511 для проверки пароля.
+        Возвращает сообщение для клиента и ожидаемый от него хэш.
+        """
+        # Словарь - заготовка
+        message_auth = {RESPONSE: 511, DATA: None}
+        # Набор байтов в hex представлении
+        random_str = binascii.hexlify(os.urandom(64))
+        # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
+        message_auth[DATA] = random_str.decode('ascii')
+        # Создаём хэш пароля и связки с рандомной строкой, сохраняем
+        # серверную версию ключа
+        hash = hmac.new(self.database.get_hash(name), random_str, 'MD5')
+        digest = hash.digest()
+        SERVER_LOGGER.debug(f'Auth message = {message_auth}')
+        return message_auth, digest
+
+    def finish_auth(self, challenge, client, ans):
+        """
+        Метод проверки ответа клиента на запрос 511 и завершения авторизации.
+        Запрошенный у клиента ключ приходит в этом же ответе.
+        """
+        message = challenge.presence
+        client_digest = binascii.a2b_base64(ans[DATA])
+        # Если ответ клиента корректный, то сохраняем его в список
+        # пользователей.
+        if RESPONSE in ans and ans[RESPONSE] == 511 \
+                and hmac.compare_digest(challenge.digest, client_digest):
+            key = None
+            if challenge.key_changed:
+                key = ans.get(PUBLIC_KEY, message[USER].get(PUBLIC_KEY))
+            self.complete_login(message, client, key, challenge.deadline)
         else:
-            SERVER_LOGGER.debug('Correct username, starting passwd check.')
-            # Иначе отвечаем 511 и проводим процедуру авторизации
-            # Словарь - заготовка
-            message_auth = {RESPONSE: 511, DATA: None}
-            # Набор байтов в hex представлении
-            random_str = binascii.hexlify(os.urandom(64))
-            # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
-            message_auth[DATA] = random_str.decode('ascii')
-            # Создаём хэш пароля и связки с рандомной строкой, сохраняем
-            # серверную версию ключа
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
-            digest = hash.digest()
-            SERVER_LOGGER.debug(f'Auth message = {message_auth}')
-            try:
-                # Обмен с клиентом
-                sending_message(sock, message_auth)
-                ans = getting_message(sock)
-            except OSError as err:
-                SERVER_LOGGER.debug('Error in auth, data:', exc_info=err)
-                sock.close()
+            self.send_to(client, {
+                RESPONSE: 400,
+                ERROR: 'Пользователь не зарегистрирован.'
+            })
+            self.close_client(client)
+
+    def complete_login(self, message, client, key, deadline):
+        """
+        Метод завершения входа авторизованного клиента. Ответ 200
+        содержит новый токен возобновления сессии, если они включены.
+        key - новый публичный ключ клиента или None, если он не изменился,
+        deadline - предельный срок сессии.
+        """
+        client.name = message[USER][ACCOUNT_NAME]
+        client.session_deadline = deadline
+        client.key_fingerprint = key_fingerprint(key) if key else self.presence_fingerprint(message[USER])
+        self.names[client.name] = client
+        client_ip, client_port = client.address
+        response = {RESPONSE: 200}
+        token = self.session_token(client)
+        if token:
+            response[SESSION_TOKEN] = token
+        self.send_to(client, response)
+        # добавляем пользователя в список активных и если у него изменился открытый ключ
+        # сохраняем новый
+        self.database.user_login(
+            message[USER][ACCOUNT_NAME],
+            client_ip,
+            client_port,
+            key)
+        self.on_user_login(message[USER][ACCOUNT_NAME])
+        login_date = datetime.datetime.now()
+        for listener in self.user_listeners:
+            listener.user_logged_in(client.name, client_ip, client_port, login_date)
+        self.deliver_offline_messages(client)
+
+    def deliver_offline_messages(self, client):
+        """
+        Метод доставки клиенту сообщений, поступивших пока он был отключён.
+        Сообщения читаются из хранилища порциями без удаления, пока очередь
+        отправки не достигнет порога high water или предела её размера.
+        Следующая порция читается из flush_client, когда очередь опустеет
+        наполовину, а из хранилища сообщения удаляются после отправки их байт.
+        """
+        client.offline_pending = False
+        while client in self.clients and not client.closing:
+            batch = self.database.peek_offline_frames(client.name, OFFLINE_BATCH_SIZE, client.offline_position)
+            for position, frame in batch:
+                if client.out_buffer and (len(client.out_buffer) >= self.outbound_high_water or
+                                          len(client.out_buffer) + len(frame) > self.outbound_limit):
+                    client.offline_pending = True
+                    return
+                self.send_frame(client, frame)
+                if client not in self.clients:
+                    return
+                client.offline_position = position
+                client.offline_acks.append((client.bytes_queued, position))
+            if len(batch) < OFFLINE_BATCH_SIZE:
                 return
-            client_digest = binascii.a2b_base64(ans[DATA])
-            # Если ответ клиента корректный, то сохраняем его в список
-            # пользователей.
-            if RESPONSE in ans and ans[RESPONSE] == 511 \
-                    and hmac.compare_digest(digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-                try:
-                    sending_message(sock, {RESPONSE: 200})
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                # добавляем пользователя в список активных и если у него изменился открытый ключ
-                # сохраняем новый
-                self.database.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port,
-                    message[USER][PUBLIC_KEY])
-            else:
-                try:
-                    sending_message(sock, {
-                        RESPONSE: 400,
-                        ERROR: 'Пользователь не зарегистрирован.'
-                    })
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
+
+    def ack_offline_messages(self, client, written):
+        """
+        Метод удаления из хранилища доставленных сообщений, байты которых
+        отправлены клиенту: written - число отправленных байт.
+        """
+        position = None
+        while client.offline_acks and client.offline_acks[0][0] <= written:
+            position = client.offline_acks.popleft()[1]
+        if position is not None:
+            self.database.ack_offline_messages(client.name, position)
 
     def service_update_lists(self):
         """Метод реализующий отправки сервисного сообщения 205 клиентам."""
-        for client in self.names:
-            try:
-                sending_message(self.names[client], {RESPONSE: 205})
-            except OSError:
-                self.remove_client(self.names[client])
+        with self.lock:
+            for client in list(self.names.values()):
+                self.send_to(client, {RESPONSE: 205})
+
+    def is_online(self, name):
+        """Метод проверяющий, что пользователь подключён к серверу."""
+        return name in self.names
+
+    def add_user_listener(self, listener):
+        """
+        Метод подписки на вход и выход пользователей. Из потока сервера
+        вызываются listener.user_logged_in(name, ip_address, port, login_date)
+        и listener.user_logged_out(name).
+        """
+        with self.lock:
+            self.user_listeners.append(listener)
+
+    def on_user_login(self, name):
+        """Событие успешной авторизации пользователя."""
+        pass
+
+    def on_user_logout(self, name):
+        """Событие отключения авторизованного пользователя."""
+        pass
@@ -0,0 +1,86 @@
+from collections import deque, namedtuple
+
+from base.utils import MessageDecoder
+
+# Ожидаемый ответ на запрос 511: сообщение о присутствии, ожидаемый хэш,
+# признак смены ключа клиента и предельный срок сессии.
+Challenge = namedtuple('Challenge', 'presence digest key_changed deadline')
+
+
+class ClientConnection:
+    """
+    Класс - подключение (сессия) клиента к серверу.
+    Хранит сокет клиента, имя авторизованного пользователя, декодер
+    входящего потока кадров и очередь исходящих байт, которая
+    отправляется по готовности сокета к записи.
+    """
+
+    def __init__(self, sock, address):
+        # Сокет клиента и его адрес
+        self.sock = sock
+        self.address = address
+
+        # Имя пользователя, None до успешной авторизации.
+        # Вместе со словарём names сервера образует двусторонний индекс.
+        self.name = None
+
+        # Декодер входящих кадров
+        self.decoder = MessageDecoder()
+
+        # Очередь байт, ожидающих отправки клиенту,
+        # и счётчики байт, поставленных в неё и отправленных с момента подключения
+        self.out_buffer = bytearray()
+        self.bytes_queued = 0
+        self.bytes_sent = 0
+
+        # Флаг приостановки чтения запросов клиента, пока не опустеет очередь
+        self.paused = False
+
+        # Флаг закрытия соединения после отправки очереди
+        self.closing = False
+
+        # Ожидаемый ответ на запрос 511 (Challenge)
+        self.challenge = None
+
+        # Срок, до которого клиент должен пройти авторизацию (time.monotonic)
+        self.auth_deadline = None
+
+        # Номер обрабатываемого запроса клиента, возвращается в ответах на него
+        self.request_id = None
+
+        # Предельный срок сессии (unix time), после него токен не продлевается,
+        # и отпечаток ключа, с которым клиент вошёл, - для выпуска токенов
+        self.session_deadline = None
+        self.key_fingerprint = None
+
+        # Доставка сообщений, ожидавших подключения клиента: позиция последнего
+        # сообщения, поставленного в очередь отправки, признак, что в хранилище
+        # остались ещё сообщения, и пары (значение bytes_queued после сообщения,
+        # его позиция) для удаления сообщений из хранилища после отправки их байт.
+        self.offline_position = None
+        self.offline_pending = False
+        self.offline_acks = deque()
+
+    @property
+    def authenticated(self):
+        """Признак того, что клиент прошёл авторизацию."""
+        return self.name is not None
+
+    def fileno(self):
+        """Метод возвращает дескриптор сокета, нужен для работы с селектором."""
+        return self.sock.fileno()
+
+    def __repr__(self):
+        return f'<ClientConnection {self.name or "-"} {self.address}>'
+
+
+class AsyncClientConnection(ClientConnection):
+    """
+    Класс - подключение клиента к асинхронному серверу.
+    Вместо собственной очереди отправки использует буфер транспорта asyncio.
+    """
+
+    def __init__(self, reader, writer):
+        super().__init__(writer.get_extra_info('socket'), writer.get_extra_info('peername'))
+        self.reader = reader
+        self.writer = writer
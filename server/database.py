@@ -1,15 +1,223 @@
 import datetime
+import functools
+import json
+import logging
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import Future
 
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text
-from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy import create_engine, event, bindparam, select, text, tuple_, \
+    Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Date, Text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session, aliased
+from sqlalchemy.pool import QueuePool
+
+from base.variables import STATS_FLUSH_COUNT, USER_CACHE_SIZE, DB_BUSY_TIMEOUT, \
+    WRITE_BATCH_WINDOW, WRITE_BATCH_SIZE, HISTORY_COMPACT_CHUNK, ARCHIVE_PAGE_SIZE, STAT_PAGE_SIZE, \
+    OFFLINE_EXPIRE_CHUNK
+from server.repository import Repository, ArchiveRecord, UserStats, history_border
+
+# Загрузка логера
+SERVER_LOGGER = logging.getLogger('server')
+
+# Кэшируемые данные пользователя
+UserRecord = namedtuple('UserRecord', 'id passwd_hash pubkey')
+
+
+# Миграции схемы базы сервера. Номер применённой миграции хранится
+# в PRAGMA user_version, при запуске применяются все следующие по порядку.
+MIGRATIONS = [
+    # 1: индексы по столбцам, по которым выполняются запросы,
+    # и уникальность пары пользователь - контакт.
+    [
+        'DELETE FROM Contacts WHERE id NOT IN (SELECT MIN(id) FROM Contacts GROUP BY user, contact)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_contacts_user_contact ON Contacts (user, contact)',
+        'CREATE INDEX IF NOT EXISTS ix_contacts_contact ON Contacts (contact)',
+        'CREATE INDEX IF NOT EXISTS ix_history_user_name ON history_user (name)',
+        'CREATE INDEX IF NOT EXISTS ix_history_user ON History (user)',
+    ],
+    # 2: выборка старых записей истории входов для свёртки
+    # и одна суточная запись на пользователя.
+    [
+        'CREATE INDEX IF NOT EXISTS ix_history_user_date ON history_user (date)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_history_user_daily_user_day ON history_user_daily (user, day)',
+    ],
+    # 3: полнотекстовый индекс архива сообщений. Перенесён в FULL_TEXT_SEARCH:
+    # SQLite может быть собран без FTS5, номер оставлен для уже обновлённых баз.
+    [],
+    # 4: постраничная выборка статистики пользователей в порядке любого столбца.
+    [
+        'CREATE INDEX IF NOT EXISTS ix_users_last_login ON users (last_login)',
+        'CREATE INDEX IF NOT EXISTS ix_history_sent ON History (sent, user)',
+        'CREATE INDEX IF NOT EXISTS ix_history_accepted ON History (accepted, user)',
+    ],
+]
+
+# Полнотекстовый индекс архива сообщений, обновляется триггерами.
+# Создаётся при запуске, если SQLite поддерживает FTS5.
+FULL_TEXT_SEARCH = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_archive_fts "
+    "USING fts5(text, content='message_archive', content_rowid='id')",
+    'CREATE TRIGGER IF NOT EXISTS message_archive_insert AFTER INSERT ON message_archive '
+    'WHEN new.text IS NOT NULL BEGIN '
+    'INSERT INTO message_archive_fts (rowid, text) VALUES (new.id, new.text); END',
+    'CREATE TRIGGER IF NOT EXISTS message_archive_delete AFTER DELETE ON message_archive '
+    'WHEN old.text IS NOT NULL BEGIN '
+    "INSERT INTO message_archive_fts (message_archive_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+]
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Настройка нового соединения с SQLite: журнал WAL позволяет читать
+    базу, не дожидаясь окончания записи, а synchronous=NORMAL не вызывает
+    fsync на каждую транзакцию (в режиме WAL база при сбое остаётся целой).
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def read_method(method):
+    """
+    Декоратор метода чтения базы: по окончании освобождает сессию потока,
+    чтобы потоки, только читающие базу, не держали соединения пула.
+    Сессию потока записи не трогает: там чтение - часть пачки изменений.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            if threading.current_thread() is not self.writer:
+                self.session.remove()
+
+    return wrapper
+
+
+class LruCache:
+    """
+    Класс - ограниченный по размеру кэш, вытесняющий давно не
+    использованные записи. Считает попадания и промахи.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        # Номера версий ключей, увеличиваются при сбросе записи: значение,
+        # загруженное до сброса, в кэш не сохраняется.
+        self.versions = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        """
+        Метод возвращает значение по ключу, при промахе получает его
+        вызовом loader(key) вне блокировки и сохраняет в кэше, если
+        запись не сбросили во время загрузки.
+        """
+        with self.lock:
+            if key in self.data:
+                self.hits += 1
+                self.data.move_to_end(key)
+                return self.data[key]
+            self.misses += 1
+            version = self.versions.get(key, 0)
+        value = loader(key)
+        with self.lock:
+            if self.versions.get(key, 0) != version:
+                return value
+            self.data[key] = value
+            if len(self.data) > self.size:
+                self.data.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        """Метод удаления записи из кэша."""
+        with self.lock:
+            self.data.pop(key, None)
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+    def stats(self):
+        """Метод возвращает число попаданий, промахов и размер кэша."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.data)}
+
+
+class WriteScheduler(threading.Thread):
+    """
+    Класс - поток записи в базу данных.
+    Изменения ставятся в очередь и выполняются пачками в одной транзакции:
+    пачка собирается, пока с первого изменения не пройдёт window секунд
+    или не наберётся size изменений. Результат каждого изменения
+    передаётся через Future, который завершается после фиксации транзакции.
+    """
+
+    def __init__(self, session, window, size):
+        super().__init__(name='db-writer', daemon=True)
+        self.session = session
+        self.window = window
+        self.size = size
+        self.queue = queue.Queue()
+
+    def submit(self, func, *args):
+        """Метод постановки изменения в очередь, возвращает Future с его результатом."""
+        future = Future()
+        self.queue.put((future, func, args))
+        return future
+
+    def run(self):
+        """Метод основной цикл потока."""
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.execute(batch)
+
+    def execute(self, batch):
+        """
+        Метод выполнения пачки изменений в одной транзакции.
+        Если одно из изменений завершилось ошибкой, транзакция отменяется,
+        а изменения пачки выполняются по одному.
+        """
+        results = []
+        try:
+            for future, func, args in batch:
+                results.append(func(*args))
+            self.session.commit()
+        except Exception as err:
+            self.session.rollback()
+            if len(batch) > 1:
+                for item in batch:
+                    self.execute([item])
+                return
+            SERVER_LOGGER.error(f'Ошибка записи в базу данных: {err}')
+            batch[0][0].set_exception(err)
+            return
+        for (future, func, args), result in zip(batch, results):
+            future.set_result(result)
 
 
 # класс для хранения данных для серверной стороны
-class ServerRepository:
+class ServerRepository(Repository):
     """
     Класс - оболочка для работы с базой данных сервера.
     Использует SQLite базу данных, реализован с помощью
     SQLAlchemy ORM и используется классический подход.
+    Методы можно вызывать из разных потоков: у каждого потока своя сессия.
+    Изменения, кроме очереди сообщений, выполняет поток записи WriteScheduler.
     """
 
     class Users:
@@ -38,6 +246,14 @@ class ServerRepository:
             self.ip_address = ip_address
             self.port = port
 
+    # класс для отображения таблицы БД свёрнутой по суткам истории посещения
+    class HistoryUserDaily:
+        def __init__(self, user, day, logins):
+            self.id = None
+            self.user = user
+            self.day = day
+            self.logins = logins
+
     # класс для отображение таблицы БД контактов пользователей
     class UsersContacts:
         def __init__(self, user, contact):
@@ -53,11 +269,35 @@ class ServerRepository:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self, path):
+    # класс для отображения таблицы БД сообщений, ожидающих доставки
+    class OfflineMessages:
+        def __init__(self, recipient, message, created):
+            self.id = None
+            self.recipient = recipient
+            self.message = message
+            self.created = created
+
+    # класс для отображения таблицы БД архива сообщений
+    class MessageArchive:
+        def __init__(self, sender, recipient, created, size, digest, text):
+            self.id = None
+            self.sender = sender
+            self.recipient = recipient
+            self.created = created
+            self.size = size
+            self.digest = digest
+            self.text = text
+
+    def __init__(self, path, write_window=WRITE_BATCH_WINDOW, write_batch=WRITE_BATCH_SIZE):
         # движок БД -'sqlite:///server_database.db3'
-        self.engine = create_engine(f'sqlite:///{path}', echo=False, pool_recycle=7200, connect_args={
-            'check_same_thread': False
-        })
+        # Соединения переиспользуются пулом, при занятой базе запрос
+        # ждёт до DB_BUSY_TIMEOUT секунд вместо немедленной ошибки.
+        self.engine = create_engine(f'sqlite:///{path}', echo=False, pool_recycle=7200, poolclass=QueuePool,
+                                    connect_args={
+                                        'check_same_thread': False,
+                                        'timeout': DB_BUSY_TIMEOUT
+                                    })
+        event.listen(self.engine, 'connect', set_sqlite_pragmas)
         # подготовка "запроса" на создание таблицы users внутри каталога MetaData
         self.metadata = MetaData()
 
@@ -85,6 +325,13 @@ class ServerRepository:
                                    Column('ip_address', String),
                                    Column('port', Integer)
                                    )
+        # таблица истории посещения, свёрнутой по суткам
+        history_user_daily_table = Table('history_user_daily', self.metadata,
+                                         Column('id', Integer, primary_key=True),
+                                         Column('user', ForeignKey('users.id')),
+                                         Column('day', Date),
+                                         Column('logins', Integer)
+                                         )
         # таблица контактов пользователей
         contacts = Table('Contacts', self.metadata,
                          Column('id', Integer, primary_key=True),
@@ -99,160 +346,576 @@ class ServerRepository:
                                     Column('sent', Integer),
                                     Column('accepted', Integer)
                                     )
+        # таблица сообщений для пользователей, не подключённых к серверу
+        offline_messages_table = Table('offline_messages', self.metadata,
+                                       Column('id', Integer, primary_key=True),
+                                       Column('recipient', ForeignKey('users.id'), index=True),
+                                       Column('message', Text),
+                                       Column('created', DateTime, index=True)
+                                       )
+        # таблица архива пересылаемых сообщений
+        message_archive_table = Table('message_archive', self.metadata,
+                                      Column('id', Integer, primary_key=True),
+                                      Column('sender', ForeignKey('users.id'), index=True),
+                                      Column('recipient', ForeignKey('users.id'), index=True),
+                                      Column('created', DateTime, index=True),
+                                      Column('size', Integer),
+                                      Column('digest', String),
+                                      Column('text', Text)
+                                      )
         self.metadata.create_all(self.engine)
+        self.migrate()
+        # Признак полнотекстового индекса архива, без него поиск идёт через LIKE
+        self.full_text_search = self.create_full_text_search()
+
+        self.contacts_table = contacts
+        self.message_archive_table = message_archive_table
+
+        # Частые запросы, выполняемые в обход ORM. Запросы создаются один раз,
+        # а их скомпилированный SQL хранится в statement_cache.
+        self.statement_cache = dict()
+        self.select_user_record = select([users_table.c.id, users_table.c.passwd_hash, users_table.c.pubkey]). \
+            where(users_table.c.name == bindparam('b_name'))
+        self.update_last_login = users_table.update(). \
+            where(users_table.c.id == bindparam('b_id')). \
+            values(last_login=bindparam('b_date'), pubkey=bindparam('b_key'))
+        self.update_login_date = users_table.update(). \
+            where(users_table.c.id == bindparam('b_id')). \
+            values(last_login=bindparam('b_date'))
+        self.insert_active_user = active_users_table.insert(). \
+            values(user_id=bindparam('b_id'), ip_address=bindparam('b_ip'),
+                   port=bindparam('b_port'), login_date=bindparam('b_date'))
+        self.insert_login_history = history_user_table.insert(). \
+            values(name=bindparam('b_id'), ip_address=bindparam('b_ip'),
+                   port=bindparam('b_port'), date=bindparam('b_date'))
+        self.delete_active_user = active_users_table.delete(). \
+            where(active_users_table.c.user_id == bindparam('b_id'))
 
         # связывание таблицы и класса-отображения
         mapper(self.Users, users_table)
         mapper(self.ActiveUsers, active_users_table)
         mapper(self.HistoryUser, history_user_table)
+        mapper(self.HistoryUserDaily, history_user_daily_table)
         mapper(self.UsersContacts, contacts)
         mapper(self.UsersHistory, users_history_table)
+        mapper(self.OfflineMessages, offline_messages_table)
+        mapper(self.MessageArchive, message_archive_table)
+
+        # создание сессии: отдельной для каждого потока
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+
+        # Счётчики отправленных и принятых сообщений, ещё не записанные
+        # в таблицу History. Пишутся одной транзакцией методом flush_message_stats.
+        self.stats_lock = threading.Lock()
+        self.pending_sent = Counter()
+        self.pending_accepted = Counter()
+        self.pending_count = 0
+
+        # Счётчики, переданные потоку записи, но ещё не записанные
+        self.flushing_sent = Counter()
+        self.flushing_accepted = Counter()
+
+        # Записи архива сообщений, ещё не переданные потоку записи
+        self.pending_archive = []
+
+        # Кэш записей пользователей: имя -> UserRecord или None,
+        # если пользователь не зарегистрирован.
+        self.user_cache = LruCache(USER_CACHE_SIZE)
+
+        # Последнее изменение контактов пользователя: список контактов
+        # отдаётся только после его записи.
+        self.contact_writes = dict()
+
+        # Последнее изменение очереди сообщений пользователя: очередь
+        # читается только после его записи.
+        self.offline_writes = dict()
+
+        # Захвачена, пока идёт свёртка истории входов
+        self.compact_lock = threading.Lock()
 
-        # создание сессии
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+        # Захвачена, пока идёт удаление просроченных сообщений
+        self.expire_lock = threading.Lock()
 
         # когда устанавливается соединение, очищаем таблицу активных пользователей
         self.session.query(self.ActiveUsers).delete()
         self.session.commit()
 
+        # Поток записи изменений пачками
+        self.writer = WriteScheduler(self.session, write_window, write_batch)
+        self.writer.start()
+
+    def migrate(self):
+        """Метод применения к базе недостающих миграций схемы."""
+        with self.engine.begin() as connection:
+            version = connection.execute('PRAGMA user_version').scalar()
+            for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                for statement in statements:
+                    connection.execute(statement)
+                # PRAGMA не поддерживает параметры запроса
+                connection.execute(f'PRAGMA user_version = {number}')
+
+    def create_full_text_search(self):
+        """
+        Метод создания полнотекстового индекса архива. Если SQLite собран
+        без FTS5, индекс не создаётся. Возвращает признак наличия индекса.
+        """
+        try:
+            with self.engine.begin() as connection:
+                exists = connection.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'message_archive_fts'").first()
+                for statement in FULL_TEXT_SEARCH:
+                    connection.execute(statement)
+                if not exists:
+                    # В архиве уже могут быть сообщения
+                    connection.execute("INSERT INTO message_archive_fts (message_archive_fts) VALUES ('rebuild')")
+        except OperationalError as err:
+            SERVER_LOGGER.warning(f'Полнотекстовый поиск по архиву недоступен: {err}')
+            # Триггеры, оставшиеся от сборки с FTS5, мешали бы записи в архив
+            with self.engine.begin() as connection:
+                connection.execute('DROP TRIGGER IF EXISTS message_archive_insert')
+                connection.execute('DROP TRIGGER IF EXISTS message_archive_delete')
+            return False
+        return True
+
+    def execute_cached(self, statement, **params):
+        """Метод выполнения заранее созданного запроса в сессии текущего потока."""
+        connection = self.session.connection().execution_options(compiled_cache=self.statement_cache)
+        return connection.execute(statement, params)
+
+    def sync(self):
+        """Метод ожидания записи всех изменений, поставленных в очередь потока записи."""
+        self.writer.submit(lambda: None).result()
+
     # основные действия в БД
     def user_login(self, name, ip_address, port, key):
         """
         Запись в базу входа клиента.
+        Выполняется потоком записи, метод не ждёт её окончания.
+        """
+
+        def invalidate(future):
+            # Если ключ изменился, запись в кэше устарела
+            if not future.exception() and future.result():
+                self.user_cache.invalidate(name)
+
+        self.writer.submit(self.write_user_login, name, ip_address, port, key).add_done_callback(invalidate)
+
+    def write_user_login(self, name, ip_address, port, key):
+        """
+        Изменения базы при входе клиента, возвращает признак смены ключа.
+        Вход - самая частая запись, поэтому выполняется запросами Core
+        без загрузки объектов ORM.
         """
         # проверка пользователей на наличие там пользователя с таким именем
-        query_result = self.session.query(self.Users).filter_by(name=name)
-        # если имя пользователя есть, обновляется время последнего логина
-        if query_result.count():
-            user = query_result.first()
-            user.last_login = datetime.datetime.now()
-            if user.pubkey != key:
-                user.pubkey = key
-        # иначе исключение
-        else:
+        user = self.user_record(name)
+        if not user:
             raise ValueError('Пользователь не зарегистрирован.')
+        now = datetime.datetime.now()
 
-        # Теперь можно создать запись в таблицу активных пользователей
-        # создание экземпляра класса self.ActiveUsers, через который передаем данные в таблицу
-        new_active_user = self.ActiveUsers(user.id, ip_address, port, datetime.datetime.now())
-        self.session.add(new_active_user)
+        # обновляется время последнего логина и, если передан и изменился, ключ
+        key_changed = key is not None and user.pubkey != key
+        if key_changed:
+            self.execute_cached(self.update_last_login, b_id=user.id, b_date=now, b_key=key)
+        else:
+            self.execute_cached(self.update_login_date, b_id=user.id, b_date=now)
 
-        # Внесение записи в историю входов
-        # Создаем экземпляр класса self.LoginHistory, через который передаем данные в таблицу
-        history = self.HistoryUser(user.id, datetime.datetime.now(), ip_address, port)
-        self.session.add(history)
-
-        # сохранение изменений
-        self.session.commit()
+        # запись в таблицу активных пользователей и в историю входов
+        self.execute_cached(self.insert_active_user, b_id=user.id, b_ip=ip_address, b_port=port, b_date=now)
+        self.execute_cached(self.insert_login_history, b_id=user.id, b_ip=ip_address, b_port=port, b_date=now)
+        return key_changed
 
     def add_user(self, name, passwd_hash):
         """
         Метод регистрации пользователя.
         Принимает имя и хэш пароля, создаёт запись в таблице статистики.
+        Ждёт окончания записи.
         """
+        self.writer.submit(self.write_add_user, name, passwd_hash).result()
+        self.user_cache.invalidate(name)
+
+    def write_add_user(self, name, passwd_hash):
+        """Изменения базы при регистрации пользователя."""
         user_row = self.Users(name, passwd_hash)
         self.session.add(user_row)
-        self.session.commit()
+        # id пользователя нужен для записи статистики
+        self.session.flush()
         history_row = self.UsersHistory(user_row.id)
         self.session.add(history_row)
-        self.session.commit()
 
     def remove_user(self, name):
         """
         Метод удаляющий пользователя из базы.
+        Ждёт окончания записи.
         """
+        self.writer.submit(self.write_remove_user, name).result()
+        self.user_cache.invalidate(name)
+        with self.stats_lock:
+            self.pending_sent.pop(name, None)
+            self.pending_accepted.pop(name, None)
+
+    def write_remove_user(self, name):
+        """Изменения базы при удалении пользователя."""
         user = self.session.query(self.Users).filter_by(name=name).first()
         self.session.query(self.ActiveUsers).filter_by(user_id=user.id).delete()
         self.session.query(self.HistoryUser).filter_by(name=user.id).delete()
+        self.session.query(self.HistoryUserDaily).filter_by(user=user.id).delete()
         self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
         self.session.query(self.UsersContacts).filter_by(
             contact=user.id).delete()
         self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
+        self.session.query(self.OfflineMessages).filter_by(recipient=user.id).delete()
+        self.session.query(self.MessageArchive).filter(
+            (self.MessageArchive.sender == user.id) | (self.MessageArchive.recipient == user.id)).delete()
         self.session.query(self.Users).filter_by(name=name).delete()
-        self.session.commit()
+
+    def user_record(self, name):
+        """
+        Метод получения id, хэша пароля и публичного ключа пользователя.
+        Возвращает UserRecord или None, если пользователь не зарегистрирован.
+        Результат берётся из кэша.
+        """
+        return self.user_cache.get(name, self.load_user_record)
+
+    @read_method
+    def load_user_record(self, name):
+        """Метод чтения записи пользователя из базы в обход кэша."""
+        row = self.execute_cached(self.select_user_record, b_name=name).first()
+        return UserRecord(*row) if row else None
+
+    def cache_stats(self):
+        """Метод возвращает статистику кэша пользователей."""
+        return self.user_cache.stats()
 
     def get_hash(self, name):
         """
         Метод получения хэша пароля пользователя.
+        Для незарегистрированного пользователя возвращает None.
         """
-        user = self.session.query(self.Users).filter_by(name=name).first()
-        return user.passwd_hash
+        user = self.user_record(name)
+        return user.passwd_hash if user else None
 
     def get_pubkey(self, name):
         """
         Метод получения публичного ключа пользователя.
+        Для незарегистрированного пользователя возвращает None.
         """
-        user = self.session.query(self.Users).filter_by(name=name).first()
-        return user.pubkey
+        user = self.user_record(name)
+        return user.pubkey if user else None
 
     def check_user(self, name):
         """
         Метод проверяющий существование пользователя.
         """
-        if self.session.query(self.Users).filter_by(name=name).count():
-            return True
-        else:
-            return False
+        return self.user_record(name) is not None
 
     def user_logout(self, name):
         """
         фиксация отключения пользователя
+        Выполняется потоком записи, метод не ждёт её окончания.
         """
-        # получаем запись из таблицы Users пользователя, что покидает нас
-        user = self.session.query(self.Users).filter_by(name=name).first()
+        self.writer.submit(self.write_user_logout, name)
 
-        # Удаляем запись из таблицы ActiveUsers
-        self.session.query(self.ActiveUsers).filter_by(user_id=user.id).delete()
+    def write_user_logout(self, name):
+        """Изменения базы при отключении пользователя."""
+        # получаем запись пользователя, что покидает нас
+        user = self.user_record(name)
+        # Пользователь мог быть удалён администратором до отключения
+        if not user:
+            return
 
-        self.session.commit()
+        # Удаляем запись из таблицы ActiveUsers
+        self.execute_cached(self.delete_active_user, b_id=user.id)
 
-    # Фиксация передачи сообщения с соответсвующими отметками в БД
     def process_message(self, sender, recipient):
-        # ID отправителя и получателя
-        sender = self.session.query(self.Users).filter_by(name=sender).first().id
-        recipient = self.session.query(self.Users).filter_by(name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = self.session.query(self.UsersHistory).filter_by(user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(self.UsersHistory).filter_by(user=recipient).first()
-        recipient_row.accepted += 1
+        """
+        Фиксация передачи сообщения.
+        Счётчики накапливаются в памяти и записываются в базу пачкой
+        после STATS_FLUSH_COUNT сообщений или при вызове flush_message_stats.
+        """
+        with self.stats_lock:
+            self.pending_sent[sender] += 1
+            self.pending_accepted[recipient] += 1
+            self.pending_count += 1
+            full = self.pending_count >= STATS_FLUSH_COUNT
+        if full:
+            self.flush_message_stats()
 
-        self.session.commit()
+    def add_message_stats(self, sent, accepted):
+        """
+        Фиксация пачки переданных сообщений, накопленной процессом-обработчиком.
+        Счётчики добавляются к накопленным в памяти.
+        """
+        with self.stats_lock:
+            self.pending_sent.update(sent)
+            self.pending_accepted.update(accepted)
+            self.pending_count += sum(sent.values())
+            full = self.pending_count >= STATS_FLUSH_COUNT
+        if full:
+            self.flush_message_stats()
+
+    def flush_message_stats(self):
+        """
+        Метод передачи накопленных счётчиков сообщений и записей архива
+        потоку записи. До окончания записи счётчики учитываются в message_history.
+        """
+        self.flush_archive()
+        with self.stats_lock:
+            if not self.pending_count:
+                return
+            sent, accepted = self.pending_sent, self.pending_accepted
+            self.pending_sent, self.pending_accepted = Counter(), Counter()
+            self.pending_count = 0
+            self.flushing_sent.update(sent)
+            self.flushing_accepted.update(accepted)
+
+        def forget(future):
+            with self.stats_lock:
+                self.flushing_sent.subtract(sent)
+                self.flushing_accepted.subtract(accepted)
+
+        self.writer.submit(self.write_message_stats, sent, accepted).add_done_callback(forget)
+
+    def write_message_stats(self, sent, accepted):
+        """Изменения таблицы History: прибавление счётчиков сообщений."""
+        # Пользователи, удалённые до записи, в выборку не попадут.
+        rows = self.session.query(self.Users.name, self.UsersHistory). \
+            join(self.UsersHistory, self.UsersHistory.user == self.Users.id). \
+            filter(self.Users.name.in_(set(sent) | set(accepted)))
+        for name, row in rows:
+            row.sent += sent[name]
+            row.accepted += accepted[name]
+
+    def archive_message(self, sender, recipient, size, digest, text=None):
+        """
+        Метод записи сообщения в архив.
+        Записи накапливаются в памяти и передаются потоку записи пачкой
+        после STATS_FLUSH_COUNT сообщений или при вызове flush_message_stats.
+        """
+        with self.stats_lock:
+            self.pending_archive.append((sender, recipient, datetime.datetime.now(), size, digest, text))
+            full = len(self.pending_archive) >= STATS_FLUSH_COUNT
+        if full:
+            self.flush_archive()
+
+    def archive_messages(self, records):
+        """Метод записи в архив пачки сообщений, накопленной процессом-обработчиком."""
+        with self.stats_lock:
+            self.pending_archive.extend(records)
+            full = len(self.pending_archive) >= STATS_FLUSH_COUNT
+        if full:
+            self.flush_archive()
+
+    def flush_archive(self):
+        """Метод передачи накопленных записей архива потоку записи."""
+        with self.stats_lock:
+            if not self.pending_archive:
+                return
+            records, self.pending_archive = self.pending_archive, []
+        self.writer.submit(self.write_archive, records)
+
+    def write_archive(self, records):
+        """Изменения базы при записи пачки архива одним запросом."""
+        rows = []
+        for sender, recipient, created, size, digest, message_text in records:
+            sender = self.user_record(sender)
+            recipient = self.user_record(recipient)
+            # Сообщения пользователей, удалённых до записи, не архивируются.
+            if sender and recipient:
+                rows.append({'sender': sender.id, 'recipient': recipient.id, 'created': created,
+                             'size': size, 'digest': digest, 'text': message_text})
+        if rows:
+            self.session.execute(self.message_archive_table.insert(), rows)
+
+    @read_method
+    def archive_page(self, sender=None, recipient=None, query=None, since=None, until=None,
+                     before=None, limit=ARCHIVE_PAGE_SIZE):
+        """
+        Страница архива сообщений, новые первыми.
+        Слова query ищутся полнотекстовым индексом как фраза (без индекса -
+        как подстрока), страницы выбираются по id (before), без OFFSET.
+        """
+        sender_user = aliased(self.Users)
+        recipient_user = aliased(self.Users)
+        archive = self.MessageArchive
+        result = self.session.query(archive.id, sender_user.name, recipient_user.name,
+                                    archive.created, archive.size, archive.digest, archive.text). \
+            join(sender_user, archive.sender == sender_user.id). \
+            join(recipient_user, archive.recipient == recipient_user.id)
+        if sender:
+            result = result.filter(sender_user.name == sender)
+        if recipient:
+            result = result.filter(recipient_user.name == recipient)
+        if since:
+            result = result.filter(archive.created >= since)
+        if until:
+            result = result.filter(archive.created < until)
+        if before:
+            result = result.filter(archive.id < before)
+        if query and self.full_text_search:
+            # Кавычки делают из запроса фразу, спецсимволы FTS5 не разбираются
+            phrase = '"' + query.replace('"', '""') + '"'
+            result = result.filter(text(
+                'message_archive.id IN (SELECT rowid FROM message_archive_fts '
+                'WHERE message_archive_fts MATCH :phrase)')).params(phrase=phrase)
+        elif query:
+            result = result.filter(archive.text.contains(query, autoescape=True))
+        result = result.order_by(archive.id.desc()).limit(limit)
+        return [ArchiveRecord(*row) for row in result.all()]
+
+    def store_message(self, recipient, message):
+        """
+        Метод сохранения сообщения для пользователя, не подключённого к серверу.
+        Сообщение хранится целиком, текст остаётся зашифрованным ключом получателя.
+        Выполняется потоком записи, метод не ждёт её окончания.
+        """
+        self.offline_writes[recipient] = self.writer.submit(
+            self.write_store_message, recipient, json.dumps(message), datetime.datetime.now())
+
+    def write_store_message(self, recipient, message, created):
+        """Изменения базы при сохранении сообщения для отключённого пользователя."""
+        user = self.user_record(recipient)
+        # Пользователь мог быть удалён администратором до записи
+        if user:
+            self.session.add(self.OfflineMessages(user.id, message, created))
+
+    def wait_offline_writes(self, name):
+        """Метод ожидания записи изменений очереди сообщений пользователя."""
+        pending = self.offline_writes.pop(name, None)
+        if pending:
+            pending.exception()
+
+    def pop_offline_messages(self, name, limit):
+        """
+        Метод выборки не более limit ожидающих сообщений пользователя
+        в порядке поступления. Выбранные сообщения удаляются из очереди.
+        """
+        self.wait_offline_writes(name)
+        return self.writer.submit(self.write_pop_offline_messages, name, limit).result()
+
+    def write_pop_offline_messages(self, name, limit):
+        """Изменения базы при выборке сообщений с удалением."""
+        user = self.user_record(name)
+        rows = self.session.query(self.OfflineMessages.id, self.OfflineMessages.message). \
+            filter_by(recipient=user.id). \
+            order_by(self.OfflineMessages.id). \
+            limit(limit).all()
+        if rows:
+            self.session.query(self.OfflineMessages). \
+                filter(self.OfflineMessages.id.in_([row.id for row in rows])). \
+                delete(synchronize_session=False)
+        return [json.loads(row.message) for row in rows]
+
+    @read_method
+    def peek_offline_messages(self, name, limit, after=None):
+        """
+        Метод выборки без удаления не более limit ожидающих сообщений
+        пользователя, следующих за позицией after. Позиция - id записи.
+        """
+        self.wait_offline_writes(name)
+        user = self.user_record(name)
+        rows = self.session.query(self.OfflineMessages.id, self.OfflineMessages.message). \
+            filter_by(recipient=user.id)
+        if after is not None:
+            rows = rows.filter(self.OfflineMessages.id > after)
+        rows = rows.order_by(self.OfflineMessages.id).limit(limit).all()
+        return [(row.id, json.loads(row.message)) for row in rows]
+
+    def ack_offline_messages(self, name, position):
+        """
+        Метод удаления доставленных сообщений пользователя до позиции position включительно.
+        Выполняется потоком записи, метод не ждёт её окончания.
+        """
+        self.offline_writes[name] = self.writer.submit(self.write_ack_offline_messages, name, position)
+
+    def write_ack_offline_messages(self, name, position):
+        """Изменения базы при подтверждении доставки сообщений."""
+        user = self.user_record(name)
+        if user:
+            self.session.query(self.OfflineMessages). \
+                filter(self.OfflineMessages.recipient == user.id, self.OfflineMessages.id <= position). \
+                delete(synchronize_session=False)
 
-    # Добавление контакта для пользователя
+    def remove_expired_messages(self, ttl, chunk=OFFLINE_EXPIRE_CHUNK):
+        """
+        Метод запуска удаления сообщений, ожидающих доставки дольше ttl секунд.
+        Сообщения удаляются потоком записи пачками по chunk, как при свёртке
+        истории входов. Метод не ждёт окончания и возвращает None, число
+        удалённых сообщений записывается в лог. Повторный вызов во время
+        удаления игнорируется.
+        """
+        if not self.expire_lock.acquire(blocking=False):
+            return None
+        border = datetime.datetime.now() - datetime.timedelta(seconds=ttl)
+        self.submit_expire_step(border, chunk, 0)
+        return None
+
+    def submit_expire_step(self, border, chunk, removed):
+        """Метод постановки в очередь потока записи следующей пачки удаления."""
+
+        def next_step(future):
+            if not future.exception() and future.result() == chunk:
+                self.submit_expire_step(border, chunk, removed + chunk)
+                return
+            if not future.exception():
+                count = removed + future.result()
+                if count:
+                    SERVER_LOGGER.info(f'Удалено просроченных сообщений из очереди: {count}.')
+            self.expire_lock.release()
+
+        self.writer.submit(self.write_expired_messages, border, chunk).add_done_callback(next_step)
+
+    def write_expired_messages(self, border, chunk):
+        """
+        Изменения базы при удалении пачки просроченных сообщений.
+        Возвращает число удалённых сообщений.
+        """
+        ids = [row.id for row in self.session.query(self.OfflineMessages.id).
+               filter(self.OfflineMessages.created < border).
+               order_by(self.OfflineMessages.id).
+               limit(chunk)]
+        if ids:
+            self.session.query(self.OfflineMessages). \
+                filter(self.OfflineMessages.id.in_(ids)). \
+                delete(synchronize_session=False)
+        return len(ids)
+
+    # Добавление контакта для пользователя, выполняется потоком записи
     def add_contact(self, user, contact):
+        self.contact_writes[user] = self.writer.submit(self.write_add_contact, user, contact)
+
+    def write_add_contact(self, user, contact):
         # ID пользователей
-        user = self.session.query(self.Users).filter_by(name=user).first()
-        contact = self.session.query(self.Users).filter_by(name=contact).first()
+        user = self.user_record(user)
+        contact = self.user_record(contact)
 
-        # проверка, что не дубль, и что контакт может существовать (полю пользователь мы доверяем)
-        if not contact or self.session.query(self.UsersContacts).filter_by(user=user.id,
-                                                                           contact=contact.id).count():
+        # проверка, что контакт может существовать (полю пользователь мы доверяем)
+        if not contact:
             return
 
-        # создание объекта и внесение его в базу
-        contact_row = self.UsersContacts(user.id, contact.id)
-        self.session.add(contact_row)
-        self.session.commit()
+        # дубль отбрасывает уникальный индекс пары пользователь - контакт
+        self.session.execute(self.contacts_table.insert().prefix_with('OR IGNORE'),
+                             {'user': user.id, 'contact': contact.id})
 
-    # Функция удаляет контакт из базы данных
+    # Функция удаляет контакт из базы данных, выполняется потоком записи
     def remove_contact(self, user, contact):
+        self.contact_writes[user] = self.writer.submit(self.write_remove_contact, user, contact)
+
+    def write_remove_contact(self, user, contact):
         # ID пользователей
-        user = self.session.query(self.Users).filter_by(name=user).first()
-        contact = self.session.query(self.Users).filter_by(name=contact).first()
+        user = self.user_record(user)
+        contact = self.user_record(contact)
 
         # проверка, что контакт может существовать
         if not contact:
             return
 
         # Удаляем требуемое
-        print(self.session.query(self.UsersContacts).filter(
+        self.session.query(self.UsersContacts).filter(
             self.UsersContacts.user == user.id,
             self.UsersContacts.contact == contact.id
-        ).delete())
-        self.session.commit()
+        ).delete()
 
+    @read_method
     def users_list(self):
         """
         Список всех известных пользователей и время последнего входа.
@@ -261,6 +924,7 @@ class ServerRepository:
         # Возвращаем список кортежей
         return query_lst.all()
 
+    @read_method
     def active_users_list(self):
         """
         Список активных пользователей.
@@ -275,6 +939,7 @@ class ServerRepository:
 
         return query.all()
 
+    @read_method
     def user_history(self, name=None):
         """
         История входов по пользователю или всем пользователям.
@@ -290,11 +955,76 @@ class ServerRepository:
             query = query.filter(self.Users.name == name)
         return query.all()
 
-        # функция возвращает список контактов пользователя.
+    @read_method
+    def user_history_daily(self, name=None):
+        """
+        Свёрнутая по суткам история входов по пользователю или всем пользователям.
+        """
+        query = self.session.query(self.Users.name,
+                                   self.HistoryUserDaily.day,
+                                   self.HistoryUserDaily.logins
+                                   ).join(self.Users).order_by(self.HistoryUserDaily.day)
+        if name:
+            query = query.filter(self.Users.name == name)
+        return query.all()
+
+    def compact_history(self, retention, chunk=HISTORY_COMPACT_CHUNK):
+        """
+        Метод запуска свёртки истории входов старше retention дней.
+        Каждая пачка из chunk записей выполняется потоком записи отдельным
+        изменением, следующая ставится в очередь после фиксации предыдущей,
+        поэтому входы пользователей не ждут окончания всей свёртки.
+        Метод не ждёт окончания, повторный вызов во время свёртки игнорируется.
+        """
+        if not self.compact_lock.acquire(blocking=False):
+            return
+        self.submit_compact_step(history_border(retention), chunk)
+
+    def submit_compact_step(self, border, chunk):
+        """Метод постановки в очередь потока записи следующей пачки свёртки."""
+
+        def next_step(future):
+            if not future.exception() and future.result() == chunk:
+                self.submit_compact_step(border, chunk)
+            else:
+                self.compact_lock.release()
+
+        self.writer.submit(self.write_compact_history, border, chunk).add_done_callback(next_step)
 
+    def write_compact_history(self, border, chunk):
+        """
+        Изменения базы при свёртке пачки истории входов: самые старые записи
+        до border прибавляются к суточным итогам и удаляются.
+        Возвращает число обработанных записей.
+        """
+        rows = self.session.query(self.HistoryUser.id, self.HistoryUser.name, self.HistoryUser.date). \
+            filter(self.HistoryUser.date < border). \
+            order_by(self.HistoryUser.date). \
+            limit(chunk).all()
+        logins = Counter((row.name, row.date.date()) for row in rows)
+        for (user, day), count in logins.items():
+            updated = self.session.query(self.HistoryUserDaily). \
+                filter_by(user=user, day=day). \
+                update({self.HistoryUserDaily.logins: self.HistoryUserDaily.logins + count},
+                       synchronize_session=False)
+            if not updated:
+                self.session.add(self.HistoryUserDaily(user, day, count))
+        if rows:
+            self.session.query(self.HistoryUser). \
+                filter(self.HistoryUser.id.in_([row.id for row in rows])). \
+                delete(synchronize_session=False)
+        return len(rows)
+
+    # функция возвращает список контактов пользователя.
+    @read_method
     def get_contacts(self, name):
+        # Дожидаемся записи последнего изменения контактов пользователя
+        pending = self.contact_writes.pop(name, None)
+        if pending:
+            pending.exception()
+
         # Запрашивааем указанного пользователя
-        user = self.session.query(self.Users).filter_by(name=name).one()
+        user = self.user_record(name)
 
         # Запрашиваем его список контактов
         query = self.session.query(self.UsersContacts, self.Users.name). \
@@ -304,7 +1034,51 @@ class ServerRepository:
         # выбираем только имена пользователей и возвращаем их.
         return [contact[1] for contact in query.all()]
 
+    @read_method
+    def message_history_page(self, order='name', descending=False, prefix=None, after=None,
+                             limit=STAT_PAGE_SIZE):
+        """
+        Страница статистики сообщений пользователей.
+        Страницы выбираются по ключу (after) без OFFSET, порядок каждого
+        столбца поддерживается индексом, поэтому время запроса страницы
+        не зависит от числа пользователей. Ещё не записанные счётчики
+        добавляются к показываемым значениям, но на порядок не влияют:
+        ключ страницы строится по записанным (stored_sent, stored_accepted).
+        """
+        key = {
+            'name': (self.Users.name, self.Users.id),
+            'last_login': (self.Users.last_login, self.Users.id),
+            'sent': (self.UsersHistory.sent, self.UsersHistory.user),
+            'accepted': (self.UsersHistory.accepted, self.UsersHistory.user),
+        }[order]
+        query = self.session.query(
+            self.Users.id,
+            self.Users.name,
+            self.Users.last_login,
+            self.UsersHistory.sent,
+            self.UsersHistory.accepted
+        ).join(self.UsersHistory, self.UsersHistory.user == self.Users.id)
+        if prefix:
+            # Диапазон вместо LIKE, чтобы использовался индекс по имени
+            query = query.filter(self.Users.name >= prefix,
+                                 self.Users.name < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        if after:
+            bound = tuple_(*key)
+            query = query.filter(bound < tuple_(*after) if descending else bound > tuple_(*after))
+        if descending:
+            query = query.order_by(*[column.desc() for column in key])
+        else:
+            query = query.order_by(*key)
+        rows = query.limit(limit).all()
+        with self.stats_lock:
+            return [UserStats(user_id, name, last_login,
+                              sent + self.pending_sent[name] + self.flushing_sent[name],
+                              accepted + self.pending_accepted[name] + self.flushing_accepted[name],
+                              sent, accepted)
+                    for user_id, name, last_login, sent, accepted in rows]
+
     # Функция возвращает количество переданных и полученных сообщений
+    @read_method
     def message_history(self):
         query = self.session.query(
             self.Users.name,
@@ -312,8 +1086,12 @@ class ServerRepository:
             self.UsersHistory.sent,
             self.UsersHistory.accepted
         ).join(self.Users)
-        # Возвращаем список кортежей
-        return query.all()
+        # Добавляем к записанным в базу счётчикам ещё не записанные.
+        with self.stats_lock:
+            return [(name, last_login,
+                     sent + self.pending_sent[name] + self.flushing_sent[name],
+                     accepted + self.pending_accepted[name] + self.flushing_accepted[name])
+                    for name, last_login, sent, accepted in query.all()]
 
 
 # отладка
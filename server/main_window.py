@@ -1,7 +1,7 @@
 from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QApplication, QLabel, QTableView
-from PyQt5.QtGui import QStandardItemModel, QStandardItem
-from PyQt5.QtCore import QTimer
+from server.users_model import ActiveUsersModel
 from server.stat_window import StatWindow
+from server.archive_window import ArchiveWindow
 from server.config_window import ConfigWindow
 from server.add_user import RegisterUser
 from server.remove_user import DelUserDialog
@@ -41,6 +41,9 @@ class MainWindow(QMainWindow):
         # Кнопка вывести историю сообщений
         self.show_history_button = QAction('История клиентов', self)
 
+        # Кнопка поиска по архиву сообщений
+        self.show_archive_button = QAction('Архив сообщений', self)
+
         # Статусбар
         self.statusBar()
         self.statusBar().showMessage('Server Working')
@@ -50,6 +53,7 @@ class MainWindow(QMainWindow):
         self.toolbar.addAction(self.exitAction)
         self.toolbar.addAction(self.refresh_button)
         self.toolbar.addAction(self.show_history_button)
+        self.toolbar.addAction(self.show_archive_button)
         self.toolbar.addAction(self.config_btn)
         self.toolbar.addAction(self.register_btn)
         self.toolbar.addAction(self.remove_btn)
@@ -70,14 +74,16 @@ class MainWindow(QMainWindow):
         self.active_clients_table.move(10, 45)
         self.active_clients_table.setFixedSize(780, 400)
 
-        # Таймер, обновляющий список клиентов 1 раз в секунду
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.create_users_model)
-        self.timer.start(1000)
+        # Модель списка клиентов обновляется по событиям входа и выхода от сервера
+        self.users_model = ActiveUsersModel(self.database)
+        self.server_thread.add_user_listener(self.users_model)
+        self.active_clients_table.setModel(self.users_model)
+        self.create_users_model()
 
         # Связываем кнопки с процедурами
         self.refresh_button.triggered.connect(self.create_users_model)
         self.show_history_button.triggered.connect(self.show_statistics)
+        self.show_archive_button.triggered.connect(self.show_archive)
         self.config_btn.triggered.connect(self.server_config)
         self.register_btn.triggered.connect(self.reg_user)
         self.remove_btn.triggered.connect(self.rem_user)
@@ -86,25 +92,8 @@ class MainWindow(QMainWindow):
         self.show()
 
     def create_users_model(self):
-        """Метод заполняющий таблицу активных пользователей."""
-        list_users = self.database.active_users_list()
-        list = QStandardItemModel()
-        list.setHorizontalHeaderLabels(
-            ['Имя Клиента', 'IP Адрес', 'Порт', 'Время подключения'])
-        for row in list_users:
-            user, ip, port, time = row
-            user = QStandardItem(user)
-            user.setEditable(False)
-            ip = QStandardItem(ip)
-            ip.setEditable(False)
-            port = QStandardItem(str(port))
-            port.setEditable(False)
-            # Уберём милисекунды из строки времени, т.к. такая точность не
-            # требуется.
-            time = QStandardItem(str(time.replace(microsecond=0)))
-            time.setEditable(False)
-            list.appendRow([user, ip, port, time])
-        self.active_clients_table.setModel(list)
+        """Метод полного перечитывания таблицы активных пользователей из базы."""
+        self.users_model.reload()
         self.active_clients_table.resizeColumnsToContents()
         self.active_clients_table.resizeRowsToContents()
 
@@ -115,6 +104,13 @@ class MainWindow(QMainWindow):
         stat_window = StatWindow(self.database)
         stat_window.show()
 
+    # noinspection PyGlobalUndefined
+    def show_archive(self):
+        """Метод создающий окно поиска по архиву сообщений."""
+        global archive_window
+        archive_window = ArchiveWindow(self.database)
+        archive_window.show()
+
     # noinspection PyGlobalUndefined
     def server_config(self):
         """Метод создающий окно с настройками сервера."""
@@ -0,0 +1,232 @@
+import datetime
+import itertools
+import threading
+from collections import Counter, deque
+
+from base.variables import HISTORY_COMPACT_CHUNK, ARCHIVE_PAGE_SIZE, STAT_PAGE_SIZE
+from server.repository import Repository, ArchiveRecord, UserStats, history_border, stats_key
+
+
+class MemoryRepository(Repository):
+    """
+    Класс - хранилище данных сервера в памяти на словарях и множествах.
+    Данные теряются при остановке сервера. Подходит для бенчмарков,
+    нагрузочных тестов и серверов, только пересылающих сообщения.
+    """
+
+    class User:
+        def __init__(self, user_id, name, passwd_hash):
+            self.id = user_id
+            self.name = name
+            self.last_login = datetime.datetime.now()
+            self.passwd_hash = passwd_hash
+            self.pubkey = None
+            # Статистика сообщений
+            self.sent = 0
+            self.accepted = 0
+            # Имена контактов
+            self.contacts = set()
+            # Ожидающие доставки сообщения: (позиция, время поступления, сообщение)
+            self.offline = deque()
+
+    def __init__(self):
+        # Методы вызываются из потока сервера и из графической оболочки
+        self.lock = threading.RLock()
+
+        # Зарегистрированные пользователи: имя -> User
+        self.users = dict()
+        self.user_ids = itertools.count(1)
+
+        # Подключённые пользователи: имя -> (адрес, порт, время входа)
+        self.active_users = dict()
+
+        # История входов: кортежи (имя, время, адрес, порт) в порядке входа
+        self.history = deque()
+
+        # Свёрнутая история входов: (имя, день) -> число входов
+        self.daily_logins = Counter()
+
+        # Архив сообщений: список ArchiveRecord в порядке записи
+        self.archive = list()
+        self.archive_ids = itertools.count(1)
+
+        # Позиции ожидающих доставки сообщений, общие для всех очередей
+        self.offline_ids = itertools.count(1)
+
+    def user_login(self, name, ip_address, port, key):
+        with self.lock:
+            user = self.users.get(name)
+            if not user:
+                raise ValueError('Пользователь не зарегистрирован.')
+            now = datetime.datetime.now()
+            user.last_login = now
+            if key is not None:
+                user.pubkey = key
+            self.active_users[name] = (ip_address, port, now)
+            self.history.append((name, now, ip_address, port))
+
+    def user_logout(self, name):
+        with self.lock:
+            self.active_users.pop(name, None)
+
+    def add_user(self, name, passwd_hash):
+        with self.lock:
+            if name in self.users:
+                raise ValueError('Пользователь уже существует.')
+            self.users[name] = self.User(next(self.user_ids), name, passwd_hash)
+
+    def remove_user(self, name):
+        with self.lock:
+            del self.users[name]
+            self.active_users.pop(name, None)
+            self.history = deque(row for row in self.history if row[0] != name)
+            for key in [key for key in self.daily_logins if key[0] == name]:
+                del self.daily_logins[key]
+            self.archive = [record for record in self.archive if name not in (record.sender, record.recipient)]
+            for user in self.users.values():
+                user.contacts.discard(name)
+
+    def check_user(self, name):
+        return name in self.users
+
+    def get_hash(self, name):
+        user = self.users.get(name)
+        return user.passwd_hash if user else None
+
+    def get_pubkey(self, name):
+        user = self.users.get(name)
+        return user.pubkey if user else None
+
+    def process_message(self, sender, recipient):
+        with self.lock:
+            self.users[sender].sent += 1
+            self.users[recipient].accepted += 1
+
+    def add_message_stats(self, sent, accepted):
+        with self.lock:
+            # Пользователи могли быть удалены, пока копилась статистика
+            for name, count in sent.items():
+                if name in self.users:
+                    self.users[name].sent += count
+            for name, count in accepted.items():
+                if name in self.users:
+                    self.users[name].accepted += count
+
+    def archive_message(self, sender, recipient, size, digest, text=None):
+        self.archive_messages([(sender, recipient, datetime.datetime.now(), size, digest, text)])
+
+    def archive_messages(self, records):
+        with self.lock:
+            for sender, recipient, created, size, digest, text in records:
+                self.archive.append(ArchiveRecord(next(self.archive_ids), sender, recipient, created,
+                                                  size, digest, text))
+
+    def archive_page(self, sender=None, recipient=None, query=None, since=None, until=None,
+                     before=None, limit=ARCHIVE_PAGE_SIZE):
+        query = query.casefold() if query else None
+        page = []
+        with self.lock:
+            for record in reversed(self.archive):
+                if len(page) >= limit:
+                    break
+                if (before and record.id >= before) or (sender and record.sender != sender) \
+                        or (recipient and record.recipient != recipient) \
+                        or (since and record.created < since) or (until and record.created >= until) \
+                        or (query and query not in (record.text or '').casefold()):
+                    continue
+                page.append(record)
+        return page
+
+    def store_message(self, recipient, message):
+        with self.lock:
+            self.users[recipient].offline.append((next(self.offline_ids), datetime.datetime.now(), message))
+
+    def pop_offline_messages(self, name, limit):
+        with self.lock:
+            offline = self.users[name].offline
+            return [offline.popleft()[2] for _ in range(min(limit, len(offline)))]
+
+    def peek_offline_messages(self, name, limit, after=None):
+        with self.lock:
+            offline = self.users[name].offline
+            return [(position, message) for position, _, message in
+                    itertools.islice((item for item in offline if after is None or item[0] > after), limit)]
+
+    def ack_offline_messages(self, name, position):
+        with self.lock:
+            offline = self.users[name].offline
+            while offline and offline[0][0] <= position:
+                offline.popleft()
+
+    def remove_expired_messages(self, ttl):
+        border = datetime.datetime.now() - datetime.timedelta(seconds=ttl)
+        count = 0
+        with self.lock:
+            for user in self.users.values():
+                # Сообщения в очереди упорядочены по времени поступления
+                while user.offline and user.offline[0][1] < border:
+                    user.offline.popleft()
+                    count += 1
+        return count
+
+    def add_contact(self, user, contact):
+        with self.lock:
+            if contact in self.users:
+                self.users[user].contacts.add(contact)
+
+    def remove_contact(self, user, contact):
+        with self.lock:
+            self.users[user].contacts.discard(contact)
+
+    def get_contacts(self, name):
+        with self.lock:
+            return list(self.users[name].contacts)
+
+    def users_list(self):
+        with self.lock:
+            return [(user.name, user.last_login) for user in self.users.values()]
+
+    def active_users_list(self):
+        with self.lock:
+            return [(name, ip_address, port, login_date)
+                    for name, (ip_address, port, login_date) in self.active_users.items()]
+
+    def user_history(self, name=None):
+        with self.lock:
+            if name:
+                return [row for row in self.history if row[0] == name]
+            return list(self.history)
+
+    def user_history_daily(self, name=None):
+        with self.lock:
+            return sorted((user, day, logins) for (user, day), logins in self.daily_logins.items()
+                          if not name or user == name)
+
+    def compact_history(self, retention, chunk=HISTORY_COMPACT_CHUNK):
+        border = history_border(retention)
+        while True:
+            # Блокировка отпускается между пачками
+            with self.lock:
+                count = 0
+                while count < chunk and self.history and self.history[0][1] < border:
+                    name, date, *_ = self.history.popleft()
+                    self.daily_logins[(name, date.date())] += 1
+                    count += 1
+            if count < chunk:
+                return
+
+    def message_history_page(self, order='name', descending=False, prefix=None, after=None,
+                             limit=STAT_PAGE_SIZE):
+        with self.lock:
+            rows = [UserStats(user.id, user.name, user.last_login, user.sent, user.accepted,
+                              user.sent, user.accepted)
+                    for user in self.users.values() if not prefix or user.name.startswith(prefix)]
+        rows.sort(key=lambda row: stats_key(row, order), reverse=descending)
+        if after:
+            rows = [row for row in rows
+                    if (stats_key(row, order) < tuple(after) if descending else stats_key(row, order) > tuple(after))]
+        return rows[:limit]
+
+    def message_history(self):
+        with self.lock:
+            return [(user.name, user.last_login, user.sent, user.accepted) for user in self.users.values()]
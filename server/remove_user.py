@@ -46,11 +46,10 @@ class DelUserDialog(QDialog):
 
     def remove_user(self):
         """Метод - обработчик удаления пользователя."""
-        self.database.remove_user(self.selector.currentText())
+        # Сначала отключаем пользователя, затем удаляем его из базы.
         if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
+            self.server.remove_client(self.server.names[self.selector.currentText()])
+        self.database.remove_user(self.selector.currentText())
         # Рассылаем клиентам сообщение о необходимости обновить справочники
         self.server.service_update_lists()
         self.close()
@@ -0,0 +1,229 @@
+import datetime
+import os
+from abc import ABC, abstractmethod
+from collections import namedtuple
+
+from base.variables import HISTORY_COMPACT_CHUNK, ARCHIVE_PAGE_SIZE, STAT_PAGE_SIZE
+from base.utils import encode_message
+
+# Запись архива сообщений
+ArchiveRecord = namedtuple('ArchiveRecord', 'id sender recipient created size digest text')
+
+# Строка статистики сообщений пользователя. sent и accepted - показываемые
+# счётчики вместе с ещё не записанными, stored_sent и stored_accepted -
+# записанные в хранилище, по ним упорядочиваются страницы.
+UserStats = namedtuple('UserStats', 'id name last_login sent accepted stored_sent stored_accepted')
+
+# Столбцы, по которым упорядочивается статистика пользователей
+STATS_ORDER = ('name', 'last_login', 'sent', 'accepted')
+
+# Поля UserStats ключа постраничной выборки для столбцов STATS_ORDER
+STATS_KEY_FIELDS = {'name': 'name', 'last_login': 'last_login', 'sent': 'stored_sent', 'accepted': 'stored_accepted'}
+
+
+class Repository(ABC):
+    """
+    Интерфейс хранилища данных сервера.
+    Содержит все методы, которые используют MessageProcessor и окна
+    графической оболочки. Реализации: ServerRepository (SQLite) и
+    MemoryRepository (в памяти, без сохранения на диск).
+    """
+
+    @abstractmethod
+    def user_login(self, name, ip_address, port, key):
+        """Запись входа клиента. Если ключ не изменился, key - None."""
+
+    @abstractmethod
+    def user_logout(self, name):
+        """Запись отключения клиента."""
+
+    @abstractmethod
+    def add_user(self, name, passwd_hash):
+        """Регистрация пользователя."""
+
+    @abstractmethod
+    def remove_user(self, name):
+        """Удаление пользователя и всех его данных."""
+
+    @abstractmethod
+    def check_user(self, name):
+        """Проверка, что пользователь зарегистрирован."""
+
+    @abstractmethod
+    def get_hash(self, name):
+        """Хэш пароля пользователя или None, если пользователь не зарегистрирован."""
+
+    @abstractmethod
+    def get_pubkey(self, name):
+        """Публичный ключ пользователя или None, если пользователь не зарегистрирован."""
+
+    def user_credentials(self, name):
+        """Пара (хэш пароля, публичный ключ) или None, если пользователь не зарегистрирован."""
+        if not self.check_user(name):
+            return None
+        return self.get_hash(name), self.get_pubkey(name)
+
+    @abstractmethod
+    def process_message(self, sender, recipient):
+        """Учёт переданного сообщения в статистике."""
+
+    @abstractmethod
+    def add_message_stats(self, sent, accepted):
+        """
+        Учёт пачки переданных сообщений: sent и accepted - Counter
+        числа отправленных и принятых сообщений по именам пользователей.
+        """
+
+    @abstractmethod
+    def store_message(self, recipient, message):
+        """Сохранение сообщения для отключённого пользователя."""
+
+    @abstractmethod
+    def pop_offline_messages(self, name, limit):
+        """Выборка с удалением не более limit ожидающих сообщений пользователя."""
+
+    def pop_offline_frames(self, name, limit):
+        """То же, что pop_offline_messages, но сообщения возвращаются готовыми кадрами."""
+        return [encode_message(message) for message in self.pop_offline_messages(name, limit)]
+
+    @abstractmethod
+    def peek_offline_messages(self, name, limit, after=None):
+        """
+        Выборка без удаления не более limit ожидающих сообщений пользователя,
+        следующих за позицией after. Возвращает пары (позиция, сообщение).
+        """
+
+    def peek_offline_frames(self, name, limit, after=None):
+        """То же, что peek_offline_messages, но сообщения возвращаются готовыми кадрами."""
+        return [(position, encode_message(message))
+                for position, message in self.peek_offline_messages(name, limit, after)]
+
+    @abstractmethod
+    def ack_offline_messages(self, name, position):
+        """Удаление доставленных сообщений пользователя до позиции position включительно."""
+
+    @abstractmethod
+    def remove_expired_messages(self, ttl):
+        """
+        Удаление сообщений, ожидающих доставки дольше ttl секунд, возвращает их число.
+        Хранилище может удалять их в фоне, тогда возвращает None.
+        """
+
+    @abstractmethod
+    def add_contact(self, user, contact):
+        """Добавление контакта пользователю."""
+
+    @abstractmethod
+    def remove_contact(self, user, contact):
+        """Удаление контакта пользователя."""
+
+    @abstractmethod
+    def get_contacts(self, name):
+        """Список имён контактов пользователя."""
+
+    @abstractmethod
+    def users_list(self):
+        """Список кортежей (имя, время последнего входа) всех пользователей."""
+
+    @abstractmethod
+    def active_users_list(self):
+        """Список кортежей (имя, адрес, порт, время входа) подключённых пользователей."""
+
+    @abstractmethod
+    def user_history(self, name=None):
+        """Список кортежей (имя, время, адрес, порт) истории входов."""
+
+    @abstractmethod
+    def user_history_daily(self, name=None):
+        """Список кортежей (имя, день, число входов) свёрнутой истории входов."""
+
+    @abstractmethod
+    def compact_history(self, retention, chunk=HISTORY_COMPACT_CHUNK):
+        """
+        Свёртка записей истории входов старше retention дней в суточные
+        итоги. Записи обрабатываются и удаляются пачками не больше chunk.
+        """
+
+    @abstractmethod
+    def message_history(self):
+        """Список кортежей (имя, время последнего входа, отправлено, принято)."""
+
+    @abstractmethod
+    def message_history_page(self, order='name', descending=False, prefix=None, after=None,
+                             limit=STAT_PAGE_SIZE):
+        """
+        Страница статистики сообщений пользователей - список UserStats,
+        упорядоченный по столбцу order из STATS_ORDER, при равенстве - по id.
+        prefix - начало имени пользователя. Для следующей страницы передаётся
+        after - ключ stats_key последней строки предыдущей страницы.
+        """
+
+    @abstractmethod
+    def archive_message(self, sender, recipient, size, digest, text=None):
+        """
+        Запись сообщения в архив: размер и хэш текста, сам текст - если передан.
+        Запись может откладываться до вызова flush_message_stats.
+        """
+
+    @abstractmethod
+    def archive_messages(self, records):
+        """
+        Запись пачки сообщений в архив: кортежи (отправитель, получатель,
+        время, размер, хэш текста, текст или None).
+        """
+
+    @abstractmethod
+    def archive_page(self, sender=None, recipient=None, query=None, since=None, until=None,
+                     before=None, limit=ARCHIVE_PAGE_SIZE):
+        """
+        Страница архива сообщений, новые первыми, - список ArchiveRecord.
+        Фильтры: имена отправителя и получателя, слова текста query,
+        время записи с since до until. Для следующей страницы передаётся
+        before - id последней записи предыдущей страницы.
+        """
+
+    def flush_message_stats(self):
+        """Запись накопленной статистики сообщений и записей архива, если хранилище их копит."""
+
+    def sync(self):
+        """Ожидание записи отложенных изменений, если хранилище их откладывает."""
+
+    def flush(self):
+        """Запись всех отложенных изменений с ожиданием окончания записи."""
+        self.flush_message_stats()
+        self.sync()
+
+
+def stats_key(row, order):
+    """
+    Функция возвращает ключ строки UserStats для постраничной выборки
+    по столбцу order. Счётчики в ключе - записанные в хранилище.
+    """
+    return getattr(row, STATS_KEY_FIELDS[order]), row.id
+
+
+def history_border(retention):
+    """
+    Функция возвращает границу свёртки истории входов: начало суток
+    retention дней назад, чтобы сутки сворачивались целиком.
+    """
+    day = datetime.date.today() - datetime.timedelta(days=retention)
+    return datetime.datetime.combine(day, datetime.time())
+
+
+def make_repository(storage, path):
+    """
+    Функция создания хранилища по названию: sqlite - база в файле path,
+    memory - хранилище в памяти, path не используется,
+    segments - база в файле path и журнал сегментов в каталоге рядом с ней.
+    """
+    if storage == 'memory':
+        from server.memory_database import MemoryRepository
+        return MemoryRepository()
+    if storage == 'segments':
+        from server.segment_log import SegmentRepository
+        return SegmentRepository(path, os.path.splitext(path)[0] + '_segments')
+    if storage == 'sqlite':
+        from server.database import ServerRepository
+        return ServerRepository(path)
+    raise ValueError(f'Неизвестный тип хранилища: {storage}')
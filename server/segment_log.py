@@ -0,0 +1,288 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import weakref
+from collections import defaultdict, deque, namedtuple
+from itertools import dropwhile, islice, takewhile
+
+from base.variables import SEGMENT_SIZE, WRITE_BATCH_WINDOW, WRITE_BATCH_SIZE
+from base.utils import encode_message, decode_message, HEADER
+from server.database import ServerRepository
+
+# Загрузка логера
+SERVER_LOGGER = logging.getLogger('server')
+
+# Заголовок записи журнала: тип, длина данных, время записи, длина имени получателя.
+# За заголовком следуют имя получателя и данные.
+RECORD = struct.Struct('!BIdH')
+# Типы записей. Нулевой тип - ещё не записанная часть сегмента.
+MESSAGE_RECORD = 1
+ACK_RECORD = 2
+# Данные записи подтверждения: номер сегмента и смещение последнего доставленного сообщения
+POSITION = struct.Struct('!II')
+
+# Сообщение в индексе получателя: сегмент, смещение и длина данных, время записи
+Entry = namedtuple('Entry', 'segment offset length created')
+
+
+class Segment:
+    """Класс - файл сегмента журнала фиксированного размера, отображённый в память."""
+
+    def __init__(self, path, number, size):
+        self.path = path
+        self.number = number
+        create = not os.path.exists(path)
+        self.file = open(path, 'w+b' if create else 'r+b')
+        if create:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.view = memoryview(self.map)
+        # Выданные срезы отображения: id -> слабая ссылка на memoryview.
+        # Отображение нельзя закрыть, пока они не освобождены.
+        self.views = dict()
+        # Смещение следующей записи
+        self.position = 0
+        # Число недоставленных сообщений
+        self.live = 0
+
+    def slice(self, offset, length):
+        """Метод возвращает данные сегмента без копирования: memoryview отображения."""
+        view = self.view[offset:offset + length]
+        key = id(view)
+        self.views[key] = weakref.ref(view, lambda ref: self.views.pop(key, None))
+        return view
+
+    def close(self):
+        # Срезы, которые ещё используются, освобождаются до закрытия отображения
+        for ref in list(self.views.values()):
+            view = ref()
+            if view is not None:
+                view.release()
+        self.views.clear()
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+
+class SegmentLog:
+    """
+    Класс - журнал сообщений из сегментов фиксированного размера.
+    Записи только дописываются в конец последнего сегмента, при его
+    заполнении создаётся следующий. Доставка фиксируется записью
+    подтверждения, а индекс недоставленных сообщений по получателям
+    хранится в памяти и восстанавливается чтением сегментов при запуске.
+    Сегменты удаляются целиком, начиная с самого старого.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        # Сегменты по возрастанию номера, последний - активный
+        self.segments = dict()
+        # Недоставленные сообщения: имя получателя -> deque из Entry
+        self.index = defaultdict(deque)
+
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log'):
+                self.load_segment(int(name[:-4]))
+        if not self.segments:
+            self.roll()
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f'{number:020d}.log')
+
+    @property
+    def active(self):
+        return self.segments[next(reversed(self.segments))]
+
+    def load_segment(self, number):
+        """Метод чтения сегмента при запуске: восстановление индекса получателей."""
+        segment = Segment(self.segment_path(number), number, self.segment_size)
+        self.segments[number] = segment
+        data = segment.map
+        position = 0
+        while position + RECORD.size <= len(data):
+            kind, length, created, name_length = RECORD.unpack_from(data, position)
+            if not kind:
+                break
+            start = position + RECORD.size
+            name = data[start:start + name_length].decode('utf-8')
+            offset = start + name_length
+            if kind == MESSAGE_RECORD:
+                self.index[name].append(Entry(number, offset, length, created))
+                segment.live += 1
+            elif kind == ACK_RECORD:
+                self.consume(name, POSITION.unpack_from(data, offset))
+            position = offset + length
+        segment.position = position
+
+    def roll(self):
+        """Метод создания следующего сегмента."""
+        number = next(reversed(self.segments)) + 1 if self.segments else 1
+        self.segments[number] = Segment(self.segment_path(number), number, self.segment_size)
+        SERVER_LOGGER.debug(f'Создан сегмент журнала сообщений {number}.')
+
+    def write(self, kind, name, payload):
+        """Метод дописывания записи в активный сегмент, возвращает Entry её данных."""
+        name = name.encode('utf-8')
+        size = RECORD.size + len(name) + len(payload)
+        if size > self.segment_size:
+            raise ValueError('Запись не помещается в сегмент журнала.')
+        if self.active.position + size > len(self.active.map):
+            self.roll()
+        segment = self.active
+        start = segment.position
+        offset = start + RECORD.size + len(name)
+        created = time.time()
+        # Заголовок пишется последним: запись без заголовка при чтении не видна
+        segment.map[start + RECORD.size:offset] = name
+        segment.map[offset:offset + len(payload)] = payload
+        RECORD.pack_into(segment.map, start, kind, len(payload), created, len(name))
+        segment.position = offset + len(payload)
+        return Entry(segment.number, offset, len(payload), created)
+
+    def consume(self, name, position):
+        """Метод удаления из индекса сообщений получателя до позиции position включительно."""
+        entries = self.index.get(name)
+        while entries and (entries[0].segment, entries[0].offset) <= tuple(position):
+            entry = entries.popleft()
+            segment = self.segments.get(entry.segment)
+            if segment:
+                segment.live -= 1
+        if entries is not None and not entries:
+            del self.index[name]
+
+    def append(self, name, payload):
+        """Метод записи сообщения для получателя name."""
+        with self.lock:
+            entry = self.write(MESSAGE_RECORD, name, payload)
+            self.active.live += 1
+            self.index[name].append(entry)
+
+    def pop(self, name, limit=None):
+        """
+        Метод выборки не более limit сообщений получателя в порядке записи.
+        Данные возвращаются срезами memoryview отображения сегмента без
+        копирования и действительны, пока сегмент не удалён. Выбранные
+        сообщения отмечаются доставленными записью подтверждения.
+        """
+        with self.lock:
+            selected = list(islice(self.index.get(name) or (), limit))
+            if not selected:
+                return []
+            result = [self.segments[entry.segment].slice(entry.offset, entry.length) for entry in selected]
+            last = selected[-1]
+            self.consume(name, (last.segment, last.offset))
+            self.write(ACK_RECORD, name, POSITION.pack(last.segment, last.offset))
+            return result
+
+    def peek(self, name, limit, after=None):
+        """
+        Метод выборки без подтверждения не более limit сообщений получателя,
+        записанных после позиции after. Возвращает пары (позиция, данные),
+        позиция - номер сегмента и смещение сообщения. Данные, как в pop,
+        возвращаются срезами memoryview без копирования.
+        """
+        with self.lock:
+            entries = self.index.get(name) or ()
+            if after is not None:
+                entries = dropwhile(lambda entry: (entry.segment, entry.offset) <= tuple(after), entries)
+            return [((entry.segment, entry.offset), self.segments[entry.segment].slice(entry.offset, entry.length))
+                    for entry in islice(entries, limit)]
+
+    def ack(self, name, position):
+        """Метод подтверждения доставки сообщений получателя до позиции position включительно."""
+        with self.lock:
+            entries = self.index.get(name)
+            if not entries or (entries[0].segment, entries[0].offset) > tuple(position):
+                return
+            self.consume(name, position)
+            self.write(ACK_RECORD, name, POSITION.pack(*position))
+
+    def expire(self, ttl):
+        """
+        Метод удаления сообщений, записанных больше ttl секунд назад.
+        Просроченные сообщения отмечаются записью подтверждения, как
+        доставленные, после чего удаляются старые сегменты без недоставленных
+        сообщений. Активный сегмент не удаляется. Возвращает число удалённых сообщений.
+        """
+        border = time.time() - ttl
+        count = 0
+        with self.lock:
+            for name, entries in list(self.index.items()):
+                expired = sum(1 for _ in takewhile(lambda entry: entry.created < border, entries))
+                if not expired:
+                    continue
+                last = entries[expired - 1]
+                self.consume(name, (last.segment, last.offset))
+                self.write(ACK_RECORD, name, POSITION.pack(last.segment, last.offset))
+                count += expired
+            while len(self.segments) > 1:
+                segment = self.segments[next(iter(self.segments))]
+                if segment.live:
+                    break
+                del self.segments[segment.number]
+                segment.close()
+                os.remove(segment.path)
+                SERVER_LOGGER.debug(f'Удалён сегмент журнала сообщений {segment.number}.')
+        return count
+
+    def flush(self):
+        """Метод сброса изменений активного сегмента на диск."""
+        with self.lock:
+            self.active.map.flush()
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments.clear()
+
+
+class SegmentRepository(ServerRepository):
+    """
+    Класс - база данных сервера, хранящая очередь сообщений для
+    отключённых пользователей в журнале сегментов SegmentLog.
+    Сообщения хранятся готовыми кадрами и отдаются при доставке без
+    разбора и повторного кодирования. Остальные данные - в SQLite.
+    """
+
+    def __init__(self, path, segment_directory, segment_size=SEGMENT_SIZE,
+                 write_window=WRITE_BATCH_WINDOW, write_batch=WRITE_BATCH_SIZE):
+        super().__init__(path, write_window, write_batch)
+        self.messages = SegmentLog(segment_directory, segment_size)
+
+    def sync(self):
+        super().sync()
+        self.messages.flush()
+
+    def remove_user(self, name):
+        super().remove_user(name)
+        self.messages.pop(name)
+
+    def store_message(self, recipient, message):
+        self.messages.append(recipient, encode_message(message))
+
+    def pop_offline_frames(self, name, limit):
+        return self.messages.pop(name, limit)
+
+    def pop_offline_messages(self, name, limit):
+        return [decode_message(frame[HEADER.size:]) for frame in self.messages.pop(name, limit)]
+
+    def peek_offline_frames(self, name, limit, after=None):
+        return self.messages.peek(name, limit, after)
+
+    def peek_offline_messages(self, name, limit, after=None):
+        return [(position, decode_message(frame[HEADER.size:]))
+                for position, frame in self.messages.peek(name, limit, after)]
+
+    def ack_offline_messages(self, name, position):
+        self.messages.ack(name, position)
+
+    def remove_expired_messages(self, ttl):
+        return self.messages.expire(ttl)
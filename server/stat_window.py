@@ -1,6 +1,80 @@
-from PyQt5.QtWidgets import QDialog, QPushButton, QTableView
-from PyQt5.QtGui import QStandardItemModel, QStandardItem
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDialog, QPushButton, QTableView, QLineEdit, QLabel
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QVariant
+
+from base.variables import STAT_PAGE_SIZE
+from server.repository import STATS_ORDER, stats_key
+
+
+class StatModel(QAbstractTableModel):
+    """
+    Класс - модель таблицы статистики пользователей.
+    Строки загружаются из базы страницами по мере прокрутки таблицы
+    (canFetchMore/fetchMore), сортировка и отбор по началу имени
+    выполняются запросом к базе.
+    """
+    headers = ('Имя Клиента', 'Последний раз входил', 'Сообщений отправлено', 'Сообщений получено')
+
+    def __init__(self, database):
+        super().__init__()
+        self.database = database
+        self.rows = []
+        # Столбец и направление сортировки, начало имени
+        self.order = STATS_ORDER[0]
+        self.descending = False
+        self.prefix = None
+        # Загружены все строки
+        self.exhausted = False
+
+    def reset(self):
+        """Метод сброса загруженных строк и загрузки первой страницы."""
+        self.beginResetModel()
+        self.rows = []
+        self.exhausted = False
+        self.endResetModel()
+        self.fetchMore(QModelIndex())
+
+    def set_prefix(self, prefix):
+        self.prefix = prefix or None
+        self.reset()
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        after = stats_key(self.rows[-1], self.order) if self.rows else None
+        page = self.database.message_history_page(self.order, self.descending, self.prefix, after, STAT_PAGE_SIZE)
+        self.exhausted = len(page) < STAT_PAGE_SIZE
+        if not page:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(page) - 1)
+        self.rows.extend(page)
+        self.endInsertRows()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.order = STATS_ORDER[column]
+        self.descending = order == Qt.DescendingOrder
+        self.reset()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return QVariant()
+        row = self.rows[index.row()]
+        if index.column() == 1:
+            return str(row.last_login.replace(microsecond=0))
+        return str(row[index.column() + 1])
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return QVariant()
 
 
 # noinspection PyTypeChecker
@@ -12,9 +86,9 @@ class StatWindow(QDialog):
     def __init__(self, database):
         super().__init__()
         self.database = database
-        self.initUI()
         self.close_button = None
         self.stat_table = None
+        self.initUI()
 
     def initUI(self):
         # Настройки окна:
@@ -22,6 +96,14 @@ class StatWindow(QDialog):
         self.setFixedSize(600, 700)
         self.setAttribute(Qt.WA_DeleteOnClose)
 
+        # Отбор по началу имени
+        self.label_prefix = QLabel('Имя начинается с:', self)
+        self.label_prefix.move(10, 13)
+        self.label_prefix.setFixedSize(120, 15)
+        self.prefix_field = QLineEdit(self)
+        self.prefix_field.setFixedSize(450, 20)
+        self.prefix_field.move(140, 10)
+
         # Кнапка закрытия окна
         self.close_button = QPushButton('Закрыть', self)
         self.close_button.move(250, 650)
@@ -29,31 +111,18 @@ class StatWindow(QDialog):
 
         # Лист с собственно статистикой
         self.stat_table = QTableView(self)
-        self.stat_table.move(10, 10)
-        self.stat_table.setFixedSize(580, 620)
+        self.stat_table.move(10, 40)
+        self.stat_table.setFixedSize(580, 590)
 
         self.create_stat_model()
 
     def create_stat_model(self):
-        """Метод реализующий заполнение таблицы статистикой сообщений."""
-        # Список записей из базы
-        stat_list = self.database.message_history()
-
-        # Объект модели данных:
-        list = QStandardItemModel()
-        list.setHorizontalHeaderLabels(
-            ['Имя Клиента', 'Последний раз входил', 'Сообщений отправлено', 'Сообщений получено'])
-        for row in stat_list:
-            user, last_seen, sent, recv = row
-            user = QStandardItem(user)
-            user.setEditable(False)
-            last_seen = QStandardItem(str(last_seen.replace(microsecond=0)))
-            last_seen.setEditable(False)
-            sent = QStandardItem(str(sent))
-            sent.setEditable(False)
-            recv = QStandardItem(str(recv))
-            recv.setEditable(False)
-            list.appendRow([user, last_seen, sent, recv])
-        self.stat_table.setModel(list)
+        """Метод подключения к таблице модели статистики сообщений."""
+        self.stat_model = StatModel(self.database)
+        self.stat_table.setModel(self.stat_model)
+        # Включение сортировки загружает первую страницу
+        self.stat_table.setSortingEnabled(True)
+        self.stat_table.sortByColumn(0, Qt.AscendingOrder)
+        self.prefix_field.textChanged.connect(self.stat_model.set_prefix)
+        # Ширина столбцов - по первой странице, остальные строки не загружаются
         self.stat_table.resizeColumnsToContents()
-        self.stat_table.resizeRowsToContents()
@@ -0,0 +1,90 @@
+"""
+Токены возобновления сессии.
+
+Токен выдаётся клиенту после успешной авторизации и позволяет при
+переподключении войти без проверки пароля. Токен состоит из двух частей:
+идентификатора сессии (имя пользователя, отпечаток его публичного ключа,
+срок действия токена и предельный срок сессии) и ключа сессии -
+HMAC-SHA256 идентификатора на секрете сервера. При входе клиент передаёт
+в сообщении о присутствии идентификатор, случайную строку и HMAC ключом
+сессии от этой строки и времени сообщения. Сервер вычисляет ключ по
+идентификатору заново, не обращаясь к базе, а повтор перехваченного
+сообщения отклоняет по времени и по недавно использованным строкам.
+"""
+
+import base64
+import hashlib
+import hmac
+import time
+from collections import deque
+
+from base.variables import ENCODING
+
+
+def make_token(secret, name, ttl, deadline, now=None, fingerprint=None):
+    """
+    Функция выпуска токена пользователя name, действительного ttl сек.,
+    но не дольше предельного срока сессии deadline (unix time),
+    установленного при входе по паролю. fingerprint - отпечаток ключа,
+    с которым клиент вошёл: с другим ключом по токену не войти.
+    """
+    expires = int(min((time.time() if now is None else now) + ttl, deadline))
+    token_id = base64.urlsafe_b64encode(
+        f'{expires}:{int(deadline)}:{fingerprint or ""}:{name}'.encode(ENCODING)).decode('ascii')
+    return f'{token_id}.{token_key(secret, token_id)}'
+
+
+def token_key(secret, token_id):
+    """Функция вычисления ключа сессии по идентификатору токена."""
+    return hmac.new(secret, token_id.encode('ascii'), hashlib.sha256).hexdigest()
+
+
+def token_proof(key, nonce, timestamp):
+    """
+    Функция доказательства владения ключом сессии: HMAC от случайной
+    строки клиента и времени сообщения о присутствии.
+    """
+    return hmac.new(key.encode('ascii'), f'{nonce}:{timestamp!r}'.encode('ascii'), hashlib.sha256).digest()
+
+
+def check_token_id(token_id, now=None):
+    """
+    Функция разбора идентификатора токена. Возвращает имя пользователя,
+    предельный срок сессии и отпечаток ключа или None, если идентификатор
+    повреждён или срок действия истёк. Подлинность идентификатора не
+    проверяется: поддельному идентификатору соответствует ключ, неизвестный клиенту.
+    """
+    try:
+        expires, deadline, fingerprint, name = base64.urlsafe_b64decode(
+            token_id.encode('ascii')).decode(ENCODING).split(':', 3)
+        expires, deadline = int(expires), int(deadline)
+    except (AttributeError, ValueError):
+        return None
+    if expires < (time.time() if now is None else now):
+        return None
+    return name, deadline, fingerprint or None
+
+
+class NonceCache:
+    """
+    Класс - случайные строки входов по токену, использованные за последние
+    window сек. Повтор строки за это время означает повтор перехваченного
+    сообщения. Хранится в памяти процесса, записи удаляются по истечении срока.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.seen = set()
+        # Пары (срок хранения, строка) в порядке добавления
+        self.expires = deque()
+
+    def add(self, nonce, now=None):
+        """Метод запоминает строку, возвращает False, если она уже использована."""
+        now = time.time() if now is None else now
+        while self.expires and self.expires[0][0] < now:
+            self.seen.discard(self.expires.popleft()[1])
+        if nonce in self.seen:
+            return False
+        self.seen.add(nonce)
+        self.expires.append((now + self.window, nonce))
+        return True
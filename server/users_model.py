@@ -0,0 +1,89 @@
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QVariant, pyqtSignal
+
+
+class ActiveUsersModel(QAbstractTableModel):
+    """
+    Класс - модель таблицы подключённых пользователей.
+    Заполняется из базы методом reload, дальше изменяется по событиям входа
+    и выхода от сервера: добавляется или удаляется только изменившаяся строка.
+    Методы user_logged_in и user_logged_out вызываются из потока сервера,
+    сигналы передают событие в поток графической оболочки.
+    """
+    headers = ('Имя Клиента', 'IP Адрес', 'Порт', 'Время подключения')
+
+    logged_in = pyqtSignal(str, str, int, object)
+    logged_out = pyqtSignal(str)
+
+    def __init__(self, database):
+        super().__init__()
+        self.database = database
+        # Строки таблицы: [имя, адрес, порт, время входа]
+        self.rows = []
+        # Номер строки по имени пользователя
+        self.positions = dict()
+        self.logged_in.connect(self.add_user)
+        self.logged_out.connect(self.remove_user)
+
+    def user_logged_in(self, name, ip_address, port, login_date):
+        self.logged_in.emit(name, ip_address, port, login_date)
+
+    def user_logged_out(self, name):
+        self.logged_out.emit(name)
+
+    def reload(self):
+        """
+        Метод полного перечитывания списка подключённых пользователей из базы.
+        Вызывается после подписки на события сервера: sync дожидается записи
+        в базу входов и выходов, произошедших до подписки.
+        """
+        self.database.sync()
+        self.beginResetModel()
+        self.rows = [list(row) for row in self.database.active_users_list()]
+        self.positions = {row[0]: position for position, row in enumerate(self.rows)}
+        self.endResetModel()
+
+    def add_user(self, name, ip_address, port, login_date):
+        """Метод добавления строки вошедшего пользователя."""
+        row = [name, ip_address, port, login_date]
+        # Событие могло прийти после загрузки списка, в котором пользователь уже есть
+        position = self.positions.get(name)
+        if position is not None:
+            self.rows[position] = row
+            self.dataChanged.emit(self.index(position, 0), self.index(position, len(self.headers) - 1))
+            return
+        position = len(self.rows)
+        self.beginInsertRows(QModelIndex(), position, position)
+        self.rows.append(row)
+        self.positions[name] = position
+        self.endInsertRows()
+
+    def remove_user(self, name):
+        """Метод удаления строки отключившегося пользователя."""
+        position = self.positions.pop(name, None)
+        if position is None:
+            return
+        self.beginRemoveRows(QModelIndex(), position, position)
+        del self.rows[position]
+        for shifted in range(position, len(self.rows)):
+            self.positions[self.rows[shifted][0]] = shifted
+        self.endRemoveRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return QVariant()
+        value = self.rows[index.row()][index.column()]
+        if index.column() == 3:
+            # Уберём милисекунды из строки времени, т.к. такая точность не требуется.
+            return str(value.replace(microsecond=0))
+        return str(value)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return QVariant()
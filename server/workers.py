@@ -0,0 +1,559 @@
+"""
+Многопроцессный режим сервера.
+
+Несколько процессов-обработчиков слушают один порт (SO_REUSEPORT),
+ядро распределяет между ними входящие соединения. Родительский процесс
+ведёт общий справочник подключённых пользователей и пересылает сообщения
+между обработчиками через сокеты Unix. База данных открыта только
+в отдельном процессе менеджера, остальные процессы обращаются к ней
+через прокси. Обработчики кэшируют записи пользователей и копят
+статистику сообщений у себя, чтобы пересылка сообщений не ждала менеджера.
+"""
+
+import copyreg
+import datetime
+import inspect
+import multiprocessing
+import os
+import selectors
+import socket
+import threading
+from collections import Counter, namedtuple
+from multiprocessing.managers import BaseManager
+
+from base.descriptors import PortValidator
+from base.variables import *
+from base.utils import encode_message, MessageDecoder
+from server.center import MessageProcessor
+from server.database import LruCache
+from server.repository import Repository, make_repository
+import log.config.server_log_config
+
+# Загрузка логера
+SERVER_LOGGER = logging.getLogger('server')
+
+# Внутренние сообщения между процессами сервера
+# Пользователь авторизовался в процессе-обработчике
+IPC_LOGIN = 'login'
+# Пользователь отключился от процесса-обработчика
+IPC_LOGOUT = 'logout'
+# Сообщение для пользователя, подключённого к другому процессу
+IPC_ROUTE = 'route'
+# Разослать клиентам сервисное сообщение 205
+IPC_UPDATE = 'update'
+# Отключить пользователя
+IPC_KICK = 'kick'
+# Завершить процесс-обработчик
+IPC_STOP = 'stop'
+# Признак отключения при одновременном входе под одним именем в разные процессы
+DUPLICATE = 'duplicate'
+# Номер процесса-обработчика
+WORKER = 'worker'
+# Адрес и порт клиента
+ADDRESS = 'address'
+
+# Пользователь в общем справочнике: имя и номер процесса-обработчика
+RemoteClient = namedtuple('RemoteClient', 'name worker')
+
+
+# База данных процесса менеджера
+_repository = None
+
+
+def init_repository(storage, path):
+    """Функция инициализации базы данных в процессе менеджера."""
+    global _repository
+    _repository = make_repository(storage, path)
+
+
+def get_repository():
+    """Функция возвращает базу данных процесса менеджера."""
+    return _repository
+
+
+class RepositoryManager(BaseManager):
+    """Менеджер процесса, единственного владельца базы данных сервера."""
+
+
+# Журнал сегментов отдаёт кадры срезами memoryview своего отображения,
+# процессам-обработчикам они передаются копией в bytes.
+copyreg.pickle(memoryview, lambda view: (bytes, (bytes(view),)))
+
+
+RepositoryManager.register(
+    'repository',
+    callable=get_repository,
+    exposed=tuple(name for name, value in vars(Repository).items()
+                  if not name.startswith('_') and inspect.isfunction(value)))
+
+
+class WorkerRepository(Repository):
+    """
+    Класс - хранилище процесса-обработчика поверх прокси базы данных.
+    Каждый вызов прокси - запрос к процессу менеджера, который обслуживает
+    все процессы-обработчики по очереди. Поэтому записи пользователей
+    кэшируются в процессе-обработчике, а статистика сообщений и записи
+    архива копятся в нём и передаются менеджеру пачкой в flush_message_stats.
+    Остальные методы вызывают прокси.
+    """
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+        # Кэш записей пользователей: имя -> (хэш пароля, ключ) или None.
+        # Записи сбрасываются по сообщениям координатора о входе и изменении
+        # списка пользователей.
+        self.user_cache = LruCache(USER_CACHE_SIZE)
+
+        # Статистика сообщений и записи архива, ещё не переданные менеджеру
+        self.pending_sent = Counter()
+        self.pending_accepted = Counter()
+        self.pending_count = 0
+        self.pending_archive = []
+
+    def forget_user(self, name):
+        """Метод сброса записи пользователя в кэше."""
+        self.user_cache.invalidate(name)
+
+    def forget_users(self):
+        """Метод сброса всех записей кэша."""
+        self.user_cache = LruCache(USER_CACHE_SIZE)
+
+    def user_credentials(self, name):
+        return self.user_cache.get(name, self.proxy.user_credentials)
+
+    def check_user(self, name):
+        return self.user_credentials(name) is not None
+
+    def get_hash(self, name):
+        record = self.user_credentials(name)
+        return record[0] if record else None
+
+    def get_pubkey(self, name):
+        record = self.user_credentials(name)
+        return record[1] if record else None
+
+    def user_login(self, name, ip_address, port, key):
+        self.proxy.user_login(name, ip_address, port, key)
+        if key is not None:
+            # Другие процессы перечитают ключ по сообщению о входе,
+            # к этому времени он должен быть записан.
+            self.proxy.sync()
+            self.forget_user(name)
+
+    def user_logout(self, name):
+        self.proxy.user_logout(name)
+
+    def add_user(self, name, passwd_hash):
+        self.proxy.add_user(name, passwd_hash)
+        self.forget_user(name)
+
+    def remove_user(self, name):
+        self.proxy.remove_user(name)
+        self.forget_user(name)
+
+    def process_message(self, sender, recipient):
+        self.pending_sent[sender] += 1
+        self.pending_accepted[recipient] += 1
+        self.pending_count += 1
+        if self.pending_count >= STATS_FLUSH_COUNT:
+            self.flush_message_stats()
+
+    def add_message_stats(self, sent, accepted):
+        self.pending_sent.update(sent)
+        self.pending_accepted.update(accepted)
+        self.pending_count += sum(sent.values())
+
+    def archive_message(self, sender, recipient, size, digest, text=None):
+        self.pending_archive.append((sender, recipient, datetime.datetime.now(), size, digest, text))
+        if len(self.pending_archive) >= STATS_FLUSH_COUNT:
+            self.flush_message_stats()
+
+    def archive_messages(self, records):
+        self.pending_archive.extend(records)
+
+    def flush_message_stats(self):
+        """Метод передачи менеджеру накопленной статистики и записей архива."""
+        if not self.pending_count and not self.pending_archive:
+            return
+        if self.pending_count:
+            self.proxy.add_message_stats(self.pending_sent, self.pending_accepted)
+            self.pending_sent, self.pending_accepted = Counter(), Counter()
+            self.pending_count = 0
+        if self.pending_archive:
+            self.proxy.archive_messages(self.pending_archive)
+            self.pending_archive = []
+        self.proxy.flush_message_stats()
+
+    def sync(self):
+        self.proxy.sync()
+
+    def store_message(self, recipient, message):
+        self.proxy.store_message(recipient, message)
+
+    def pop_offline_messages(self, name, limit):
+        return self.proxy.pop_offline_messages(name, limit)
+
+    def pop_offline_frames(self, name, limit):
+        return self.proxy.pop_offline_frames(name, limit)
+
+    def peek_offline_messages(self, name, limit, after=None):
+        return self.proxy.peek_offline_messages(name, limit, after)
+
+    def peek_offline_frames(self, name, limit, after=None):
+        return self.proxy.peek_offline_frames(name, limit, after)
+
+    def ack_offline_messages(self, name, position):
+        self.proxy.ack_offline_messages(name, position)
+
+    def remove_expired_messages(self, ttl):
+        return self.proxy.remove_expired_messages(ttl)
+
+    def add_contact(self, user, contact):
+        self.proxy.add_contact(user, contact)
+
+    def remove_contact(self, user, contact):
+        self.proxy.remove_contact(user, contact)
+
+    def get_contacts(self, name):
+        return self.proxy.get_contacts(name)
+
+    def users_list(self):
+        return self.proxy.users_list()
+
+    def active_users_list(self):
+        return self.proxy.active_users_list()
+
+    def user_history(self, name=None):
+        return self.proxy.user_history(name)
+
+    def user_history_daily(self, name=None):
+        return self.proxy.user_history_daily(name)
+
+    def compact_history(self, retention, chunk=HISTORY_COMPACT_CHUNK):
+        self.proxy.compact_history(retention, chunk)
+
+    def message_history(self):
+        return self.proxy.message_history()
+
+    def message_history_page(self, order='name', descending=False, prefix=None, after=None,
+                             limit=STAT_PAGE_SIZE):
+        return self.proxy.message_history_page(order, descending, prefix, after, limit)
+
+    def archive_page(self, sender=None, recipient=None, query=None, since=None, until=None,
+                     before=None, limit=ARCHIVE_PAGE_SIZE):
+        return self.proxy.archive_page(sender, recipient, query, since, until, before, limit)
+
+
+class IpcChannel:
+    """
+    Класс - канал обмена кадрами между процессами сервера.
+    Сокет неблокирующий, неотправленные данные копятся в очереди
+    и дописываются по готовности сокета к записи.
+    """
+
+    def __init__(self, sock, selector):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.selector = selector
+        self.decoder = MessageDecoder()
+        self.out_buffer = bytearray()
+        self.selector.register(self.sock, selectors.EVENT_READ, self)
+
+    def send(self, message):
+        """Метод отправки сообщения в канал."""
+        self.out_buffer += encode_message(message)
+        self.flush()
+
+    def flush(self):
+        """Метод отправки накопленной очереди."""
+        if self.out_buffer:
+            try:
+                sent = self.sock.send(self.out_buffer)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            del self.out_buffer[:sent]
+        events = selectors.EVENT_READ
+        if self.out_buffer:
+            events |= selectors.EVENT_WRITE
+        if events != self.selector.get_key(self.sock).events:
+            self.selector.modify(self.sock, events, self)
+
+    def read(self):
+        """Метод приёма данных, возвращает список полностью принятых сообщений."""
+        data = self.sock.recv(MAX_PACKAGE_LENGTH)
+        if not data:
+            raise ConnectionResetError('Канал между процессами сервера закрыт')
+        return self.decoder.feed(data)
+
+
+class WorkerMessageProcessor(MessageProcessor):
+    """
+    Процесс-обработчик многопроцессного сервера.
+    Обслуживает свою часть подключений, о входах и выходах пользователей
+    сообщает координатору, сообщения пользователям других процессов
+    передаёт через него.
+    """
+
+    def __init__(self, worker_id, ipc_sock, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.worker_id = worker_id
+        self.reuse_port = True
+        self.ipc = IpcChannel(ipc_sock, self.selector)
+
+        # Пользователи других процессов: имя -> номер процесса
+        self.remote_names = dict()
+
+    def handle_event(self, key, mask):
+        """Метод обработки события готовности одного сокета."""
+        if key.data is not self.ipc:
+            super().handle_event(key, mask)
+            return
+        if mask & selectors.EVENT_WRITE:
+            self.ipc.flush()
+        if mask & selectors.EVENT_READ:
+            try:
+                messages = self.ipc.read()
+            except (BlockingIOError, InterruptedError):
+                return
+            except (OSError, ValueError) as err:
+                SERVER_LOGGER.critical(f'Потеряна связь с координатором сервера: {err}')
+                self.running = False
+                return
+            for message in messages:
+                self.process_ipc_message(message)
+
+    def process_ipc_message(self, message):
+        """Метод обработки сообщения координатора."""
+        if message[ACTION] == IPC_ROUTE:
+            self.deliver_routed(message[MESSAGE])
+        elif message[ACTION] == IPC_LOGIN and message[WORKER] != self.worker_id:
+            self.remote_names[message[ACCOUNT_NAME]] = message[WORKER]
+            # При входе мог измениться публичный ключ пользователя
+            self.database.forget_user(message[ACCOUNT_NAME])
+        elif message[ACTION] == IPC_LOGOUT and message[WORKER] != self.worker_id:
+            if self.remote_names.get(message[ACCOUNT_NAME]) == message[WORKER]:
+                del self.remote_names[message[ACCOUNT_NAME]]
+        elif message[ACTION] == IPC_UPDATE:
+            # Список пользователей изменился: пользователи добавлены или удалены
+            self.database.forget_users()
+            self.service_update_lists()
+        elif message[ACTION] == IPC_STOP:
+            self.running = False
+        elif message[ACTION] == IPC_KICK and message[ACCOUNT_NAME] in self.names:
+            client = self.names[message[ACCOUNT_NAME]]
+            if message.get(DUPLICATE):
+                # Координатор отклонил повторный вход: запись в таблице активных
+                # пользователей принадлежит подключению в другом процессе,
+                # поэтому отключение в базу не записывается.
+                del self.names[client.name]
+            self.remove_client(client)
+
+    def process_message(self, message):
+        """
+        Метод отправки сообщения клиенту.
+        Если получатель подключён к другому процессу, сообщение уходит координатору.
+        """
+        if message[TO] in self.remote_names:
+            self.ipc.send({ACTION: IPC_ROUTE, MESSAGE: message})
+            SERVER_LOGGER.info(
+                f'Сообщение пользователю {message[TO]} передано процессу {self.remote_names[message[TO]]}.')
+        else:
+            self.deliver_routed(message)
+
+    def deliver_routed(self, message):
+        """
+        Метод отправки сообщения клиенту этого процесса. Отправителю уже
+        ответили 200, поэтому сообщение для только что отключившегося
+        получателя сохраняется в очереди до его входа.
+        """
+        if message[TO] in self.names:
+            super().process_message(message)
+        else:
+            self.database.store_message(message[TO], message)
+            SERVER_LOGGER.info(f'Пользователь {message[TO]} отключился, сообщение поставлено в очередь.')
+
+    def is_online(self, name):
+        """Метод проверяющий, что пользователь подключён к любому процессу сервера."""
+        return name in self.names or name in self.remote_names
+
+    def on_user_login(self, name):
+        """Событие успешной авторизации пользователя."""
+        self.ipc.send({ACTION: IPC_LOGIN, ACCOUNT_NAME: name, WORKER: self.worker_id,
+                       ADDRESS: self.names[name].address})
+
+    def on_user_logout(self, name):
+        """Событие отключения авторизованного пользователя."""
+        self.ipc.send({ACTION: IPC_LOGOUT, ACCOUNT_NAME: name, WORKER: self.worker_id})
+
+
+def run_worker(worker_id, ipc_sock, manager_address, listen_address, listen_port,
+               outbound_high_water, outbound_limit, auth_timeout, offline_ttl, history_retention, archive,
+               session_ttl, token_secret, session_max_age):
+    """Функция - точка входа процесса-обработчика."""
+    manager = RepositoryManager(address=manager_address)
+    manager.connect()
+    server = WorkerMessageProcessor(
+        worker_id, ipc_sock, listen_address, listen_port, WorkerRepository(manager.repository()),
+        outbound_high_water, outbound_limit, auth_timeout, offline_ttl, history_retention, archive,
+        session_ttl, token_secret, session_max_age)
+    server.run()
+
+
+class ShardedServer(threading.Thread):
+    """
+    Координатор многопроцессного сервера.
+    Запускает процесс базы данных и процессы-обработчики, ведёт общий
+    справочник подключённых пользователей и пересылает сообщения между
+    обработчиками. Для графической оболочки заменяет MessageProcessor.
+    """
+    port = PortValidator()
+
+    def __init__(self, listen_address, listen_port, database_path, workers,
+                 outbound_high_water=OUTBOUND_HIGH_WATER, outbound_limit=OUTBOUND_LIMIT,
+                 auth_timeout=AUTH_TIMEOUT, offline_ttl=OFFLINE_MESSAGE_TTL,
+                 history_retention=HISTORY_RETENTION, archive=ARCHIVE_MODE,
+                 session_ttl=SESSION_TOKEN_TTL, session_max_age=SESSION_MAX_AGE,
+                 storage=DEFAULT_STORAGE):
+        self.addr = listen_address
+        self.port = listen_port
+
+        # Флаг продолжения работы
+        self.running = True
+
+        # Общий справочник подключённых пользователей: имя -> RemoteClient
+        self.names = dict()
+
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.RLock()
+
+        # Подписчики на вход и выход пользователей (графическая оболочка)
+        self.user_listeners = []
+
+        # Процесс базы данных, остальные процессы работают с ней через прокси
+        self.manager = RepositoryManager()
+        self.manager.start(init_repository, (storage, database_path))
+        self.database = self.manager.repository()
+
+        # Общий секрет токенов сессии: токен, выданный одним процессом,
+        # принимается любым другим
+        token_secret = os.urandom(32)
+
+        # Процессы-обработчики и каналы связи с ними
+        self.workers = []
+        parent_socks = []
+        for worker_id in range(workers):
+            parent_sock, worker_sock = socket.socketpair()
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(worker_id, worker_sock, self.manager.address, listen_address, listen_port,
+                      outbound_high_water, outbound_limit, auth_timeout, offline_ttl, history_retention,
+                      archive, session_ttl, token_secret, session_max_age),
+                daemon=True)
+            process.start()
+            worker_sock.close()
+            self.workers.append(process)
+            parent_socks.append(parent_sock)
+        self.channels = [IpcChannel(sock, self.selector) for sock in parent_socks]
+
+        super().__init__()
+
+    def run(self):
+        """Метод основной цикл потока - пересылка сообщений между процессами."""
+        SERVER_LOGGER.info(f'Запущен многопроцессный сервер, порт: {self.port}, процессов: {len(self.workers)}.')
+        while self.running:
+            events = self.selector.select(SERVER_SELECT_TIMEOUT)
+            with self.lock:
+                for key, mask in events:
+                    self.handle_event(key.data, mask)
+
+        # Процессы-обработчики передают накопленную статистику и завершаются
+        self.broadcast({ACTION: IPC_STOP})
+        for process in self.workers:
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.database.flush()
+        self.manager.shutdown()
+
+    def handle_event(self, channel, mask):
+        """Метод обработки события готовности канала процесса-обработчика."""
+        if mask & selectors.EVENT_WRITE:
+            channel.flush()
+        if mask & selectors.EVENT_READ:
+            worker_id = self.channels.index(channel)
+            try:
+                messages = channel.read()
+            except (BlockingIOError, InterruptedError):
+                return
+            except (OSError, ValueError) as err:
+                SERVER_LOGGER.critical(f'Процесс-обработчик {worker_id} завершился: {err}')
+                self.selector.unregister(channel.sock)
+                self.forget_worker(worker_id)
+                return
+            for message in messages:
+                self.process_ipc_message(message, worker_id)
+
+    def process_ipc_message(self, message, worker_id):
+        """Метод обработки сообщения процесса-обработчика."""
+        if message[ACTION] == IPC_LOGIN:
+            name = message[ACCOUNT_NAME]
+            if name in self.names:
+                # Одновременный вход под одним именем в разные процессы.
+                SERVER_LOGGER.error(f'Пользователь {name} уже подключён, повторное подключение разорвано.')
+                self.channels[worker_id].send({ACTION: IPC_KICK, ACCOUNT_NAME: name, DUPLICATE: True})
+                return
+            self.names[name] = RemoteClient(name, worker_id)
+            self.broadcast(message, exclude=worker_id)
+            ip_address, port = message[ADDRESS]
+            login_date = datetime.datetime.now()
+            for listener in self.user_listeners:
+                listener.user_logged_in(name, ip_address, port, login_date)
+        elif message[ACTION] == IPC_LOGOUT:
+            name = message[ACCOUNT_NAME]
+            if name in self.names and self.names[name].worker == worker_id:
+                del self.names[name]
+                self.broadcast(message, exclude=worker_id)
+                for listener in self.user_listeners:
+                    listener.user_logged_out(name)
+        elif message[ACTION] == IPC_ROUTE:
+            recipient = self.names.get(message[MESSAGE][TO])
+            if recipient:
+                self.channels[recipient.worker].send(message)
+            else:
+                # Отправителю уже ответили 200: сообщение ждёт входа получателя.
+                self.database.store_message(message[MESSAGE][TO], message[MESSAGE])
+                SERVER_LOGGER.info(
+                    f'Пользователь {message[MESSAGE][TO]} отключился, сообщение поставлено в очередь.')
+
+    def forget_worker(self, worker_id):
+        """Метод удаления из справочника пользователей завершившегося процесса."""
+        for client in [client for client in self.names.values() if client.worker == worker_id]:
+            del self.names[client.name]
+            self.database.user_logout(client.name)
+            self.broadcast({ACTION: IPC_LOGOUT, ACCOUNT_NAME: client.name, WORKER: worker_id},
+                           exclude=worker_id)
+            for listener in self.user_listeners:
+                listener.user_logged_out(client.name)
+
+    def broadcast(self, message, exclude=None):
+        """Метод рассылки сообщения всем процессам-обработчикам."""
+        for worker_id, channel in enumerate(self.channels):
+            if worker_id != exclude and self.workers[worker_id].is_alive():
+                channel.send(message)
+
+    def add_user_listener(self, listener):
+        """Метод подписки на вход и выход пользователей, как у MessageProcessor."""
+        with self.lock:
+            self.user_listeners.append(listener)
+
+    def remove_client(self, client):
+        """Метод отключения пользователя в обслуживающем его процессе."""
+        with self.lock:
+            self.channels[client.worker].send({ACTION: IPC_KICK, ACCOUNT_NAME: client.name})
+
+    def service_update_lists(self):
+        """Метод реализующий отправки сервисного сообщения 205 клиентам."""
+        with self.lock:
+            self.broadcast({ACTION: IPC_UPDATE})
@@ -0,0 +1,398 @@
+"""Тесты основного класса сервера MessageProcessor"""
+
+import binascii
+import hmac
+import os
+import selectors
+import socket
+import sys
+import time
+import unittest
+from unittest import mock
+
+from base.variables import *
+from base.utils import encode_message, key_fingerprint, MessageDecoder
+from server.center import MessageProcessor
+from server.connection import ClientConnection, Challenge
+from server.memory_database import MemoryRepository
+
+# для запуска из командной строки
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+
+class ServerTestCase(unittest.TestCase):
+    """
+    Базовый класс тестов сервера. Поток сервера не запускается:
+    клиенты подключаются через socketpair, а события селектора
+    обрабатываются вызовом pump, как в основном цикле сервера.
+    """
+    server_options = {}
+
+    def setUp(self):
+        self.database = MemoryRepository()
+        for name in ('test1', 'test2'):
+            self.database.add_user(name, b'hash')
+        self.peers = []
+        self.server = self.make_server()
+
+    def tearDown(self):
+        for peer in self.peers:
+            peer.close()
+        for client in list(self.server.clients):
+            self.server.remove_client(client)
+        self.server.selector.close()
+
+    def make_server(self):
+        return MessageProcessor('127.0.0.1', 7777, self.database, **self.server_options)
+
+    def connect(self):
+        """Метод подключения клиента, возвращает подключение на сервере и сокет клиента."""
+        server_sock, peer = socket.socketpair()
+        server_sock.setblocking(False)
+        peer.setblocking(False)
+        self.peers.append(peer)
+        client = ClientConnection(server_sock, ('127.0.0.1', 10000 + len(self.peers)))
+        self.server.clients.add(client)
+        self.server.selector.register(server_sock, selectors.EVENT_READ, client)
+        self.server.start_handshake(client)
+        return client, peer
+
+    def login(self, name):
+        """Метод подключения авторизованного клиента, ответ 200 уже прочитан."""
+        client, peer = self.connect()
+        self.server.complete_login({USER: {ACCOUNT_NAME: name}}, client, None, time.time() + 60)
+        self.assertEqual(self.receive(peer)[0][RESPONSE], 200)
+        return client, peer
+
+    def pump(self):
+        """Метод обработки событий селектора сервера без ожидания."""
+        with self.server.lock:
+            for key, mask in self.server.selector.select(0):
+                self.server.handle_event(key, mask)
+
+    def send(self, peer, *messages):
+        """Метод отправки серверу сообщений одним блоком и обработки их сервером."""
+        peer.sendall(b''.join(encode_message(message) for message in messages))
+        self.pump()
+
+    def receive(self, peer, count=1, timeout=2):
+        """Метод приёма count сообщений сервера, пока сервер обрабатывает события."""
+        decoder = MessageDecoder()
+        messages = []
+        deadline = time.monotonic() + timeout
+        while len(messages) < count and time.monotonic() < deadline:
+            self.pump()
+            try:
+                data = peer.recv(MAX_PACKAGE_LENGTH)
+            except BlockingIOError:
+                time.sleep(0.001)
+                continue
+            if not data:
+                break
+            messages += decoder.feed(data)
+        return messages
+
+    def closed(self, peer, timeout=2):
+        """Метод проверки, что сервер закрыл соединение, непрочитанные данные пропускаются."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.pump()
+            try:
+                if not peer.recv(MAX_PACKAGE_LENGTH):
+                    return True
+            except BlockingIOError:
+                time.sleep(0.001)
+            except ConnectionResetError:
+                return True
+        return False
+
+
+class TestOutboundQueue(ServerTestCase):
+    """Тестовый класс очереди отправки клиента"""
+    server_options = {'outbound_high_water': 64 * 1024, 'outbound_limit': 2 * 1024 * 1024}
+
+    def test_partial_write(self):
+        """Очередь, не отправленная за один раз, дописывается по готовности сокета"""
+        client, peer = self.login('test1')
+        frame = encode_message({RESPONSE: 200, DATA: 'x' * (1024 * 1024)})
+        self.server.send_frame(client, frame)
+        self.pump()
+        # Клиент не читает: отправлена только часть, чтение запросов приостановлено
+        self.assertTrue(client.out_buffer)
+        self.assertLess(client.bytes_sent, client.bytes_queued)
+        self.assertTrue(client.paused)
+        self.assertEqual(self.server.selector.get_key(client.sock).events, selectors.EVENT_WRITE)
+
+        data = bytearray()
+        deadline = time.monotonic() + 5
+        while len(data) < len(frame) and time.monotonic() < deadline:
+            self.pump()
+            try:
+                data += peer.recv(MAX_PACKAGE_LENGTH)
+            except BlockingIOError:
+                pass
+        self.assertEqual(bytes(data), frame)
+        self.assertEqual(client.out_buffer, bytearray())
+        self.assertEqual(client.bytes_sent, client.bytes_queued)
+        self.assertFalse(client.paused)
+        self.assertEqual(self.server.selector.get_key(client.sock).events, selectors.EVENT_READ)
+
+    def test_hard_limit(self):
+        """Клиент, очередь которого превысила предел, отключается, остальные обслуживаются"""
+        client, peer = self.login('test1')
+        other, other_peer = self.login('test2')
+        for _ in range(3):
+            self.server.send_frame(client, encode_message({RESPONSE: 200, DATA: 'x' * (1024 * 1024)}))
+        self.assertNotIn(client, self.server.clients)
+        self.assertFalse(self.server.is_online('test1'))
+        self.assertTrue(self.closed(peer))
+        self.send(other_peer, {ACTION: USERS_REQUEST, TIME: 1.0, ACCOUNT_NAME: 'test2'})
+        self.assertEqual(self.receive(other_peer)[0][RESPONSE], 202)
+
+    def test_pipelined_ids(self):
+        """Ответы на запросы, отправленные подряд, приходят по порядку со своими номерами"""
+        client, peer = self.login('test1')
+        self.send(peer,
+                  {ACTION: USERS_REQUEST, TIME: 1.0, ACCOUNT_NAME: 'test1', REQUEST_ID: 1},
+                  {ACTION: 'unknown', TIME: 1.0, REQUEST_ID: 2},
+                  {ACTION: GET_CONTACTS, TIME: 1.0, USER: 'test1', REQUEST_ID: 3},
+                  {ACTION: GET_CONTACTS, TIME: 1.0, USER: 'test1'})
+        replies = self.receive(peer, 4)
+        self.assertEqual([(reply[RESPONSE], reply.get(REQUEST_ID)) for reply in replies],
+                         [(202, 1), (400, 2), (202, 3), (202, None)])
+        self.assertIsNone(client.request_id)
+
+    def test_message_without_id(self):
+        """Сообщение пользователя получателю пересылается без номера запроса отправителя"""
+        sender, sender_peer = self.login('test1')
+        recipient, recipient_peer = self.login('test2')
+        self.send(sender_peer, {ACTION: MESSAGE, TIME: 1.0, FROM: 'test1', TO: 'test2',
+                                MESSAGE: 'text', REQUEST_ID: 7})
+        self.assertEqual(self.receive(sender_peer), [{RESPONSE: 200, REQUEST_ID: 7}])
+        message, = self.receive(recipient_peer)
+        self.assertEqual(message[MESSAGE], 'text')
+        self.assertNotIn(REQUEST_ID, message)
+
+
+class TestPublicKeyRequest(ServerTestCase):
+    """Тестовый класс запроса публичного ключа"""
+
+    def test_public_key(self):
+        """Ключ пользователя отдаётся с ответом 511"""
+        self.database.user_login('test2', '127.0.0.1', 7777, 'key')
+        client, peer = self.login('test1')
+        self.send(peer, {ACTION: PUBLIC_KEY_REQUEST, TIME: 1.0, ACCOUNT_NAME: 'test2'})
+        self.assertEqual(self.receive(peer), [{RESPONSE: 511, DATA: 'key'}])
+
+    def test_unknown_user(self):
+        """Запрос ключа незарегистрированного пользователя - ответ 400, клиент не отключается"""
+        client, peer = self.login('test1')
+        self.send(peer, {ACTION: PUBLIC_KEY_REQUEST, TIME: 1.0, ACCOUNT_NAME: 'test3'},
+                  {ACTION: PUBLIC_KEY_REQUEST, TIME: 1.0, ACCOUNT_NAME: 'test2'})
+        self.assertEqual([reply[RESPONSE] for reply in self.receive(peer, 2)], [400, 400])
+        self.assertIn(client, self.server.clients)
+
+
+class TestOfflineDelivery(ServerTestCase):
+    """Тестовый класс доставки сообщений, поступивших пока получатель был отключён"""
+    server_options = {'outbound_high_water': 64 * 1024, 'outbound_limit': 4 * 1024 * 1024}
+
+    def message(self, text, request_id):
+        return {ACTION: MESSAGE, TIME: 1.0, FROM: 'test1', TO: 'test2', MESSAGE: text, REQUEST_ID: request_id}
+
+    def test_store_and_forward(self):
+        """Сообщения ставятся в очередь, доставляются при входе и удаляются после отправки"""
+        sender, sender_peer = self.login('test1')
+        self.send(sender_peer, *(self.message(f'text {i}', i) for i in range(3)))
+        self.assertEqual([reply[RESPONSE] for reply in self.receive(sender_peer, 3)], [200] * 3)
+        self.assertEqual(len(self.database.peek_offline_messages('test2', 10)), 3)
+
+        client, peer = self.connect()
+        self.server.complete_login({USER: {ACCOUNT_NAME: 'test2'}}, client, None, time.time() + 60)
+        replies = self.receive(peer, 4)
+        self.assertEqual(replies[0][RESPONSE], 200)
+        self.assertEqual([message[MESSAGE] for message in replies[1:]], ['text 0', 'text 1', 'text 2'])
+        self.assertEqual(self.database.peek_offline_messages('test2', 10), [])
+
+    def test_ack_by_bytes_sent(self):
+        """Из очереди удаляются только сообщения, байты которых отправлены клиенту"""
+        text = 'x' * (512 * 1024)
+        for i in range(3):
+            self.database.store_message('test2', self.message(text, i))
+
+        # Получатель не читает: часть сообщений остаётся в очереди отправки
+        client, peer = self.connect()
+        self.server.complete_login({USER: {ACCOUNT_NAME: 'test2'}}, client, None, time.time() + 60)
+        self.pump()
+        self.assertLess(client.bytes_sent, client.bytes_queued)
+        self.assertTrue(client.offline_pending)
+        # Ни одно сообщение не отправлено целиком: все остаются в хранилище
+        self.assertEqual(len(self.database.peek_offline_messages('test2', 10)), 3)
+
+        replies = self.receive(peer, 4, timeout=5)
+        self.assertEqual([len(message.get(MESSAGE, '')) for message in replies[1:]], [len(text)] * 3)
+        self.assertEqual(self.database.peek_offline_messages('test2', 10), [])
+
+
+class TestAuthorization(ServerTestCase):
+    """Тестовый класс неблокирующей авторизации"""
+    server_options = {'auth_timeout': 0.2}
+
+    @staticmethod
+    def presence(name):
+        return {ACTION: PRESENCE, TIME: 1.0, USER: {ACCOUNT_NAME: name, PUBLIC_KEY: 'key'}}
+
+    @staticmethod
+    def answer(challenge, passwd_hash=b'hash'):
+        digest = hmac.new(passwd_hash, challenge[DATA].encode('ascii'), 'MD5').digest()
+        return {RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode('ascii')}
+
+    def test_password(self):
+        """Ответ на запрос 511 приходит следующим сообщением клиента"""
+        client, peer = self.connect()
+        self.send(peer, self.presence('test1'))
+        challenge, = self.receive(peer)
+        self.assertEqual(challenge[RESPONSE], 511)
+        self.assertIsInstance(client.challenge, Challenge)
+        self.assertFalse(client.authenticated)
+        self.send(peer, self.answer(challenge))
+        reply, = self.receive(peer)
+        self.assertEqual(reply[RESPONSE], 200)
+        self.assertIn(SESSION_TOKEN, reply)
+        self.assertIsNone(client.challenge)
+        self.assertIs(self.server.names['test1'], client)
+        self.assertEqual(self.database.get_pubkey('test1'), 'key')
+
+    def test_wrong_password(self):
+        """Неверный ответ на запрос 511 - ответ 400 и отключение"""
+        client, peer = self.connect()
+        self.send(peer, self.presence('test1'))
+        challenge, = self.receive(peer)
+        self.send(peer, self.answer(challenge, b'wrong'))
+        self.assertEqual(self.receive(peer)[0][RESPONSE], 400)
+        self.assertTrue(self.closed(peer))
+        self.assertFalse(self.server.is_online('test1'))
+
+    def test_unknown_and_busy_user(self):
+        """Незарегистрированное и занятое имя отклоняются до запроса пароля"""
+        self.login('test1')
+        for name in ('test1', 'test3'):
+            client, peer = self.connect()
+            self.send(peer, self.presence(name))
+            self.assertEqual(self.receive(peer)[0][RESPONSE], 400)
+            self.assertTrue(self.closed(peer))
+
+    def test_other_clients_served(self):
+        """Пока клиент не ответил на запрос 511, остальные клиенты обслуживаются"""
+        waiting, waiting_peer = self.connect()
+        self.send(waiting_peer, self.presence('test1'))
+        challenge, = self.receive(waiting_peer)
+        client, peer = self.login('test2')
+        self.send(peer, {ACTION: USERS_REQUEST, TIME: 1.0, ACCOUNT_NAME: 'test2'})
+        self.assertEqual(self.receive(peer)[0][RESPONSE], 202)
+        self.send(waiting_peer, self.answer(challenge))
+        self.assertEqual(self.receive(waiting_peer)[0][RESPONSE], 200)
+
+    def test_handshake_deadline(self):
+        """Клиенты, не прошедшие авторизацию вовремя, отключаются, остальные - нет"""
+        stalled, stalled_peer = self.connect()
+        self.send(stalled_peer, self.presence('test1'))
+        silent, silent_peer = self.connect()
+        client, peer = self.login('test2')
+        self.assertEqual(len(self.server.handshakes), 3)
+        time.sleep(0.3)
+        self.server.expire_handshakes()
+        self.assertEqual(len(self.server.handshakes), 0)
+        self.assertEqual(self.server.clients, {client})
+        self.assertTrue(self.closed(stalled_peer))
+        self.assertTrue(self.closed(silent_peer))
+
+    def password_login(self, name):
+        """Метод входа по паролю, возвращает выданный токен сессии."""
+        client, peer = self.connect()
+        self.send(peer, self.presence(name))
+        challenge, = self.receive(peer)
+        self.send(peer, self.answer(challenge))
+        reply, = self.receive(peer)
+        self.server.remove_client(client)
+        return reply[SESSION_TOKEN]
+
+    @staticmethod
+    def token_presence(name, token, nonce='nonce', timestamp=None, key='key'):
+        token_id, session_key = token.split('.')
+        timestamp = time.time() if timestamp is None else timestamp
+        proof = hmac.new(session_key.encode('ascii'), f'{nonce}:{timestamp!r}'.encode('ascii'), 'sha256')
+        return {ACTION: PRESENCE, TIME: timestamp,
+                USER: {ACCOUNT_NAME: name, PUBLIC_KEY_HASH: key_fingerprint(key)},
+                SESSION_TOKEN: token_id, TOKEN_NONCE: nonce,
+                TOKEN_PROOF: binascii.b2a_base64(proof.digest()).decode('ascii')}
+
+    def test_token_login(self):
+        """Вход по токену - один обмен без запроса 511 и без чтения базы"""
+        token = self.password_login('test1')
+        client, peer = self.connect()
+        with mock.patch.object(self.database, 'check_user', side_effect=AssertionError), \
+                mock.patch.object(self.database, 'get_pubkey', side_effect=AssertionError), \
+                mock.patch.object(self.database, 'get_hash', side_effect=AssertionError):
+            self.send(peer, self.token_presence('test1', token))
+        reply, = self.receive(peer)
+        self.assertEqual(reply[RESPONSE], 200)
+        self.assertIn(SESSION_TOKEN, reply)
+        self.assertIs(self.server.names['test1'], client)
+
+    def test_token_replay(self):
+        """Повтор сообщения о присутствии с токеном приводит к запросу пароля"""
+        token = self.password_login('test1')
+        presence = self.token_presence('test1', token)
+        client, peer = self.connect()
+        self.send(peer, presence)
+        self.assertEqual(self.receive(peer)[0][RESPONSE], 200)
+        self.server.remove_client(client)
+        client, peer = self.connect()
+        with self.assertLogs('server', 'WARNING'):
+            self.send(peer, presence)
+        self.assertEqual(self.receive(peer)[0][RESPONSE], 511)
+        self.assertFalse(self.server.is_online('test1'))
+
+    def test_token_rejected(self):
+        """Токен с другим ключом, старым временем или неверным HMAC - запрос пароля"""
+        token = self.password_login('test1')
+        token_id, session_key = token.split('.')
+        wrong_key = self.token_presence('test1', token, 'nonce1', key='other')
+        stale = self.token_presence('test1', token, 'nonce2', timestamp=time.time() - 2 * SESSION_PROOF_WINDOW)
+        forged = self.token_presence('test1', f'{token_id}.{"0" * len(session_key)}', 'nonce3')
+        for presence in (wrong_key, stale, forged):
+            client, peer = self.connect()
+            self.send(peer, presence)
+            self.assertEqual(self.receive(peer)[0][RESPONSE], 511)
+            self.assertFalse(self.server.is_online('test1'))
+        self.assertEqual(self.server.token_nonces.seen, set())
+
+    def test_not_presence_before_auth(self):
+        """Сообщение, отличное от PRESENCE, до авторизации - отключение"""
+        client, peer = self.connect()
+        self.send(peer, {ACTION: GET_CONTACTS, TIME: 1.0, USER: 'test1'})
+        self.assertNotIn(client, self.server.clients)
+        self.assertTrue(self.closed(peer))
+
+
+class TestHandlerErrors(ServerTestCase):
+    """Тестовый класс ошибок обработчиков действий"""
+
+    def test_handler_error(self):
+        """Ошибка обработчика отключает только клиента, запрос которого её вызвал"""
+        client, peer = self.login('test1')
+        other, other_peer = self.login('test2')
+        with mock.patch.object(self.database, 'get_contacts', side_effect=RuntimeError('сбой')), \
+                self.assertLogs('server', 'ERROR'):
+            self.send(peer, {ACTION: GET_CONTACTS, TIME: 1.0, USER: 'test1'},
+                      {ACTION: USERS_REQUEST, TIME: 1.0, ACCOUNT_NAME: 'test1'})
+            self.assertEqual([reply[RESPONSE] for reply in self.receive(peer, 2)], [400])
+        self.assertTrue(self.closed(peer))
+        self.assertFalse(self.server.is_online('test1'))
+        self.send(other_peer, {ACTION: GET_CONTACTS, TIME: 1.0, USER: 'test2'})
+        self.assertEqual(self.receive(other_peer)[0][RESPONSE], 202)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+"""Тесты базы данных сервера на SQLite"""
+
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy.orm import clear_mappers
+
+from server.database import ServerRepository, WriteScheduler, LruCache, MIGRATIONS, FULL_TEXT_SEARCH
+from server.repository import stats_key
+
+# для запуска из командной строки
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+
+class FakeSession:
+    """Сессия, запоминающая изменения до фиксации"""
+
+    def __init__(self):
+        self.staged = []
+        self.committed = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.committed += self.staged
+        self.staged = []
+        self.commits += 1
+
+    def rollback(self):
+        self.staged = []
+        self.rollbacks += 1
+
+
+class TestWriteScheduler(unittest.TestCase):
+    """Тестовый класс потока записи"""
+
+    def setUp(self):
+        self.session = FakeSession()
+        self.writer = WriteScheduler(self.session, 0.05, 100)
+
+    def change(self, value):
+        if value is None:
+            raise ValueError('Ошибка изменения')
+        self.session.staged.append(value)
+        return value
+
+    def test_batch(self):
+        """Изменения, поставленные в очередь вместе, фиксируются одной транзакцией"""
+        futures = [self.writer.submit(self.change, i) for i in range(10)]
+        self.writer.start()
+        self.assertEqual([future.result(5) for future in futures], list(range(10)))
+        self.assertEqual(self.session.committed, list(range(10)))
+        self.assertEqual(self.session.commits, 1)
+
+    def test_rollback_replay(self):
+        """Ошибка одного изменения не отменяет остальные изменения пачки"""
+        futures = [self.writer.submit(self.change, value) for value in (1, None, 2)]
+        with self.assertLogs('server', 'ERROR'):
+            self.writer.start()
+            self.assertEqual(futures[0].result(5), 1)
+            self.assertRaises(ValueError, futures[1].result, 5)
+            self.assertEqual(futures[2].result(5), 2)
+        self.assertEqual(self.session.committed, [1, 2])
+        self.assertEqual(self.session.rollbacks, 2)
+
+
+class TestLruCache(unittest.TestCase):
+    """Тестовый класс кэша записей"""
+
+    def test_evict(self):
+        """Вытесняется давно не использованная запись"""
+        cache = LruCache(2)
+        cache.get('a', str.upper)
+        cache.get('b', str.upper)
+        cache.get('a', str.upper)
+        cache.get('c', str.upper)
+        self.assertEqual(list(cache.data), ['a', 'c'])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 3, 'size': 2})
+
+    def test_invalidate_during_load(self):
+        """Значение, загруженное до сброса записи, не сохраняется"""
+        cache = LruCache(2)
+
+        def loader(key):
+            cache.invalidate(key)
+            return 'stale'
+
+        self.assertEqual(cache.get('a', loader), 'stale')
+        self.assertEqual(cache.get('a', lambda key: 'fresh'), 'fresh')
+        self.assertEqual(cache.get('a', loader), 'fresh')
+
+
+class TestServerRepository(unittest.TestCase):
+    """Тестовый класс базы данных сервера"""
+
+    def setUp(self):
+        self.database = self.open_database()
+        for i in range(1, 4):
+            self.database.add_user(f'test{i}', 'hash')
+
+    def tearDown(self):
+        self.close_database()
+
+    def open_database(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'server_database.db3')
+        return ServerRepository(self.path)
+
+    def close_database(self):
+        # Классы таблиц связываются с таблицами заново в каждой базе
+        self.database.flush()
+        self.database.session.remove()
+        self.database.engine.dispose()
+        clear_mappers()
+
+    def test_migrations(self):
+        """Недостающие миграции применяются по номеру из user_version"""
+        with sqlite3.connect(self.path) as connection:
+            self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+            connection.execute('DROP INDEX ix_history_sent')
+            connection.execute('PRAGMA user_version = 3')
+        self.database.migrate()
+        with sqlite3.connect(self.path) as connection:
+            self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+            indexes = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertIn('ix_history_sent', indexes)
+
+    def test_without_full_text_search(self):
+        """Без FTS5 база открывается, поиск по архиву идёт по подстроке"""
+        self.close_database()
+        statements = [statement.replace('fts5(', 'fts_missing(') for statement in FULL_TEXT_SEARCH]
+        with mock.patch('server.database.FULL_TEXT_SEARCH', statements), self.assertLogs('server', 'WARNING'):
+            self.database = self.open_database()
+        self.assertFalse(self.database.full_text_search)
+        self.database.add_user('test1', 'hash')
+        self.database.add_user('test2', 'hash')
+        self.database.archive_message('test1', 'test2', 10, 'digest', '100% hello')
+        self.database.archive_message('test1', 'test2', 10, 'digest', 'other')
+        self.database.flush()
+        self.assertEqual([row.text for row in self.database.archive_page(query='%')], ['100% hello'])
+
+    def test_user_cache_invalidation(self):
+        """Изменения пользователя видны сразу после записи, несмотря на кэш"""
+        self.assertFalse(self.database.check_user('test4'))
+        self.database.add_user('test4', 'hash')
+        self.assertTrue(self.database.check_user('test4'))
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key1')
+        self.database.sync()
+        self.assertEqual(self.database.get_pubkey('test1'), 'key1')
+        self.database.user_logout('test1')
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key2')
+        self.database.sync()
+        self.assertEqual(self.database.get_pubkey('test1'), 'key2')
+        self.database.remove_user('test4')
+        self.assertFalse(self.database.check_user('test4'))
+
+    def test_unknown_user_credentials(self):
+        """Для незарегистрированного пользователя хэш и ключ - None"""
+        self.assertIsNone(self.database.get_hash('test4'))
+        self.assertIsNone(self.database.get_pubkey('test4'))
+        self.assertIsNone(self.database.user_credentials('test4'))
+
+    def test_offline_messages(self):
+        """Выборка не удаляет сообщения, удаляет только подтверждение"""
+        for i in range(3):
+            self.database.store_message('test2', {'text': i})
+        first = self.database.peek_offline_messages('test2', 2)
+        self.assertEqual([message for _, message in first], [{'text': 0}, {'text': 1}])
+        rest = self.database.peek_offline_messages('test2', 2, first[-1][0])
+        self.assertEqual([message for _, message in rest], [{'text': 2}])
+        self.database.ack_offline_messages('test2', first[-1][0])
+        self.assertEqual(self.database.pop_offline_messages('test2', 5), [{'text': 2}])
+
+    def test_expired_messages(self):
+        """Просроченные сообщения удаляются пачками в потоке записи"""
+        for i in range(5):
+            self.database.store_message('test2', {'text': i})
+        self.database.store_message('test1', {'text': 5})
+        self.database.sync()
+        with self.assertLogs('server', 'INFO') as logs:
+            self.assertIsNone(self.database.remove_expired_messages(-1, chunk=2))
+            # Удаление отпускает блокировку после последней пачки
+            self.assertTrue(self.database.expire_lock.acquire(timeout=5))
+        self.database.expire_lock.release()
+        self.assertIn('6', logs.output[-1])
+        self.assertEqual(self.database.peek_offline_messages('test2', 10), [])
+        self.assertEqual(self.database.peek_offline_messages('test1', 10), [])
+
+    def test_compact_history(self):
+        """Старые записи истории входов сворачиваются в суточные итоги"""
+        old = datetime.datetime.now() - datetime.timedelta(days=40)
+        user = self.database.user_record('test1')
+        session = self.database.session
+        session.add_all([self.database.HistoryUser(user.id, old, '127.0.0.1', 7777) for _ in range(5)])
+        session.commit()
+        session.remove()
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key')
+        self.database.compact_history(30, chunk=2)
+        # Свёртка идёт пачками в потоке записи и отпускает блокировку в конце
+        self.assertTrue(self.database.compact_lock.acquire(timeout=5))
+        self.database.compact_lock.release()
+        self.assertEqual(self.database.user_history_daily('test1'), [('test1', old.date(), 5)])
+        self.assertEqual(len(self.database.user_history('test1')), 1)
+
+    def test_archive_page(self):
+        """Архив выбирается страницами от новых записей с фильтрами"""
+        for i in range(5):
+            self.database.archive_message('test1', 'test2', 10, 'digest', f'hello {i}')
+        self.database.archive_message('test2', 'test1', 10, 'digest')
+        self.database.flush()
+        page = self.database.archive_page(limit=4)
+        self.assertEqual([row.text for row in page], [None, 'hello 4', 'hello 3', 'hello 2'])
+        page = self.database.archive_page(before=page[-1].id, limit=4)
+        self.assertEqual([row.text for row in page], ['hello 1', 'hello 0'])
+        self.assertEqual(len(self.database.archive_page(sender='test2')), 1)
+        self.assertEqual([row.text for row in self.database.archive_page(query='hello 3')], ['hello 3'])
+
+    def test_message_history_page(self):
+        """Незаписанные счётчики не сбивают постраничную выборку"""
+        names = [f'test{i}' for i in range(1, 11)]
+        for name in names[3:]:
+            self.database.add_user(name, 'hash')
+        for i, name in enumerate(names):
+            for _ in range(i):
+                self.database.process_message(name, 'test1')
+        self.database.flush()
+        # Незаписанные счётчики меняют показываемый порядок строк
+        for name in names[::2]:
+            for _ in range(3):
+                self.database.process_message(name, 'test2')
+        rows = []
+        after = None
+        for _ in range(len(names)):
+            page = self.database.message_history_page('sent', descending=True, after=after, limit=3)
+            rows += page
+            if len(page) < 3:
+                break
+            after = stats_key(page[-1], 'sent')
+        self.assertEqual(sorted(row.name for row in rows), sorted(names))
+        row = next(row for row in rows if row.name == 'test3')
+        self.assertEqual((row.sent, row.stored_sent), (5, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
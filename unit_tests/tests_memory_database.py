@@ -0,0 +1,122 @@
+"""Тесты хранилища сервера в памяти"""
+
+import datetime
+import os
+import sys
+import unittest
+
+from server.memory_database import MemoryRepository
+from server.repository import UserStats, stats_key
+
+# для запуска из командной строки
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+
+class TestMemoryRepository(unittest.TestCase):
+    """Тестовый класс хранилища в памяти"""
+
+    def setUp(self):
+        self.database = MemoryRepository()
+        self.database.add_user('test1', 'hash1')
+        self.database.add_user('test2', 'hash2')
+
+    def test_login_logout(self):
+        """Вход и выход отражаются в списке подключённых и истории"""
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key')
+        self.assertEqual([row[:3] for row in self.database.active_users_list()], [('test1', '127.0.0.1', 7777)])
+        self.assertEqual(self.database.get_pubkey('test1'), 'key')
+        self.database.user_logout('test1')
+        self.assertEqual(self.database.active_users_list(), [])
+        self.assertEqual(len(self.database.user_history('test1')), 1)
+
+    def test_login_same_key(self):
+        """Вход без ключа (ключ не изменился) сохраняет прежний ключ"""
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key')
+        self.database.user_logout('test1')
+        self.database.user_login('test1', '127.0.0.1', 7777, None)
+        self.assertEqual(self.database.get_pubkey('test1'), 'key')
+
+    def test_login_unknown_user(self):
+        """Вход незарегистрированного пользователя"""
+        self.assertRaises(ValueError, self.database.user_login, 'test3', '127.0.0.1', 7777, 'key')
+
+    def test_unknown_user_credentials(self):
+        """Для незарегистрированного пользователя хэш и ключ - None"""
+        self.assertIsNone(self.database.get_hash('test3'))
+        self.assertIsNone(self.database.get_pubkey('test3'))
+        self.assertIsNone(self.database.user_credentials('test3'))
+
+    def test_offline_messages(self):
+        """Сообщения отдаются в порядке поступления не больше limit за раз"""
+        for i in range(3):
+            self.database.store_message('test2', {'text': i})
+        self.assertEqual(self.database.pop_offline_messages('test2', 2), [{'text': 0}, {'text': 1}])
+        self.assertEqual(self.database.remove_expired_messages(-1), 1)
+        self.assertEqual(self.database.pop_offline_messages('test2', 2), [])
+
+    def test_peek_ack_offline_messages(self):
+        """Выборка не удаляет сообщения, удаляет только подтверждение"""
+        for i in range(3):
+            self.database.store_message('test2', {'text': i})
+        first = self.database.peek_offline_messages('test2', 2)
+        self.assertEqual([message for _, message in first], [{'text': 0}, {'text': 1}])
+        rest = self.database.peek_offline_messages('test2', 2, first[-1][0])
+        self.assertEqual([message for _, message in rest], [{'text': 2}])
+        self.database.ack_offline_messages('test2', first[0][0])
+        self.assertEqual(self.database.peek_offline_messages('test2', 5)[0], first[1])
+
+    def test_compact_history(self):
+        """Старые записи истории входов сворачиваются в суточные итоги"""
+        old = datetime.datetime.now() - datetime.timedelta(days=40)
+        self.database.history.extend([('test1', old, '127.0.0.1', 7777)] * 5)
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key')
+        self.database.compact_history(30, chunk=2)
+        self.assertEqual(self.database.user_history_daily('test1'), [('test1', old.date(), 5)])
+        self.assertEqual(len(self.database.user_history('test1')), 1)
+
+    def test_archive_page(self):
+        """Архив отдаётся страницами, новые сообщения первыми"""
+        for i in range(5):
+            self.database.archive_message('test1', 'test2', 5, 'hash', f'text {i}')
+        page = self.database.archive_page(limit=3)
+        self.assertEqual([record.text for record in page], ['text 4', 'text 3', 'text 2'])
+        page = self.database.archive_page(before=page[-1].id, limit=3)
+        self.assertEqual([record.text for record in page], ['text 1', 'text 0'])
+        self.assertEqual(len(self.database.archive_page(query='TEXT 1')), 1)
+        self.assertEqual(self.database.archive_page(sender='test2'), [])
+
+    def test_message_history_page(self):
+        """Статистика отдаётся страницами в порядке выбранного столбца"""
+        for i in range(3, 8):
+            self.database.add_user(f'test{i}', 'hash')
+        self.database.process_message('test5', 'test1')
+        page = self.database.message_history_page('sent', descending=True, limit=1)
+        self.assertEqual([row.name for row in page], ['test5'])
+        names = []
+        after = None
+        while True:
+            page = self.database.message_history_page(after=after, limit=3)
+            names += [row.name for row in page]
+            if len(page) < 3:
+                break
+            after = stats_key(page[-1], 'name')
+        self.assertEqual(names, sorted(f'test{i}' for i in range(1, 8)))
+
+    def test_stats_key(self):
+        """Ключ страницы по счётчикам строится по записанным значениям"""
+        row = UserStats(3, 'test1', None, 10, 20, 7, 15)
+        self.assertEqual(stats_key(row, 'sent'), (7, 3))
+        self.assertEqual(stats_key(row, 'accepted'), (15, 3))
+        self.assertEqual(stats_key(row, 'name'), ('test1', 3))
+
+    def test_remove_user(self):
+        """Удалённый пользователь пропадает из контактов других пользователей"""
+        self.database.add_contact('test1', 'test2')
+        self.assertEqual(self.database.get_contacts('test1'), ['test2'])
+        self.database.remove_user('test2')
+        self.assertEqual(self.database.get_contacts('test1'), [])
+        self.assertFalse(self.database.check_user('test2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
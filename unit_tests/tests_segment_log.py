@@ -0,0 +1,88 @@
+"""Тесты журнала сегментов"""
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from server.segment_log import SegmentLog
+
+# для запуска из командной строки
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+
+class TestSegmentLog(unittest.TestCase):
+    """Тестовый класс журнала сегментов"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Маленькие сегменты, чтобы журнал занял несколько файлов
+        self.log = SegmentLog(self.directory, 4096)
+
+    def tearDown(self):
+        self.log.close()
+
+    def reopen(self):
+        self.log.close()
+        self.log = SegmentLog(self.directory, 4096)
+
+    def test_pop_after_restart(self):
+        """Доставленные сообщения не возвращаются после перезапуска"""
+        for i in range(300):
+            self.log.append('test1', b'message %d' % i)
+        self.assertGreater(len(self.log.segments), 1)
+        self.assertEqual(self.log.pop('test1', 2), [b'message 0', b'message 1'])
+        self.reopen()
+        self.assertEqual(len(self.log.pop('test1')), 298)
+        self.reopen()
+        self.assertEqual(self.log.pop('test1'), [])
+
+    def test_peek_ack_after_restart(self):
+        """Выбранные без подтверждения сообщения возвращаются после перезапуска"""
+        for i in range(300):
+            self.log.append('test1', b'message %d' % i)
+        first = self.log.peek('test1', 2)
+        self.assertEqual([data for _, data in first], [b'message 0', b'message 1'])
+        self.assertEqual(self.log.peek('test1', 1, first[-1][0])[0][1], b'message 2')
+        self.reopen()
+        self.assertEqual([(position, bytes(data)) for position, data in self.log.peek('test1', 1)],
+                         [(first[0][0], b'message 0')])
+        self.log.ack('test1', first[-1][0])
+        self.reopen()
+        self.assertEqual(len(self.log.pop('test1')), 298)
+
+    def test_pop_empty(self):
+        """Выборка нуля сообщений и выборка из пустой очереди ничего не подтверждают"""
+        self.log.append('test1', b'message')
+        self.assertEqual(self.log.pop('test1', 0), [])
+        self.assertEqual(self.log.pop('test2'), [])
+        self.assertEqual(self.log.pop('test1'), [b'message'])
+
+    def test_views_released_on_close(self):
+        """Данные выдаются без копирования, срезы освобождаются при закрытии сегментов"""
+        self.log.append('test1', b'message')
+        (_, peeked), = self.log.peek('test1', 1)
+        popped, = self.log.pop('test1')
+        self.assertIsInstance(popped, memoryview)
+        self.assertEqual(peeked, popped)
+        self.log.close()
+        self.assertRaises(ValueError, bytes, peeked)
+        self.assertRaises(ValueError, bytes, popped)
+        self.log = SegmentLog(self.directory, 4096)
+
+    def test_expire(self):
+        """Просроченные сообщения удаляются вместе с ненужными сегментами"""
+        for i in range(300):
+            self.log.append('test1', b'message %d' % i)
+        time.sleep(0.05)
+        self.log.append('test2', b'new')
+        self.assertEqual(self.log.expire(0.03), 300)
+        self.assertEqual(len(self.log.segments), 1)
+        self.reopen()
+        self.assertEqual(self.log.pop('test1'), [])
+        self.assertEqual(self.log.pop('test2'), [b'new'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Тесты токенов возобновления сессии"""
+
+import os
+import sys
+import unittest
+
+from server.tokens import make_token, token_key, token_proof, check_token_id, NonceCache
+
+# для запуска из командной строки
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+
+class TestTokens(unittest.TestCase):
+    """Тестовый класс токенов возобновления сессии"""
+    secret = b'secret'
+
+    def test_valid(self):
+        """Действующий токен возвращает имя пользователя, срок сессии и отпечаток ключа"""
+        token_id = make_token(self.secret, 'test:1', 60, 5000, now=1000, fingerprint='abc').split('.')[0]
+        self.assertEqual(check_token_id(token_id, now=1059), ('test:1', 5000, 'abc'))
+        token_id = make_token(self.secret, 'test1', 60, 5000, now=1000).split('.')[0]
+        self.assertEqual(check_token_id(token_id, now=1059), ('test1', 5000, None))
+
+    def test_expired(self):
+        """Просроченный токен не принимается"""
+        token_id = make_token(self.secret, 'test1', 60, 5000, now=1000).split('.')[0]
+        self.assertIsNone(check_token_id(token_id, now=1061))
+
+    def test_deadline(self):
+        """Токен не действует дольше предельного срока сессии"""
+        token_id = make_token(self.secret, 'test1', 60, 1030, now=1000).split('.')[0]
+        self.assertEqual(check_token_id(token_id, now=1030), ('test1', 1030, None))
+        self.assertIsNone(check_token_id(token_id, now=1031))
+
+    def test_key(self):
+        """Ключ сессии вычисляется сервером по идентификатору токена"""
+        token_id, key = make_token(self.secret, 'test1', 60, 5000).split('.')
+        self.assertEqual(token_key(self.secret, token_id), key)
+        self.assertNotEqual(token_key(b'other', token_id), key)
+        forged = make_token(self.secret, 'test2', 60, 5000).split('.')[0]
+        self.assertNotEqual(token_key(self.secret, forged), key)
+        forged = make_token(self.secret, 'test1', 60, 5000, fingerprint='other').split('.')[0]
+        self.assertNotEqual(token_key(self.secret, forged), key)
+
+    def test_proof(self):
+        """Доказательство владения ключом зависит от строки клиента и времени"""
+        key = make_token(self.secret, 'test1', 60, 5000).split('.')[1]
+        self.assertEqual(token_proof(key, 'abc', 1.5), token_proof(key, 'abc', 1.5))
+        self.assertNotEqual(token_proof(key, 'abc', 1.5), token_proof(key, 'abd', 1.5))
+        self.assertNotEqual(token_proof(key, 'abc', 1.5), token_proof(key, 'abc', 2.5))
+
+    def test_malformed(self):
+        """Повреждённый токен не принимается"""
+        for token_id in ('', 'abc', 'a.b.c', 'ф', None, 123):
+            self.assertIsNone(check_token_id(token_id))
+
+    def test_nonce_cache(self):
+        """Строка отклоняется повторно в пределах окна и принимается после него"""
+        nonces = NonceCache(60)
+        self.assertTrue(nonces.add('abc', now=1000))
+        self.assertTrue(nonces.add('abd', now=1010))
+        self.assertFalse(nonces.add('abc', now=1060))
+        self.assertTrue(nonces.add('abc', now=1061))
+        self.assertEqual(nonces.seen, {'abc', 'abd'})
+        nonces.add('abe', now=1100)
+        self.assertEqual(nonces.seen, {'abc', 'abe'})
+
+
+if __name__ == '__main__':
+    unittest.main()
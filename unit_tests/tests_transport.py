@@ -0,0 +1,187 @@
+"""Тесты транспорта клиента ClientTransport"""
+
+import os
+import socket
+import sys
+import threading
+import unittest
+from collections import deque
+from unittest import mock
+
+from base.variables import *
+from base.utils import encode_message, MessageDecoder
+from client.transport import ClientTransport
+
+# для запуска из командной строки
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+
+class TransportTestCase(unittest.TestCase):
+    """
+    Базовый класс тестов транспорта. Транспорт создаётся без подключения
+    к серверу: вместо сервера - второй конец socketpair, поток приёма
+    запускается так же, как после авторизации.
+    """
+
+    def setUp(self):
+        with mock.patch.object(ClientTransport, 'connection_init'), \
+                mock.patch.object(ClientTransport, 'lists_update'):
+            self.transport = ClientTransport(7777, '127.0.0.1', None, 'test1', 'password', None)
+        self.servers = []
+        self.server = self.connect()
+        self.transport.connected = True
+        self.transport.reader = threading.Thread(target=self.transport.read_messages, daemon=True)
+        self.transport.reader.start()
+        # Ответы сервера на отправленные сообщения
+        self.sent = []
+        self.rejected = []
+        self.answered = threading.Semaphore(0)
+        self.transport.message_sent.connect(lambda *args: self.answer(self.sent, args))
+        self.transport.message_rejected.connect(lambda *args: self.answer(self.rejected, args))
+
+    def tearDown(self):
+        self.transport.running = False
+        self.transport.stopped.set()
+        for server in self.servers:
+            server.close()
+        self.transport.reader.join(2)
+        self.transport.transport.close()
+
+    def connect(self):
+        """Метод подключения транспорта, возвращает сокет сервера."""
+        server, self.transport.transport = socket.socketpair()
+        server.settimeout(2)
+        self.transport.transport.settimeout(0.1)
+        self.servers.append(server)
+        return server
+
+    def answer(self, answers, args):
+        answers.append(args)
+        self.answered.release()
+
+    @staticmethod
+    def receive(server, count=1, timeout=2):
+        """Метод приёма count запросов клиента."""
+        server.settimeout(timeout)
+        decoder = MessageDecoder()
+        messages = []
+        while len(messages) < count:
+            try:
+                data = server.recv(MAX_PACKAGE_LENGTH)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            messages += decoder.feed(data)
+        return messages
+
+    @staticmethod
+    def reply(server, *messages):
+        server.sendall(b''.join(encode_message(message) for message in messages))
+
+
+class TestRequests(TransportTestCase):
+    """Тестовый класс сопоставления ответов запросам"""
+
+    def test_out_of_order(self):
+        """Ответы, пришедшие не по порядку, передаются своим запросам по номеру"""
+        users = self.transport.users_request()
+        contacts = self.transport.contacts_request()
+        first, second = self.receive(self.server, 2)
+        self.assertEqual((first[ACTION], second[ACTION]), (USERS_REQUEST, GET_CONTACTS))
+        self.reply(self.server,
+                   {RESPONSE: 202, LIST_INFO: ['contact'], REQUEST_ID: second[REQUEST_ID]},
+                   {RESPONSE: 202, LIST_INFO: ['user'], REQUEST_ID: first[REQUEST_ID]})
+        users, contacts = self.transport.wait_replies([users, contacts])
+        self.assertEqual(users[LIST_INFO], ['user'])
+        self.assertEqual(contacts[LIST_INFO], ['contact'])
+
+    def test_reply_without_id(self):
+        """Ответ без номера запроса не передаётся ни одному запросу"""
+        future = self.transport.users_request()
+        request, = self.receive(self.server)
+        with self.assertLogs('client', 'DEBUG'):
+            self.reply(self.server, {RESPONSE: 202, LIST_INFO: ['wrong']},
+                       {RESPONSE: 202, LIST_INFO: ['user'], REQUEST_ID: request[REQUEST_ID]})
+            self.assertEqual(self.transport.wait_reply(future)[LIST_INFO], ['user'])
+        self.assertEqual(self.transport.pending, {})
+
+
+class TestSendMessage(TransportTestCase):
+    """Тестовый класс отправки сообщений пользователям"""
+
+    def test_accepted(self):
+        """Сообщение считается отправленным только после ответа 200"""
+        future = self.transport.send_message('test2', 'text')
+        request, = self.receive(self.server)
+        self.assertEqual((request[ACTION], request[TO], request[MESSAGE]), (MSG, 'test2', 'text'))
+        self.assertEqual(self.sent, [])
+        self.reply(self.server, {RESPONSE: 200, REQUEST_ID: request[REQUEST_ID]})
+        self.assertEqual(future.result(2), {RESPONSE: 200, REQUEST_ID: request[REQUEST_ID]})
+        self.assertTrue(self.answered.acquire(timeout=2))
+        self.assertEqual(self.sent, [('test2', 'text')])
+        self.assertEqual(self.rejected, [])
+
+    def test_rejected(self):
+        """Отказ сервера передаётся сигналом message_rejected"""
+        self.transport.send_message('test3', 'text')
+        request, = self.receive(self.server)
+        self.reply(self.server, {RESPONSE: 400, ERROR: 'Bad request', REQUEST_ID: request[REQUEST_ID]})
+        self.assertTrue(self.answered.acquire(timeout=2))
+        self.assertEqual(self.sent, [])
+        self.assertEqual(self.rejected, [('test3', 'text', 'Bad request')])
+
+
+class TestReconnect(TransportTestCase):
+    """Тестовый класс переподключения после разрыва соединения"""
+
+    def test_backoff(self):
+        """Задержка перед попыткой случайна, её предел растёт вдвое до RECONNECT_MAX_DELAY"""
+        with mock.patch('client.transport.random.uniform', return_value=0) as uniform, \
+                mock.patch.object(self.transport, 'connect', side_effect=ConnectionRefusedError):
+            self.assertFalse(self.transport.reconnect())
+        self.assertEqual([call.args for call in uniform.call_args_list],
+                         [(0, min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** attempt))
+                          for attempt in range(RECONNECT_ATTEMPTS)])
+
+    def test_no_replay(self):
+        """Запросы без ответа завершаются ошибкой, отложенные отправляются один раз"""
+        allow = threading.Event()
+        reconnected = threading.Event()
+        servers = []
+
+        def connect():
+            allow.wait(5)
+            servers.append(self.connect())
+            reconnected.set()
+
+        users = self.transport.users_request()
+        first = self.transport.send_message('test2', 'first')
+        self.assertEqual(len(self.receive(self.server, 2)), 2)
+        with mock.patch('client.transport.RECONNECT_DELAY', 0), \
+                mock.patch.object(self.transport, 'connect', side_effect=connect), \
+                mock.patch.object(self.transport, 'authorize'), \
+                self.assertLogs('client', 'ERROR'):
+            # Разрыв посреди запросов
+            self.server.close()
+            self.assertRaises(ConnectionResetError, users.result, 2)
+            self.assertRaises(ConnectionResetError, first.result, 2)
+            second = self.transport.send_message('test2', 'second')
+            self.assertEqual(len(self.transport.outbox), 1)
+            allow.set()
+            self.assertTrue(reconnected.wait(2))
+            request, = self.receive(servers[0])
+        self.assertEqual((request[MESSAGE], request[REQUEST_ID]), ('second', 3))
+        self.reply(servers[0], {RESPONSE: 200, REQUEST_ID: request[REQUEST_ID]})
+        self.assertEqual(second.result(2)[RESPONSE], 200)
+        # Других запросов после переподключения не было
+        self.assertEqual(self.receive(servers[0], timeout=0.2), [])
+        self.assertEqual(self.transport.outbox, deque())
+        for _ in range(2):
+            self.assertTrue(self.answered.acquire(timeout=2))
+        self.assertEqual(self.sent, [('test2', 'second')])
+        self.assertEqual([args[:2] for args in self.rejected], [('test2', 'first')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,10 +2,12 @@
 
 import json
 import os
+import socket
 import sys
 import unittest
+from unittest import mock
 
-from base.utils import sending_message, getting_message
+from base.utils import sending_message, getting_message, encode_message, MessageDecoder, HEADER
 from base.variables import *
 
 # для запуска из командной строки
@@ -23,17 +25,20 @@ class TestSocket:
         self.test_dictionary = test_dictionary
         self.encoded_message = None
         self.received_message = None
+        # Байты, которые будут отданы при чтении из сокета
+        message_in_json = json.dumps(self.test_dictionary).encode(ENCODING)
+        self.stream = HEADER.pack(len(message_in_json)) + message_in_json
 
     def recv(self, max_length):
         """
-        Получение данных из сокета и кодирование их
+        Получение данных из сокета, отдаёт не больше max_length байт
         :param max_length:
         :return:
         """
-        message_in_json = json.dumps(self.test_dictionary)
-        return message_in_json.encode(ENCODING)
+        data, self.stream = self.stream[:max_length], self.stream[max_length:]
+        return data
 
-    def send(self, message_to_send):
+    def sendall(self, message_to_send):
         """
         Тестовая функция отправки, корретно  кодирует сообщение,
         также сохраняет, то что должно быть отправлено в сокет.
@@ -41,13 +46,29 @@ class TestSocket:
         :param message_to_send:
         :return:
         """
-        message_in_json = json.dumps(self.test_dictionary)
+        message_in_json = json.dumps(self.test_dictionary).encode(ENCODING)
         # кодирует сообщение
-        self.encoded_message = message_in_json.encode(ENCODING)
+        self.encoded_message = HEADER.pack(len(message_in_json)) + message_in_json
         # сохраняем что должно было отправлено в сокет
         self.received_message = message_to_send
 
 
+class StalledSocket(TestSocket):
+    """
+    Тестовый сокет, который отдаёт часть кадра, после чего
+    чтение из него завершается по таймауту.
+    """
+
+    def __init__(self, test_dictionary, length):
+        super().__init__(test_dictionary)
+        self.stream = self.stream[:length]
+
+    def recv(self, max_length):
+        if not self.stream:
+            raise socket.timeout('timed out')
+        return super().recv(max_length)
+
+
 class TestClassUtils(unittest.TestCase):
     """Класс для тестирования утилит"""
     test_dictionary_send = {
@@ -87,6 +108,50 @@ class TestClassUtils(unittest.TestCase):
         # тест корректной расшифровки ошибочного словаря
         self.assertEqual(getting_message(test_sock_4xx), self.test_dict_recv_4xx)
 
+    def test_getting_long_message(self):
+        """Тест приёма сообщения длиннее блока чтения из сокета"""
+        test_dict = {RESPONSE: 202, LIST_INFO: ['user'] * MAX_PACKAGE_LENGTH}
+        self.assertEqual(getting_message(TestSocket(test_dict)), test_dict)
+
+    def test_getting_closed_socket(self):
+        """Тест приёма из закрытого удалённой стороной сокета"""
+        test_sock = TestSocket(self.test_dict_recv_2xx)
+        test_sock.stream = b''
+        self.assertRaises(ConnectionError, getting_message, test_sock)
+
+    def test_getting_message_timeout(self):
+        """Тест таймаута до начала кадра - приём можно повторить"""
+        self.assertRaises(socket.timeout, getting_message, StalledSocket(self.test_dict_recv_2xx, 0))
+
+    def test_getting_stalled_message(self):
+        """Тест приёма кадра, отправка которого остановилась на середине"""
+        with mock.patch('base.utils.FRAME_TIMEOUT', 0.1):
+            self.assertRaises(ConnectionAbortedError, getting_message, StalledSocket(self.test_dict_recv_2xx, 2))
+            self.assertRaises(ConnectionAbortedError, getting_message, StalledSocket(self.test_dict_recv_2xx, 6))
+
+    def test_decoder_several_messages(self):
+        """Тест декодера - несколько сообщений в одном чтении"""
+        data = encode_message(self.test_dict_recv_2xx) + encode_message(self.test_dict_recv_4xx)
+        self.assertEqual(MessageDecoder().feed(data), [self.test_dict_recv_2xx, self.test_dict_recv_4xx])
+
+    def test_decoder_partial_message(self):
+        """Тест декодера - сообщение, принятое по частям"""
+        decoder = MessageDecoder()
+        data = encode_message(self.test_dictionary_send)
+        self.assertEqual(decoder.feed(data[:3]), [])
+        self.assertEqual(decoder.feed(data[3:10]), [])
+        self.assertEqual(decoder.feed(data[10:]), [self.test_dictionary_send])
+        self.assertEqual(decoder.buffer, bytearray())
+
+    def test_decoder_too_long_message(self):
+        """Тест декодера - ошибка при превышении размера сообщения"""
+        self.assertRaises(ValueError, MessageDecoder().feed, HEADER.pack(MAX_MESSAGE_SIZE + 1))
+
+    def test_decoder_not_dict(self):
+        """Тест декодера - ошибка, если принят не словарь"""
+        body = json.dumps([1, 2]).encode(ENCODING)
+        self.assertRaises(ValueError, MessageDecoder().feed, HEADER.pack(len(body)) + body)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,108 @@
+"""Тесты многопроцессного режима сервера"""
+
+import os
+import socket
+import sys
+import unittest
+from collections import Counter
+
+from base.variables import *
+from base.utils import MessageDecoder
+from server.memory_database import MemoryRepository
+from server.workers import WorkerRepository, WorkerMessageProcessor, IPC_KICK, IPC_LOGOUT, DUPLICATE
+from unit_tests.tests_center import ServerTestCase
+
+# для запуска из командной строки
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+
+class CountingProxy:
+    """Прокси базы данных, считающий обращения к процессу менеджера"""
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        method = getattr(self.repository, name)
+
+        def call(*args):
+            self.calls[name] += 1
+            return method(*args)
+
+        return call
+
+
+class TestWorkerRepository(unittest.TestCase):
+    """Тестовый класс хранилища процесса-обработчика"""
+
+    def setUp(self):
+        self.owner = MemoryRepository()
+        self.owner.add_user('test1', 'hash1')
+        self.owner.add_user('test2', 'hash2')
+        self.proxy = CountingProxy(self.owner)
+        self.database = WorkerRepository(self.proxy)
+
+    def test_message_stats_batch(self):
+        """Статистика и архив передаются менеджеру одной пачкой"""
+        for _ in range(10):
+            self.database.process_message('test1', 'test2')
+            self.database.archive_message('test1', 'test2', 4, 'hash', 'text')
+        self.assertEqual(sum(self.proxy.calls.values()), 0)
+        self.database.flush_message_stats()
+        self.assertEqual(self.proxy.calls, Counter(add_message_stats=1, archive_messages=1, flush_message_stats=1))
+        self.assertEqual(sorted(row[2:] for row in self.owner.message_history()), [(0, 10), (10, 0)])
+        self.assertEqual(len(self.owner.archive_page()), 10)
+        self.database.flush_message_stats()
+        self.assertEqual(sum(self.proxy.calls.values()), 3)
+
+    def test_user_cache(self):
+        """Записи пользователей читаются у менеджера один раз до сброса"""
+        for _ in range(3):
+            self.assertTrue(self.database.check_user('test1'))
+            self.assertEqual(self.database.get_hash('test1'), 'hash1')
+        self.assertEqual(self.proxy.calls['user_credentials'], 1)
+        self.owner.user_login('test1', '127.0.0.1', 7777, 'key')
+        self.database.forget_user('test1')
+        self.assertEqual(self.database.get_pubkey('test1'), 'key')
+        self.assertEqual(self.proxy.calls['user_credentials'], 2)
+
+    def test_unknown_user(self):
+        """Незарегистрированный пользователь виден после сброса кэша"""
+        self.assertFalse(self.database.check_user('test3'))
+        self.assertIsNone(self.database.get_pubkey('test3'))
+        self.owner.add_user('test3', 'hash3')
+        self.assertFalse(self.database.check_user('test3'))
+        self.database.forget_users()
+        self.assertTrue(self.database.check_user('test3'))
+
+
+class TestWorkerMessageProcessor(ServerTestCase):
+    """Тестовый класс процесса-обработчика"""
+
+    def make_server(self):
+        self.coordinator, worker_sock = socket.socketpair()
+        self.peers.append(self.coordinator)
+        return WorkerMessageProcessor(0, worker_sock, '127.0.0.1', 7777, WorkerRepository(self.database))
+
+    def test_kick_duplicate(self):
+        """Отклонённый повторный вход не удаляет запись подключения из другого процесса"""
+        client, peer = self.login('test1')
+        self.server.process_ipc_message({ACTION: IPC_KICK, ACCOUNT_NAME: 'test1', DUPLICATE: True})
+        self.assertNotIn(client, self.server.clients)
+        self.assertTrue(self.closed(peer))
+        self.assertEqual([row[0] for row in self.database.active_users_list()], ['test1'])
+
+    def test_kick(self):
+        """Отключённый администратором пользователь удаляется из активных"""
+        client, peer = self.login('test1')
+        self.server.process_ipc_message({ACTION: IPC_KICK, ACCOUNT_NAME: 'test1'})
+        self.assertTrue(self.closed(peer))
+        self.assertEqual(self.database.active_users_list(), [])
+        self.coordinator.settimeout(1)
+        messages = MessageDecoder().feed(self.coordinator.recv(MAX_PACKAGE_LENGTH))
+        self.assertEqual(messages[-1][ACTION], IPC_LOGOUT)
+
+
+if __name__ == '__main__':
+    unittest.main()